@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from ai.utils import TagsAi
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Compute the AI tag suggestions of every published post in batches, so GET /ai/tags/ answers from the cache (backfill)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        ai = TagsAi()
+        posts = Post.objects.filter(status='PUBLISHED').only('id', 'content').order_by('id')
+        total = 0
+        batch = []
+        for post in posts.iterator(chunk_size=options['batch_size']):
+            batch.append(post)
+            if len(batch) == options['batch_size']:
+                total += len(ai.get_tags_batch(batch))
+                batch = []
+        if batch:
+            total += len(ai.get_tags_batch(batch))
+        self.stdout.write(self.style.SUCCESS(f'tags have been suggested for {total} posts'))
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:40
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def create_labels_version(apps, schema_editor):
+    #the row invalidate_candidate_labels() moves (see utils.py), there from the start so a tag write is one UPDATE
+    RollupWatermark = apps.get_model('posts', 'RollupWatermark')
+    RollupWatermark.objects.get_or_create(name='tag_labels', defaults={'until': timezone.now()})
+
+
+def drop_labels_version(apps, schema_editor):
+    RollupWatermark = apps.get_model('posts', 'RollupWatermark')
+    RollupWatermark.objects.filter(name='tag_labels').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0027_outbox_claim_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_labels_version, drop_labels_version),
+    ]
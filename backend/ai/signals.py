@@ -1,7 +1,9 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from posts.models import Post
+from posts.models import Post, Tag
+from posts.tags import tags_created
 from .tasks import generate_post_summary
+from .utils import invalidate_candidate_labels
 from celery import current_app
 
 @receiver(post_save, sender=Post)
@@ -18,4 +20,17 @@ def generate_summary(sender, instance, created, **kwargs):
                 print("No Celery workers available. Skipping task generation.")                
         except Exception as e:
             print(f"Error checking worker status: {e}")
-        
\ No newline at end of file
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(tags_created)
+def refresh_candidate_labels(sender, **kwargs):
+    #the zero-shot labels are the tag names, memoized results use the new label set from now on
+    invalidate_candidate_labels()
+
+
+@receiver(post_save, sender=Tag)
+def refresh_renamed_labels(sender, instance, created, **kwargs):
+    #_renamed: set by posts.signals.detect_renamed_tag, a save that keeps the name changes no label
+    if created or instance._renamed:
+        invalidate_candidate_labels()
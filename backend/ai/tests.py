@@ -1,3 +1,173 @@
-from django.test import TestCase
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+
+from posts.benchmark import StubInferenceHandler
+from posts.models import Post, RollupWatermark, Tag
+from . import utils
+
+
+class RecordingInferenceHandler(StubInferenceHandler):
+    #keep-alive, so reused connections show up as requests sharing a client port
+    protocol_version = 'HTTP/1.1'
+    calls = []   #(client port, inputs), replaced per test
+    slow = ()    #inputs answered late
+
+    def answer(self, payload):
+        self.calls.append((self.client_address[1], payload['inputs']))
+        if payload['inputs'] in self.slow:
+            time.sleep(0.3)
+        return super().answer(payload)
+
+
+class StubInferenceMixin:
+    #serves the inference API locally for the duration of each test
+
+    def setUp(self):
+        cache.clear()
+        RecordingInferenceHandler.calls = []
+        RecordingInferenceHandler.slow = ()
+        server = ThreadingHTTPServer(('127.0.0.1', 0), RecordingInferenceHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        patcher = mock.patch.object(utils, 'HF_BASE_URL', f'http://127.0.0.1:{server.server_address[1]}/models')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class SummaryAiTests(StubInferenceMixin, SimpleTestCase):
+    """
+    SummaryAi against a local stand-in of the inference API (the stub answers the first 100 characters of a chunk)
+    """
+
+    def chunk(self, letter):
+        #long enough for every line to be a chunk of its own
+        return letter * 1500
+
+    def summarize(self, *lines):
+        return utils.SummaryAi(Post(content='\n'.join(lines))).get_summary()
+
+    def test_chunks_come_back_in_order(self):
+        lines = [self.chunk(letter) for letter in 'abcd']
+        #the first chunk is answered last
+        RecordingInferenceHandler.slow = (lines[0],)
+        summary = self.summarize(*lines)
+        self.assertEqual(summary, ''.join(line[:100] + '\n' for line in lines))
+        self.assertEqual(sorted(inputs for _, inputs in RecordingInferenceHandler.calls), lines)
+
+    def test_chunks_are_sent_concurrently(self):
+        lines = [self.chunk(letter) for letter in 'abcd']
+        RecordingInferenceHandler.slow = tuple(lines)
+        started = time.monotonic()
+        self.summarize(*lines)
+        self.assertLess(time.monotonic() - started, 0.3 * len(lines))
+
+    def test_pooled_session_is_reused(self):
+        self.summarize(self.chunk('a'))
+        self.summarize(self.chunk('b'))
+        self.summarize(self.chunk('c'))
+        ports = {port for port, _ in RecordingInferenceHandler.calls}
+        self.assertEqual(len(RecordingInferenceHandler.calls), 3)
+        self.assertEqual(len(ports), 1)
+
+        #parallel chunks never open more connections than the pool holds
+        self.summarize(*[self.chunk(letter) for letter in 'defghijk'])
+        ports = {port for port, _ in RecordingInferenceHandler.calls}
+        self.assertLessEqual(len(ports), utils.MAX_PARALLEL_CALLS)
+
+    def test_edit_only_sends_the_changed_chunks(self):
+        first, second, third = self.chunk('a'), self.chunk('b'), self.chunk('c')
+        self.summarize(first, second, third)
+        self.assertEqual(len(RecordingInferenceHandler.calls), 3)
+
+        RecordingInferenceHandler.calls = []
+        edited = self.chunk('e')
+        summary = self.summarize(first, edited, third)
+        self.assertEqual([inputs for _, inputs in RecordingInferenceHandler.calls], [edited])
+        self.assertEqual(summary, ''.join(line[:100] + '\n' for line in (first, edited, third)))
+
+        #unchanged post: nothing is sent
+        RecordingInferenceHandler.calls = []
+        self.summarize(first, edited, third)
+        self.assertEqual(RecordingInferenceHandler.calls, [])
+
+    def test_summarize_chunk_is_cached_by_content(self):
+        ai = utils.SummaryAi(Post(content=''))
+        self.assertEqual(ai.get_summary(), '')
+        self.assertEqual(ai.summarize_chunk('short chunk'), 'short chunk')
+        self.assertEqual(ai.summarize_chunk('short chunk'), 'short chunk')
+        self.assertEqual(len(RecordingInferenceHandler.calls), 1)
+
+
+class TagsAiTests(StubInferenceMixin, TestCase):
+    """
+    TagsAi against the local stand-in: the candidate labels follow the tags, results are memoized by
+    content and label set (the stub ranks the labels in the order they are sent: alphabetical)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(username='author', password='x')
+        Tag.objects.bulk_create([Tag(name='django'), Tag(name='python')])
+        cls.posts = Post.objects.bulk_create([
+            Post(owner=author, title=f'post {i}', content=f'content {i}', status='PUBLISHED') for i in range(4)
+        ])
+
+    def sent(self):
+        #the contents sent, one list per call
+        return [inputs if isinstance(inputs, list) else [inputs] for _, inputs in RecordingInferenceHandler.calls]
+
+    def test_candidate_labels_follow_the_tags(self):
+        self.assertEqual(utils.get_candidate_labels()[0], ['django', 'python'])
+        Tag.objects.create(name='celery')
+        self.assertEqual(utils.get_candidate_labels()[0], ['celery', 'django', 'python'])
+        tag = Tag.objects.get(name='celery')
+        tag.name = 'redis'
+        tag.save()
+        self.assertEqual(utils.get_candidate_labels()[0], ['django', 'python', 'redis'])
+        tag.delete()
+        self.assertEqual(utils.get_candidate_labels()[0], ['django', 'python'])
+
+    def test_other_workers_see_the_change_through_the_version_row(self):
+        labels, version = utils.get_candidate_labels()
+        #a tag created by another worker: its cache is not ours, the version row is shared
+        Tag.objects.bulk_create([Tag(name='celery')])
+        RollupWatermark.objects.update_or_create(name=utils.LABELS_VERSION, defaults={'until': '2030-01-01T00:00:00Z'})
+        self.assertEqual(utils.get_candidate_labels(), (labels, version))
+        cache.delete(utils.LABELS_VERSION_KEY)   #LABELS_VERSION_TTL later
+        self.assertEqual(utils.get_candidate_labels()[0], ['celery', 'django', 'python'])
+
+    def test_memoized_by_content_and_labels(self):
+        post = self.posts[0]
+        self.assertEqual(utils.TagsAi(post).get_tags(), {'django': 1.0, 'python': 0.5})
+        utils.TagsAi(post).get_tags()
+        self.assertEqual(self.sent(), [['content 0']])
+
+        post.content = 'edited'
+        utils.TagsAi(post).get_tags()
+        self.assertEqual(self.sent()[1:], [['edited']])
+
+        Tag.objects.create(name='celery')
+        self.assertEqual(utils.TagsAi(post).get_tags(), {'celery': 1.0, 'django': 0.5, 'python': 1 / 3})
+        self.assertEqual(self.sent()[2:], [['edited']])
+
+    def test_batch_skips_memoized_posts(self):
+        first, *others = self.posts
+        utils.TagsAi(first).get_tags()
+        ai = utils.TagsAi()
+        with mock.patch.object(utils.TagsAi, 'batch_size', 2):
+            tags = ai.get_tags_batch(self.posts)
+        self.assertEqual(set(tags), {post.id for post in self.posts})
+        self.assertTrue(all(result == {'django': 1.0, 'python': 0.5} for result in tags.values()))
+        #the memoized post is not sent again, the others go two by two
+        self.assertEqual(self.sent(), [['content 0'], ['content 1', 'content 2'], ['content 3']])
+
+        RecordingInferenceHandler.calls = []
+        ai.get_tags_batch(self.posts)
+        self.assertEqual(self.sent(), [])
@@ -1,39 +1,133 @@
 import os
+import hashlib
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from django.core.cache import cache
 from django.shortcuts import get_object_or_404
-from posts.models import Post,Tag
+from django.utils import timezone
+from posts.models import Post,RollupWatermark,Tag
 from dotenv import load_dotenv
 
 load_dotenv()
 
+HF_BASE_URL = os.getenv('HF_BASE_URL', 'https://router.huggingface.co/hf-inference/models')
+MAX_PARALLEL_CALLS = 4
+CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+#one pooled session shared by every call, so connections (and TLS handshakes) are reused
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_PARALLEL_CALLS))
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_PARALLEL_CALLS))
+
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+LABELS_CACHE_KEY = 'tags:candidate_labels'
+#time of the last tag change, a database row so every worker sees it whatever the cache backend;
+#a worker reads it again after LABELS_VERSION_TTL, its labels can be that much behind
+LABELS_VERSION = 'tag_labels'
+LABELS_VERSION_KEY = 'tags:labels_version'
+LABELS_VERSION_TTL = 60
+
+
+def labels_version():
+    version = cache.get(LABELS_VERSION_KEY)
+    if version is None:
+        changed = RollupWatermark.objects.filter(name=LABELS_VERSION).values_list('until',flat=True).first()
+        version = changed.isoformat() if changed else ''
+        cache.set(LABELS_VERSION_KEY, version, LABELS_VERSION_TTL)
+    return version
+
+
+def get_candidate_labels():
+    """
+    (labels, version) of the tag names, cached until a tag changes (see signals.py)
+    the version is a hash of the labels so memoized results die with the label set
+    """
+    changed = labels_version()
+    cached = cache.get(LABELS_CACHE_KEY)
+    if cached is None or cached[2] != changed:
+        labels = list(Tag.objects.order_by('name').values_list('name',flat=True))
+        cached = (labels, content_hash(*labels), changed)
+        cache.set(LABELS_CACHE_KEY, cached, CACHE_TIMEOUT)
+    return cached[0], cached[1]
+
+
+def invalidate_candidate_labels():
+    #one UPDATE once the row exists (bulk_create's upsert would wrap itself in a transaction of its own)
+    now = timezone.now()
+    if not RollupWatermark.objects.filter(name=LABELS_VERSION).update(until=now):
+        RollupWatermark.objects.update_or_create(name=LABELS_VERSION, defaults={'until': now})
+    cache.delete_many([LABELS_CACHE_KEY, LABELS_VERSION_KEY])
+
+
 class TagsAi:
-    def __init__(self,post:Post):
-        self.API_URL =  "https://router.huggingface.co/hf-inference/models/facebook/bart-large-mnli"
+    top_k = 3
+    batch_size = 16   #posts per inference call in batch mode
+
+    def __init__(self,post:Post=None):
+        self.API_URL = f"{HF_BASE_URL}/facebook/bart-large-mnli"
         self.headers = {
             "Authorization": f"Bearer {os.getenv('HF_TOKEN')}",
         }
         self.post = post
+
     def query(self,payload):
-        response = requests.post(self.API_URL, headers=self.headers, json=payload)
+        response = session.post(self.API_URL, headers=self.headers, json=payload, timeout=120)
         return response.json()
-    def get_tags(self):
-        tags = list(Tag.objects.all().values_list('name',flat=True))
-        output = self.query({
-            "inputs": self.post.content,
-            "parameters": {"candidate_labels": tags},
-        })
+
+    def cache_key(self,content,version):
+        return 'tags:' + content_hash(self.API_URL, version, content)
+
+    def top_tags(self,output):
         labels = output['labels']
         scores = output['scores']
         rslt = {}
-        for i in range(3):
+        for i in range(min(self.top_k, len(labels))):
             rslt[labels[i]] = scores[i]
         return rslt
 
+    def get_tags(self):
+        return self.get_tags_batch([self.post])[self.post.id]
+
+    def get_tags_batch(self,posts):
+        """
+        {post id: {tag: score}} for many posts (backfills, see the suggest_post_tags command):
+        memoized by content and label set, memoized posts are skipped and the others are sent
+        `batch_size` at a time in a single call each
+        """
+        labels, version = get_candidate_labels()
+        if not labels:
+            return {post.id: {} for post in posts}
+        keys = {post.id: self.cache_key(post.content, version) for post in posts}
+        hits = cache.get_many(keys.values())
+        rslt = {post_id: hits[key] for post_id, key in keys.items() if key in hits}
+
+        missing = [post for post in posts if post.id not in rslt]
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            output = self.query({
+                "inputs": [post.content for post in batch] if len(batch) > 1 else batch[0].content,
+                "parameters": {"candidate_labels": labels},
+            })
+            outputs = output if isinstance(output, list) else [output]
+            computed = {post.id: self.top_tags(item) for post, item in zip(batch, outputs)}
+            cache.set_many({keys[post_id]: tags for post_id, tags in computed.items()}, CACHE_TIMEOUT)
+            rslt.update(computed)
+        return rslt
+
 
 
 class SummaryAi:
     def __init__(self,post):
-        self.API_URL = "https://router.huggingface.co/hf-inference/models/facebook/bart-large-cnn"
+        self.API_URL = f"{HF_BASE_URL}/facebook/bart-large-cnn"
         self.headers = {
             "Authorization": f"Bearer {os.getenv('HF_TOKEN')}",
         }
@@ -41,10 +135,27 @@ class SummaryAi:
         self.max_length = 2048
 
     def query(self,payload):
-        response = requests.post(self.API_URL, headers=self.headers, json=payload)
+        response = session.post(self.API_URL, headers=self.headers, json=payload, timeout=120)
         return response.json()
-    
-    def get_summary(self):
+
+    def summarize_chunk(self,sentence):
+        #chunks are cached by content, re-summarizing an edited post only sends the chunks that changed
+        key = 'summary:' + content_hash(self.API_URL, sentence)
+        summary = cache.get(key)
+        if summary is None:
+            length = len(sentence)
+            result = self.query({
+                "inputs": sentence,
+                "parameters":{
+                    "max_length":  int(length) ,
+                    "min_length":  int(length/4),
+                }
+            })
+            summary = str(result[0]["summary_text"])
+            cache.set(key, summary, CACHE_TIMEOUT)
+        return summary
+
+    def get_chunks(self):
         txt = self.post.content
 
         splitted = txt.split('\n')
@@ -69,19 +180,15 @@ class SummaryAi:
             input_text.append(current)
             if stop:
                 break
-        summary = ''
-        for sentence in input_text:
-            length = len(sentence)
-            result = self.query({
-            "inputs": sentence,
-            "parameters":{
-                    "max_length":  int(length) ,
-                    "min_length":  int(length/4),  
-                }
-        })
-            
-            summary += str(result[0]["summary_text"]) + '\n'
+        return input_text
 
-        return summary
+    def get_summary(self):
+        input_text = self.get_chunks()
+        if not input_text:
+            return ''
+        #the chunks are summarized concurrently, map() keeps them in order
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_CALLS, len(input_text))) as executor:
+            summaries = list(executor.map(self.summarize_chunk, input_text))
+        return ''.join(summary + '\n' for summary in summaries)
 
             
\ No newline at end of file
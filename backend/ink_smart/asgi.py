@@ -2,6 +2,8 @@
 ASGI config for ink_smart project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Requests coming through it are routed with urls_async.py: the feed, post detail, comments
+list and current user endpoints are served by async views.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -9,8 +11,20 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ink_smart.settings')
 
-application = get_asgi_application()
+ASYNC_URLCONF = 'ink_smart.urls_async'
+
+
+class InkSmartASGIHandler(ASGIHandler):
+    async def get_response_async(self, request):
+        request.urlconf = ASYNC_URLCONF
+        return await super().get_response_async(request)
+
+
+#what get_asgi_application() does, with the handler above
+django.setup(set_prefix=False)
+application = InkSmartASGIHandler()
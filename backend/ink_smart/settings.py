@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -60,6 +61,7 @@ INSTALLED_APPS = [
 CORS_ALLOW_ALL_ORIGINS = True
 
 MIDDLEWARE = [
+    'posts.middleware.ServerTimingMiddleware',   #first: its total covers every other middleware
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -103,6 +105,50 @@ DATABASES = {
     }
 }
 
+#SQLITE_PROFILE=production: SQLite tuned for several workers writing at once
+#- WAL: readers do not block the writer and the writer does not block readers
+#- synchronous=NORMAL: no fsync per commit in WAL mode, a power loss can only lose the last commits
+#- IMMEDIATE transactions take the write lock up front, so they wait `timeout` seconds (sqlite's busy_timeout)
+#  instead of failing with "database is locked" when upgrading from a read lock
+#- mmap / page cache / in-memory temp tables for the reads
+#- likes and views are committed by one writer thread per process (WRITE_QUEUE, see posts/writer.py)
+SQLITE_PRODUCTION_OPTIONS = {
+    'init_command': ';'.join([
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA mmap_size=268435456',
+        'PRAGMA cache_size=-65536',
+        'PRAGMA temp_store=MEMORY',
+    ]),
+    'transaction_mode': 'IMMEDIATE',
+    'timeout': 20,
+}
+#manage.py test
+TESTING = sys.argv[1:2] == ['test']
+
+SQLITE_PRODUCTION = os.getenv('SQLITE_PROFILE', '').lower() == 'production'
+if SQLITE_PRODUCTION:
+    DATABASES['default']['OPTIONS'] = SQLITE_PRODUCTION_OPTIONS
+
+
+# Cache
+# local memory by default, set REDIS_CACHE_URL to share the cache between workers: required with several
+# workers, the cached responses are invalidated by version keys in the cache (posts/response_cache.py)
+
+if os.getenv('REDIS_CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_CACHE_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -187,12 +233,98 @@ SIMPLE_JWT = {
 MEDIA_ROOT = os.path.join(BASE_DIR,'media')
 MEDIA_URL = '/media/'
 
+#uploaded images are resized (thumb/card/full variants) by the celery worker,
+#IMAGE_VARIANTS_IN_WORKER=false resizes them in the request instead (no worker running)
+IMAGE_VARIANTS_IN_WORKER = os.getenv('IMAGE_VARIANTS_IN_WORKER', 'true').lower() == 'true'
+
+
+
+
+
+#post views are buffered in memory and written in batches (posts/ingestion.py),
+#the tests flush inline instead of from a thread sharing their database
+VIEW_BUFFER = {
+    'MAX_SIZE': 10000,
+    'FLUSH_SIZE': 500,
+    'FLUSH_INTERVAL': 2.0,
+    'BACKGROUND': not TESTING,
+}
+
+#likes, saves and comments move the trending scores and tag affinities in batches (posts/ingestion.py)
+ENGAGEMENT_BUFFER = {
+    'MAX_SIZE': 10000,
+    'FLUSH_SIZE': 500,
+    'FLUSH_INTERVAL': 2.0,
+    'BACKGROUND': not TESTING,
+}
+
+#likes and buffered views are committed by one writer thread per process (posts/writer.py)
+WRITE_QUEUE = {
+    'ENABLED': os.getenv('WRITE_QUEUE', 'true' if SQLITE_PRODUCTION else 'false').lower() == 'true',
+    'BATCH_SIZE': 100,
+    'TIMEOUT': 30.0,
+}
+
+#time-decayed engagement scores of the trending feed (posts/trending.py), decayed by the decay-post-scores beat task
+TRENDING = {
+    'HALF_LIFE': 24 * 3600,
+    'WEIGHTS': {'views': 1.0, 'likes': 5.0, 'comments': 10.0},
+    'MIN_SCORE': 0.05,
+}
 
+#"for you" feed from the readers' tag affinities (posts/personalization.py), recomputed by the
+#rebuild-for-you-feed beat task
+FOR_YOU = {
+    'WEIGHTS': {'likes': 3.0, 'saves': 5.0, 'comments': 2.0},
+    'TAGS': 10,
+    'HALF_LIFE': 3 * 24 * 3600,
+    'MAX_PAGES': 10,
+}
 
+#precomputed related posts (posts/related.py): refreshed for new / edited posts by the refresh-related-posts
+#beat task, fully recomputed by rebuild-related-posts
+RELATED_POSTS = {
+    'NEIGHBOURS': 10,
+    'MAX_TERMS': 64,
+    'MAX_DF': 0.5,
+    'MAX_CANDIDATES': 1000,
+    'MAX_POSTINGS': 500,
+}
 
 
 #celery settings
 CELERY_BROKER_URL = 'redis://localhost:6379/0'  # Redis as broker
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
-CELERY_TASK_SERIALIZER = 'json'
\ No newline at end of file
+CELERY_TASK_SERIALIZER = 'json'
+
+CELERY_BEAT_SCHEDULE = {
+    'roll-up-post-stats': {
+        'task': 'posts.tasks.roll_up_post_stats',
+        'schedule': 300.0,
+    },
+    'decay-post-scores': {
+        'task': 'posts.tasks.decay_post_scores',
+        'schedule': 600.0,
+    },
+    'refresh-related-posts': {
+        'task': 'posts.tasks.refresh_related_posts',
+        'schedule': 300.0,
+    },
+    'rebuild-related-posts': {
+        'task': 'posts.tasks.rebuild_related_posts',
+        'schedule': 24 * 3600.0,
+    },
+    'rebuild-for-you-feed': {
+        'task': 'posts.tasks.rebuild_for_you_feed',
+        'schedule': 24 * 3600.0,
+    },
+    'deliver-outbox-mail': {
+        'task': 'posts.tasks.deliver_outbox_mail',
+        'schedule': 10.0,
+    },
+    'prune-outbox-mail': {
+        'task': 'posts.tasks.prune_outbox_mail',
+        'schedule': 3600.0,
+    },
+}
\ No newline at end of file
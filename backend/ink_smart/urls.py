@@ -2,6 +2,7 @@ from django.contrib import admin
 from django.urls import path,include,re_path
 from django.conf import settings
 from django.conf.urls.static import static
+from posts.metrics import metrics_view
 
 
 from drf_spectacular.views import (
@@ -15,6 +16,7 @@ urlpatterns = [
     path('users/',include('users.urls')),
     path('posts/',include('posts.urls')),
     path('ai/',include('ai.urls')),
+    path('metrics',metrics_view),
 
     path('schema/', SpectacularAPIView.as_view(), name='schema'),
     path('docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
@@ -0,0 +1,18 @@
+"""
+URL configuration of the ASGI entry point (asgi.py)
+
+The hot read endpoints are answered by async views (posts/views_async.py), every other
+route is the one of urls.py. The paths are the same, so clients see no difference.
+"""
+from django.urls import path
+
+from posts import views_async
+from users import views_async as users_views_async
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path('posts/', views_async.posts_list_create),
+    path('posts/<int:post_id>/', views_async.post_detail),
+    path('posts/<int:post_id>/comments/', views_async.comments_list_create),
+    path('users/current/', users_views_async.current_user_info),
+] + sync_urlpatterns
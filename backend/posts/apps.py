@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class PostsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'posts'
+
+    def ready(self):
+        import posts.signals
+        import posts.checks   #check --deploy warns about a per-process cache
+        import posts.metrics   #times the queries of every new connection (Server-Timing, /metrics)
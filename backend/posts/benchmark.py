@@ -0,0 +1,512 @@
+"""
+Endpoint benchmark: seed a dataset, call every route of posts/, users/ and ai/ and measure
+the number of queries and the latency of each one (see the benchmark_endpoints command)
+
+Query budgets are the regression guard: a route costing a fixed number of queries must keep
+that number whatever the size of the dataset, so an N+1 shows up as soon as it is introduced.
+"""
+import json
+import math
+import random
+import statistics
+import threading
+from collections import namedtuple
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from time import perf_counter
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users.models import Profile
+from .counters import COMMENT_COUNTERS, POST_COUNTERS, reconcile
+from .ingestion import engagement_buffer, view_buffer
+from .personalization import for_you
+from .related import related_posts
+from .models import Comment, Like, Post, PostView, Tag
+from .rollups import roll_up
+from .search import rebuild_index
+from .trending import trending_scores
+
+Endpoint = namedtuple('Endpoint', ['name', 'method', 'build', 'user', 'status', 'format'])
+Result = namedtuple('Result', ['queries', 'p50', 'p95'])
+
+ENDPOINTS = []
+
+DEFAULT_SIZES = {
+    'users': 50,
+    'posts': 500,
+    'tags': 30,
+    'comments': 5,       #top level comments per post
+    'replies': 2,        #replies per top level comment
+    'likes': 10,         #likes per post
+    'views': 20,         #views per post
+}
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def endpoint(name, method, user=None, status=200, format='json'):
+    """
+    register a benchmarked route, the decorated function gets (ctx, iteration) and returns
+    (path, data); it runs before the measured request so it can create the rows the request needs
+    """
+    def register(build):
+        ENDPOINTS.append(Endpoint(name, method, build, user, status, format))
+        return build
+    return register
+
+
+class Context:
+    #the seeded objects the routes are called with
+    def __init__(self, viewer, admin, post, own_post, tag):
+        self.viewer = viewer
+        self.admin = admin
+        self.post = post
+        self.own_post = own_post
+        self.tag = tag
+        self.comment = post.comments.filter(parent_comment=None).first()
+        self.tokens = {
+            'viewer': str(RefreshToken.for_user(viewer).access_token),
+            'admin': str(RefreshToken.for_user(admin).access_token),
+        }
+        self.refresh = str(RefreshToken.for_user(viewer))
+
+
+def image_file(name='bench.png'):
+    buffer = BytesIO()
+    Image.new('RGB', (1200, 800), (40, 90, 160)).save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+def new_post(owner, status='PUBLISHED'):
+    return Post.objects.create(owner=owner, title='benchmark post', content='benchmark body', status=status)
+
+
+#----- posts/urls.py
+
+@endpoint('posts:list:anonymous', 'GET')
+def posts_list_anonymous(ctx, i):
+    return '/posts/', None
+
+
+@endpoint('posts:list', 'GET', user='viewer')
+def posts_list(ctx, i):
+    return '/posts/', None
+
+
+@endpoint('posts:list:search', 'GET', user='viewer')
+def posts_search(ctx, i):
+    return '/posts/', {'search': 'benchmark topic'}
+
+
+@endpoint('posts:create', 'POST', user='viewer', status=201)
+def posts_create(ctx, i):
+    return '/posts/', {'title': f'new post {i}', 'content': 'created by the benchmark', 'tags': ['topic1', 'topic2', f'fresh{i}']}
+
+
+@endpoint('posts:detail', 'GET', user='viewer')
+def posts_detail(ctx, i):
+    return f'/posts/{ctx.post.id}/', None
+
+
+@endpoint('posts:update', 'PATCH', user='viewer')
+def posts_update(ctx, i):
+    return f'/posts/{ctx.own_post.id}/', {'content': f'edited {i}'}
+
+
+@endpoint('posts:delete', 'DELETE', user='viewer', status=204)
+def posts_delete(ctx, i):
+    return f'/posts/{new_post(ctx.viewer).id}/', None
+
+
+@endpoint('posts:image:upload', 'POST', user='viewer', status=201, format='multipart')
+def posts_image_upload(ctx, i):
+    return f'/posts/{ctx.own_post.id}/image/', {'image': image_file()}
+
+
+@endpoint('posts:image', 'GET')
+def posts_image(ctx, i):
+    return f'/posts/{ctx.own_post.id}/image/', {'variant': 'card'}
+
+
+@endpoint('posts:image:delete', 'DELETE', user='viewer', status=201)
+def posts_image_delete(ctx, i):
+    post = new_post(ctx.viewer)
+    post.image = image_file()
+    post.save()
+    return f'/posts/{post.id}/image/', None
+
+
+@endpoint('posts:publish', 'POST', user='viewer')
+def posts_publish(ctx, i):
+    return f'/posts/{new_post(ctx.viewer, status="DRAFT").id}/publish/', None
+
+
+@endpoint('posts:state', 'POST', user='viewer')
+def posts_state(ctx, i):
+    return '/posts/state/', {'post_ids': list(Post.objects.order_by('-id').values_list('id', flat=True)[:100])}
+
+
+@endpoint('posts:trending:anonymous', 'GET')
+def posts_trending_anonymous(ctx, i):
+    return '/posts/trending/', None
+
+
+@endpoint('posts:trending', 'GET', user='viewer')
+def posts_trending(ctx, i):
+    return '/posts/trending/', {'limit': 50}
+
+
+@endpoint('posts:related', 'GET')
+def posts_related(ctx, i):
+    return f'/posts/{ctx.post.id}/related/', None
+
+
+@endpoint('posts:for_you', 'GET', user='viewer')
+def posts_for_you(ctx, i):
+    return '/posts/for_you/', {'page': i % 3 + 1}
+
+
+@endpoint('posts:like', 'POST', user='viewer', status=None)   #a toggle: 201 and 200 alternate
+def posts_like(ctx, i):
+    return f'/posts/{ctx.post.id}/like/', None
+
+
+@endpoint('posts:likers', 'GET')
+def posts_likers(ctx, i):
+    return f'/posts/{ctx.post.id}/all_likes/', None
+
+
+@endpoint('posts:saved', 'GET', user='viewer')
+def posts_saved(ctx, i):
+    return '/posts/saved_posts/', None
+
+
+@endpoint('posts:save', 'POST', user='viewer')
+def posts_save(ctx, i):
+    return f'/posts/save_post/?post_id={ctx.post.id}', None
+
+
+@endpoint('comments:list', 'GET', user='viewer')
+def comments_list(ctx, i):
+    return f'/posts/{ctx.post.id}/comments/', None
+
+
+@endpoint('comments:create', 'POST', user='viewer', status=201)
+def comments_create(ctx, i):
+    #UserRateThrottle would stop the run after 10 comments
+    cache.delete(f'throttle_user_{ctx.viewer.id}')
+    return f'/posts/{ctx.post.id}/comments/', {'content': f'comment {i}'}
+
+
+@endpoint('comments:detail', 'GET')
+def comments_detail(ctx, i):
+    return f'/posts/{ctx.post.id}/comments/{ctx.comment.id}/', None
+
+
+@endpoint('comments:update', 'PATCH', user='admin')
+def comments_update(ctx, i):
+    return f'/posts/{ctx.post.id}/comments/{ctx.comment.id}/', {'content': f'edited {i}'}
+
+
+@endpoint('comments:delete', 'DELETE', user='admin', status=204)
+def comments_delete(ctx, i):
+    comment = Comment.objects.create(owner=ctx.viewer, post=ctx.post, content='to delete')
+    return f'/posts/{ctx.post.id}/comments/{comment.id}/', None
+
+
+@endpoint('comments:like', 'POST', user='viewer')
+def comments_like(ctx, i):
+    return f'/posts/{ctx.post.id}/comments/{ctx.comment.id}/like/', None
+
+
+@endpoint('comments:user', 'GET', user='viewer')
+def comments_user(ctx, i):
+    return '/posts/user_comments/', None
+
+
+@endpoint('tags:list', 'GET')
+def tags_list(ctx, i):
+    return '/posts/tags/', None
+
+
+@endpoint('tags:create', 'POST', user='admin', status=201)
+def tags_create(ctx, i):
+    return '/posts/tags/', {'name': f'benchmark tag {i}'}
+
+
+@endpoint('tags:detail', 'GET')
+def tags_detail(ctx, i):
+    return f'/posts/tags/{ctx.tag.id}/', None
+
+
+@endpoint('tags:update', 'PATCH', user='admin')
+def tags_update(ctx, i):
+    return f'/posts/tags/{ctx.tag.id}/', {'name': f'renamed {i}'}
+
+
+@endpoint('tags:delete', 'DELETE', user='admin', status=204)
+def tags_delete(ctx, i):
+    tag = Tag.objects.create(name=f'doomed {i}')
+    tag.posts.add(ctx.own_post)
+    return f'/posts/tags/{tag.id}/', None
+
+
+@endpoint('tags:bulk', 'POST', user='admin')
+def tags_bulk(ctx, i):
+    return '/posts/tags/bulk/', {'tag_names': [f'bulk{i}-{n}' for n in range(50)] + ['topic1', 'topic2']}
+
+
+@endpoint('statistics:post', 'GET', user='viewer')
+def statistics_post(ctx, i):
+    return f'/posts/statistics/post_stats/{ctx.own_post.id}/', None
+
+
+@endpoint('statistics:user', 'GET', user='viewer')
+def statistics_user(ctx, i):
+    return '/posts/statistics/', None
+
+
+#----- users/urls.py
+
+@endpoint('users:register', 'POST')
+def users_register(ctx, i):
+    return '/users/auth/register/', {
+        'user': {'username': f'newcomer{i}', 'email': f'newcomer{i}@example.com', 'password': 'benchmark', 'first_name': 'New', 'last_name': 'Comer'},
+        'first_name': 'New', 'last_name': 'Comer',
+    }
+
+
+@endpoint('users:login', 'POST')
+def users_login(ctx, i):
+    return '/users/auth/login/', {'email': ctx.viewer.email, 'password': 'benchmark'}
+
+
+@endpoint('users:access_token', 'POST')
+def users_access_token(ctx, i):
+    return '/users/auth/access_token/', {'refresh': ctx.refresh}
+
+
+@endpoint('users:profile:me', 'GET', user='viewer')
+def users_profile_me(ctx, i):
+    return '/users/profile/me/', None
+
+
+@endpoint('users:profile:update', 'PUT', user='viewer')
+def users_profile_update(ctx, i):
+    return '/users/profile/me/', {'age': 20 + i % 10}
+
+
+@endpoint('users:profile', 'GET')
+def users_profile(ctx, i):
+    return f'/users/profile/{ctx.post.owner_id}/', None
+
+
+@endpoint('users:posts', 'GET')
+def users_posts(ctx, i):
+    return f'/users/{ctx.post.owner_id}/posts/', None
+
+
+@endpoint('users:current', 'GET', user='viewer')
+def users_current(ctx, i):
+    return '/users/current/', None
+
+
+@endpoint('users:pfp:upload', 'POST', user='viewer', format='multipart')
+def users_pfp_upload(ctx, i):
+    return '/users/profile/upload_pfp/', {'pfp': image_file('pfp.png')}
+
+
+@endpoint('users:pfp:remove', 'DELETE', user='viewer')
+def users_pfp_remove(ctx, i):
+    return '/users/profile/remove_pfp/', None
+
+
+#----- ai/urls.py (against the stub upstream)
+
+@endpoint('ai:tags', 'GET')
+def ai_tags(ctx, i):
+    return '/ai/post_tags/', {'post_id': ctx.post.id}
+
+
+@endpoint('ai:summary', 'GET')
+def ai_summary(ctx, i):
+    return '/ai/post_summary/', {'post_id': ctx.post.id}
+
+
+
+class StubInferenceHandler(BaseHTTPRequestHandler):
+    #answers like the hugging face inference API: zero-shot classification and summarization
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        data = json.dumps(self.answer(payload)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def answer(self, payload):
+        if self.path.endswith('bart-large-mnli'):
+            labels = payload['parameters']['candidate_labels']
+            answer = {'labels': labels, 'scores': [1 / (rank + 1) for rank in range(len(labels))]}
+            return [answer] * len(payload['inputs']) if isinstance(payload['inputs'], list) else answer
+        return [{'summary_text': payload['inputs'][:100]}]
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_upstream():
+    #returns (server, base url), stop it with server.shutdown()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubInferenceHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/models'
+
+
+
+def seed(users, posts, tags, comments, replies, likes, views, rng=None):
+    """
+    fill the (empty, test) database with a dataset of the given size with bulk inserts,
+    then build what the signals would have maintained: counters, search index, rollups, trending scores, tag affinities, related posts
+    """
+    rng = rng or random.Random(0)
+    now = timezone.now()
+    password = make_password('benchmark')   #hashed once, shared by every seeded user
+
+    User.objects.bulk_create([
+        User(username=f'reader{n}', email=f'reader{n}@example.com', password=password, first_name='Reader', last_name=str(n))
+        for n in range(users)
+    ])
+    people = list(User.objects.filter(username__startswith='reader').order_by('id'))
+    Profile.objects.bulk_create([
+        Profile(user=person, first_name=person.first_name, last_name=person.last_name, accept_notifications=False)
+        for person in people
+    ])
+    topics = Tag.objects.bulk_create([Tag(name=f'topic{n}') for n in range(tags)])
+
+    Post.objects.bulk_create([
+        Post(owner=rng.choice(people), title=f'benchmark post {n}', content=f'benchmark body {n} ' * 40, status='PUBLISHED')
+        for n in range(posts)
+    ])
+    all_posts = list(Post.objects.order_by('id'))
+    Post.tags.through.objects.bulk_create([
+        Post.tags.through(post_id=post.id, tag_id=tag.id)
+        for post in all_posts for tag in rng.sample(topics, min(3, len(topics)))
+    ])
+
+    top = Comment.objects.bulk_create([
+        Comment(owner=rng.choice(people), post=post, content='top level comment')
+        for post in all_posts for _ in range(comments)
+    ])
+    Comment.objects.bulk_create([
+        Comment(owner=rng.choice(people), post_id=comment.post_id, parent_comment=comment, content='reply')
+        for comment in top for _ in range(replies)
+    ])
+    Comment.likes.through.objects.bulk_create([
+        Comment.likes.through(comment_id=comment.id, user_id=person.id)
+        for comment in top for person in rng.sample(people, min(2, len(people)))
+    ])
+    Like.objects.bulk_create([
+        Like(post=post, user=person)
+        for post in all_posts for person in rng.sample(people, min(likes, len(people)))
+    ])
+    PostView.objects.bulk_create([
+        PostView(post=post, viewer=rng.choice(people), timestamp=now - timedelta(days=rng.randrange(60)))
+        for post in all_posts for _ in range(views)
+    ], batch_size=1000)
+
+    reconcile(Post, POST_COUNTERS)
+    reconcile(Comment, COMMENT_COUNTERS)
+    rebuild_index()
+    roll_up()
+    trending_scores.rebuild()
+    for_you.rebuild()
+    related_posts.rebuild()
+    return people
+
+
+def build_context(people):
+    viewer = people[0]
+    admin = User.objects.create_superuser('benchmark-admin', 'admin@example.com', 'benchmark')
+    Profile.objects.create(user=admin, first_name='Admin', last_name='Benchmark')
+    own_post = new_post(viewer)
+    own_post.tags.add(*Tag.objects.order_by('id')[:2])
+    post = Post.objects.exclude(owner=viewer).filter(comments__isnull=False).order_by('id').first()
+    viewer.saved_posts.add(*Post.objects.order_by('id')[:20])
+    return Context(viewer, admin, post, own_post, Tag.objects.order_by('id').first())
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def measure(ctx, endpoints, iterations):
+    """
+    {name: Result(queries, p50, p95)}: the most queries any iteration ran and the latency
+    percentiles in milliseconds; raises BenchmarkError when a route answers an unexpected status
+    """
+    results = {}
+    for ep in endpoints:
+        client = APIClient()
+        if ep.user:
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {ctx.tokens[ep.user]}')
+        timings = []
+        queries = 0
+        for i in range(iterations):
+            path, data = ep.build(ctx, i)
+            request = getattr(client, ep.method.lower())
+            reset_queries()   #the query log is bounded, a full log would make every capture look empty
+            with CaptureQueriesContext(connection) as captured:
+                start = perf_counter()
+                if ep.method == 'GET':
+                    response = request(path, data)
+                else:
+                    response = request(path, data, format=ep.format)
+                timings.append((perf_counter() - start) * 1000)
+            if ep.status is not None and response.status_code != ep.status:
+                raise BenchmarkError(f'{ep.name}: {ep.method} {path} answered {response.status_code}, expected {ep.status}')
+            if ep.status is None and response.status_code >= 400:
+                raise BenchmarkError(f'{ep.name}: {ep.method} {path} answered {response.status_code}')
+            queries = max(queries, len(captured))
+        #buffered post views and engagements are written between routes so the flush is not charged to one request
+        view_buffer.flush()
+        engagement_buffer.flush()
+        results[ep.name] = Result(queries, round(statistics.median(timings), 2), round(percentile(timings, 0.95), 2))
+    return results
+
+
+def check_budgets(results, budgets, latency=True):
+    #the list of budget violations (an empty list means the run passes)
+    failures = []
+    for name, result in results.items():
+        budget = budgets.get(name)
+        if budget is None:
+            failures.append(f'{name}: no budget, run with --write-budgets to record one')
+            continue
+        if result.queries > budget['queries']:
+            failures.append(f"{name}: {result.queries} queries, budget {budget['queries']}")
+        if latency and result.p95 > budget['p95_ms']:
+            failures.append(f"{name}: p95 {result.p95}ms, budget {budget['p95_ms']}ms")
+    return failures
+
+
+def make_budgets(results, latency_headroom=5.0, min_latency=100):
+    #query budgets are exact, latency budgets leave room for slower machines
+    return {
+        name: {'queries': result.queries, 'p95_ms': max(min_latency, math.ceil(result.p95 * latency_headroom))}
+        for name, result in sorted(results.items())
+    }
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    #the cached responses are invalidated by bumping versions in the cache (see response_cache.py):
+    #with a per-process cache the other workers never see the bump and serve stale responses
+    backend = settings.CACHES['default']['BACKEND']
+    if backend.endswith('LocMemCache'):
+        return [Warning(
+            'the default cache is local to each process',
+            hint='set REDIS_CACHE_URL when running several workers, cached responses and tag labels are invalidated through it',
+            id='posts.W001',
+        )]
+    return []
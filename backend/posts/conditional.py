@@ -0,0 +1,101 @@
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+from .models import Post
+
+
+def make_etag(*parts):
+    #weak: the view count shown with a post may lag behind (it is not part of the validators)
+    digest = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:32]
+    return f'W/"{digest}"'
+
+
+def post_validators(post_id, viewer):
+    """
+    (etag, last_modified) of a post from one indexed lookup, None if the post does not exist
+    """
+    return post_etag(post_id, viewer, post_updated_at(post_id).first())
+
+
+async def apost_validators(post_id, viewer):
+    return post_etag(post_id, viewer, await post_updated_at(post_id).afirst())
+
+
+def post_updated_at(post_id):
+    return Post.objects.filter(id=post_id).values_list('updated_at', flat=True)
+
+
+def post_etag(post_id, viewer, updated_at):
+    if updated_at is None:
+        return None
+    #is_liked / is_saved differ between users
+    return make_etag('post', post_id, updated_at.isoformat(), viewer.id), updated_at
+
+
+def thread_validators(post_id, viewer):
+    """
+    (etag, last_modified) of the comments of a post from a single aggregate query:
+    the latest comment change plus the number of comments (a deleted comment changes nothing else)
+    """
+    return thread_etag(post_id, viewer, thread_changes(post_id).first())
+
+
+async def athread_validators(post_id, viewer):
+    return thread_etag(post_id, viewer, await thread_changes(post_id).afirst())
+
+
+def thread_changes(post_id):
+    return (
+        Post.objects.filter(id=post_id)
+        .values('created_at')
+        .annotate(last=Max('comments__updated_at'), total=Count('comments'))
+        .order_by('created_at')
+    )
+
+
+def thread_etag(post_id, viewer, row):
+    if row is None:
+        return None
+    last_modified = row['last'] or row['created_at']
+    return make_etag('thread', post_id, last_modified.isoformat(), row['total'], viewer.id), last_modified
+
+
+def not_modified(request, validators):
+    #the 304 answering the request's If-None-Match / If-Modified-Since, None when it has to be answered
+    etag, last_modified = validators
+    return get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+
+
+def add_validators(response, validators):
+    if response.status_code in (200, 304):
+        etag, last_modified = validators
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(int(last_modified.timestamp()))
+    #the validators depend on the viewer
+    patch_vary_headers(response, ['Authorization'])
+    return response
+
+
+class ConditionalGetMixin:
+    """
+    Answer If-None-Match / If-Modified-Since GETs with a 304 before anything is serialized
+
+    `get_validators()` returns (etag, last_modified) computed from the database without
+    loading the objects, or None to let the view answer normally (404...). Put the mixin
+    before AnonymousResponseCacheMixin so revalidations do not even reach the cache.
+    """
+
+    def get_validators(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        validators = self.get_validators()
+        if validators is None:
+            return super().get(request, *args, **kwargs)
+        response = not_modified(request, validators)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        return add_validators(response, validators)
@@ -0,0 +1,90 @@
+from collections import Counter
+
+from django.db import connections, router
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest, Now
+from django.db.models.sql import UpdateQuery
+
+from .models import Comment, Like, Post, PostView
+
+#stored counter -> (table holding the rows it counts, foreign key to the counted object)
+POST_COUNTERS = {
+    'likes_count': (Like, 'post'),
+    'comments_count': (Comment, 'post'),
+    'views_count': (PostView, 'post'),
+}
+COMMENT_COUNTERS = {
+    'likes_count': (Comment.likes.through, 'comment'),
+}
+
+
+def bump(model, pk, touch=True, **deltas):
+    """
+    atomically add to stored counters, e.g. bump(Post, 1, likes_count=1)
+    counters never go below 0 even if they have drifted
+    with touch the row's updated_at is moved in the same UPDATE (the counter is part of what clients revalidate)
+    returns the new values, {"likes_count": 5}, read by the UPDATE itself (RETURNING), or None without a row
+    """
+    updates = {name: Greatest(F(name) + delta, Value(0)) for name, delta in deltas.items()}
+    if touch:
+        updates['updated_at'] = Now()
+    using = router.db_for_write(model)
+    connection = connections[using]
+    if not connection.features.can_return_columns_from_insert:
+        #no RETURNING (sqlite < 3.35): the values are read back
+        if not model.objects.filter(pk=pk).update(**updates):
+            return None
+        return model.objects.using(using).filter(pk=pk).values(*deltas).first()
+    query = model.objects.filter(pk=pk).query.chain(UpdateQuery)
+    query.add_update_values(updates)
+    sql, params = query.get_compiler(using).as_sql()
+    columns = ', '.join(connection.ops.quote_name(model._meta.get_field(name).column) for name in deltas)
+    with connection.cursor() as cursor:
+        cursor.execute(f'{sql} RETURNING {columns}', params)
+        row = cursor.fetchone()
+    return dict(zip(deltas, row)) if row else None
+
+
+def add_views(post_ids):
+    #views do not touch updated_at, otherwise every read would invalidate the post's ETag
+    for post_id, views in Counter(post_ids).items():
+        bump(Post, post_id, touch=False, views_count=views)
+
+
+def related_count(model, field):
+    #correlated COUNT(*) of the rows pointing at the outer object
+    rows = model.objects.filter(**{field: OuterRef('pk')}).order_by().values(field)
+    return Coalesce(
+        Subquery(rows.annotate(total=Count('*')).values('total'), output_field=IntegerField()),
+        Value(0),
+    )
+
+
+def reconcile(model, counters, batch_size=500):
+    """
+    recount the stored counters of `model` batch by batch and fix the rows that drifted
+    (rows deleted by cascades, m2m rows removed outside the views...), returns the number of fixed rows
+    """
+    fixed = 0
+    last_id = 0
+    while True:
+        ids = list(model.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return fixed
+        last_id = ids[-1]
+
+        drift = Q()
+        for name in counters:
+            drift |= ~Q(**{name: F(f'actual_{name}')})
+        drifted = list(
+            model.objects.filter(id__in=ids)
+            .annotate(**{f'actual_{name}': related_count(*source) for name, source in counters.items()})
+            .filter(drift)
+            .values_list('id', flat=True)
+        )
+        if drifted:
+            #recounted inside the UPDATE itself so increments made meanwhile are not lost
+            model.objects.filter(id__in=drifted).update(**{
+                name: related_count(*source) for name, source in counters.items()
+            })
+            fixed += len(drifted)
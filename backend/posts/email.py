@@ -1,16 +1,140 @@
 import smtplib
+import uuid
+from datetime import timedelta
 from dotenv import load_dotenv
 import os
+from django.db.models import Q
+from django.utils import timezone
+from .models import OutboxMail
 load_dotenv()
 sender_email = os.getenv('EMAIL_SENDER')
 password = os.getenv('EMAIL_PASSWORD')
+smtp_host = os.getenv('EMAIL_HOST', 'smtp.gmail.com')
+smtp_port = int(os.getenv('EMAIL_PORT', 587))
+smtp_use_tls = os.getenv('EMAIL_USE_TLS', 'true').lower() == 'true'
 
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+CLAIM_LEASE = timedelta(minutes=5)   #a crashed worker's rows can be picked up again after this
+SENT_RETENTION = timedelta(days=7)   #sent mails are kept this long (debugging a delivery), then pruned
 
-def send_mail(receiver_email, subject, body):
-    sender_email = sender_email
-    text = f'Subject: {subject}\n\n{body}'
-    password = password
-    server = smtplib.SMTP("smtp.gmail.com",587)
-    server.starttls()
-    server.login(sender_email,password)
-    server.sendmail(sender_email,receiver_email,text)
+
+def queue_mail(receiver_email, subject, body):
+    """
+    add a notification to the outbox, called inside the request transaction so the mail
+    only exists if the like / comment that triggered it was committed; delivery happens
+    in the deliver_outbox worker, never on the request thread
+    """
+    return OutboxMail.objects.create(receiver=receiver_email, subject=subject, body=body)
+
+
+class Mailer:
+    """
+    one SMTP connection (STARTTLS + login done once) reused for every mail of a batch
+    """
+    def __init__(self, host=None, port=None, use_tls=None, credentials=None):
+        self.host = host or smtp_host
+        self.port = port or smtp_port
+        self.use_tls = smtp_use_tls if use_tls is None else use_tls
+        #(sender, password), no login when the password is empty (local relay)
+        self.sender, self.password = credentials if credentials is not None else (sender_email, password)
+        self.server = None
+
+    def __enter__(self):
+        self.server = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.use_tls:
+            self.server.starttls()
+        if self.password:
+            self.server.login(self.sender, self.password)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.server.quit()
+        except smtplib.SMTPException:
+            self.server.close()
+        return False
+
+    def send(self, receiver_email, subject, body):
+        text = f'Subject: {subject}\n\n{body}'
+        self.server.sendmail(self.sender, receiver_email, text.encode('utf-8'))
+
+
+def claim_batch(batch_size=BATCH_SIZE):
+    #mark a batch of due mails as ours so concurrent workers never send the same mail twice
+    now = timezone.now()
+    claim = uuid.uuid4().hex
+    due = OutboxMail.objects.filter(
+        Q(claimed_until__isnull=True) | Q(claimed_until__lt=now),
+        status='PENDING',
+        next_attempt_at__lte=now,
+    )
+    ids = list(due.order_by('next_attempt_at').values_list('id', flat=True)[:batch_size])
+    due.filter(id__in=ids).update(claim=claim, claimed_until=now + CLAIM_LEASE)
+    return list(OutboxMail.objects.filter(claim=claim, status='PENDING'))
+
+
+def deliver_outbox(batch_size=BATCH_SIZE, mailer=None):
+    """
+    send one batch of pending mails over a single SMTP connection
+    returns (sent, failed)
+    """
+    mails = claim_batch(batch_size)
+    if not mails:
+        return 0, 0
+    sent = failed = 0
+    remaining = list(mails)
+    try:
+        with (mailer or Mailer()) as connection:
+            while remaining:
+                mail = remaining[0]
+                try:
+                    connection.send(mail.receiver, mail.subject, mail.body)
+                except smtplib.SMTPServerDisconnected:
+                    raise
+                except (smtplib.SMTPException, OSError) as e:
+                    #rejected by the server (bad address...), only this mail is retried
+                    mark_failed(mail, e)
+                    failed += 1
+                else:
+                    mark_sent(mail)
+                    sent += 1
+                remaining.pop(0)
+    except (smtplib.SMTPException, OSError) as e:
+        #could not connect / log in, or the connection dropped: retry the rest of the batch later
+        for mail in remaining:
+            mark_failed(mail, e)
+            failed += 1
+    return sent, failed
+
+
+def mark_sent(mail):
+    mail.status = 'SENT'
+    mail.sent_at = timezone.now()
+    mail.claimed_until = None
+    mail.save(update_fields=['status', 'sent_at', 'claimed_until'])
+
+
+def mark_failed(mail, error):
+    mail.attempts += 1
+    mail.last_error = str(error)[:1000]
+    mail.claimed_until = None
+    if mail.attempts >= MAX_ATTEMPTS:
+        mail.status = 'DEAD'
+    else:
+        mail.next_attempt_at = timezone.now() + timedelta(minutes=2 ** mail.attempts)
+    mail.save(update_fields=['attempts', 'last_error', 'claimed_until', 'status', 'next_attempt_at'])
+
+
+def prune_outbox(now=None, batch_size=1000):
+    """
+    delete the mails sent more than SENT_RETENTION ago, batch by batch so the table lock is short,
+    returns the number of deleted rows (DEAD mails are kept for inspection)
+    """
+    cutoff = (now or timezone.now()) - SENT_RETENTION
+    deleted = 0
+    while True:
+        ids = list(OutboxMail.objects.filter(status='SENT', sent_at__lt=cutoff).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += OutboxMail.objects.filter(id__in=ids).delete()[0]
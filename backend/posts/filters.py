@@ -1,6 +1,6 @@
 import django_filters
-from django.db.models import Q
 from .models import Post, Tag
+from .search import search_posts
 
 class PostFilter(django_filters.FilterSet):
     # Search filter
@@ -18,16 +18,10 @@ class PostFilter(django_filters.FilterSet):
     )
 
     def search_filter(self, queryset, name, value):
+        #title, content, summary, author names and tags are looked up in the inverted index (see search.py)
+        #every word of the query has to match (as a prefix), posts are annotated with their `search_rank`
         if value:
-            return queryset.filter(
-                Q(title__icontains=value) |
-                Q(content__icontains=value) |
-                Q(summary__icontains=value) |
-                Q(owner__username__icontains=value) |
-                Q(owner__first_name__icontains=value) |
-                Q(owner__last_name__icontains=value) |
-                Q(tags__name__icontains=value)
-            ).distinct()
+            return search_posts(queryset, value)
         return queryset
 
     class Meta:
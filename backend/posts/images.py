@@ -0,0 +1,110 @@
+import logging
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+#name -> longest side in pixels
+VARIANT_SIZES = {
+    'thumb': 320,
+    'card': 800,
+    'full': 1600,
+}
+#format -> (Pillow format, extension, save options)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def generate_variants(field_file):
+    """
+    resize an uploaded image to every VARIANT_SIZES entry in every VARIANT_FORMATS format
+    and store them next to the original, returns {"thumb": {"webp": path, "jpeg": path}, ...}
+
+    The image is re-encoded from its pixels only, EXIF/GPS and other metadata are not copied
+    (the EXIF orientation is applied first so the variants are not rotated).
+    """
+    field_file.open('rb')
+    try:
+        with Image.open(field_file) as original:
+            original = ImageOps.exif_transpose(original)
+            original.load()
+    finally:
+        field_file.close()
+
+    directory, filename = os.path.split(field_file.name)
+    stem = os.path.splitext(filename)[0]
+    variants = {}
+    for name, size in VARIANT_SIZES.items():
+        image = original.copy()
+        image.thumbnail((size, size), Image.LANCZOS)
+        variants[name] = {}
+        for fmt, (pil_format, extension, options) in VARIANT_FORMATS.items():
+            #jpeg has no alpha channel
+            converted = image.convert('RGB') if pil_format == 'JPEG' or image.mode not in ('RGB', 'RGBA') else image
+            buffer = BytesIO()
+            converted.save(buffer, pil_format, **options)
+            path = default_storage.save(
+                os.path.join(directory, 'variants', f'{stem}_{name}.{extension}'),
+                ContentFile(buffer.getvalue()),
+            )
+            variants[name][fmt] = path
+    return variants
+
+
+def build_variants(instance, image_field, variants_field):
+    """
+    (re)generate the variants of instance.<image_field> into instance.<variants_field>
+    returns False when the image was replaced meanwhile: the variants are dropped, the newer upload builds its own
+    """
+    image = getattr(instance, image_field)
+    variants = {}
+    if image:
+        try:
+            variants = generate_variants(image)
+        except (OSError, Image.DecompressionBombError):
+            #not an image Pillow can read: the original is still served as is
+            logger.warning('could not build the variants of %s', image.name, exc_info=True)
+    fields = [variants_field]
+    if hasattr(instance, 'updated_at'):
+        fields.append('updated_at')
+    with transaction.atomic():
+        rows = type(instance).objects.select_for_update().filter(pk=instance.pk)
+        if (rows.values_list(image_field, flat=True).first() or '') != (image.name or ''):
+            delete_variants(variants)
+            return False
+        setattr(instance, variants_field, variants)
+        instance.save(update_fields=fields)
+    return True
+
+
+def delete_variants(variants):
+    for formats in (variants or {}).values():
+        for path in formats.values():
+            default_storage.delete(path)
+
+
+def variant_urls(variants, request=None):
+    urls = {}
+    for name, formats in (variants or {}).items():
+        urls[name] = {}
+        for fmt, path in formats.items():
+            url = default_storage.url(path)
+            urls[name][fmt] = request.build_absolute_uri(url) if request else url
+    return urls
+
+
+def pick_variant(variants, name, accept=''):
+    #webp when the client accepts it, jpeg otherwise
+    formats = (variants or {}).get(name)
+    if not formats:
+        return None
+    if 'image/webp' in accept and 'webp' in formats:
+        return formats['webp'], 'image/webp'
+    return formats['jpeg'], 'image/jpeg'
@@ -0,0 +1,209 @@
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, close_old_connections, transaction
+
+from .counters import add_views
+from .metrics import BUFFERS
+from .models import Post, PostView
+from .personalization import for_you
+from .trending import trending_scores
+from .writer import write_queue
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MAX_SIZE': 10000,        #events held in memory before new ones are dropped (backpressure)
+    'FLUSH_SIZE': 500,        #flush as soon as this many events are waiting
+    'FLUSH_INTERVAL': 2.0,    #seconds, flush whatever is waiting at least this often
+    'BACKGROUND': True,       #False: no flusher thread, flushes happen inline once FLUSH_SIZE is reached
+}
+
+
+class ViewBuffer:
+    """
+    Bounded in-process buffer of PostView rows written with bulk_create
+
+    Requests only append to a list under a lock; a daemon thread flushes the buffer when it
+    reaches `flush_size` or every `flush_interval` seconds, so analytics writes are batched
+    and taken off the request thread. When the buffer is full new events are dropped and
+    counted instead of slowing the request down (stats(), served by /metrics and logged by
+    the next flush).
+    """
+    thread_name = 'post-view-flusher'
+
+    def __init__(self, max_size, flush_size, flush_interval, background=True):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.background = background
+        self.accepted = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self._reported_dropped = 0
+        self._events = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._pid = None
+
+    def add(self, view):
+        with self._lock:
+            if len(self._events) >= self.max_size:
+                self.dropped += 1
+                return False
+            self._events.append(view)
+            self.accepted += 1
+            full = len(self._events) >= self.flush_size
+        if self.background:
+            self._ensure_worker()
+            if full:
+                self._wakeup.set()
+        elif full:
+            self.flush()
+        return True
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+                dropped, self._reported_dropped = self.dropped - self._reported_dropped, self.dropped
+            if dropped:
+                logger.warning('%s: dropped %s events since the last flush, the buffer was full', self.thread_name, dropped)
+            if not events:
+                return 0
+            try:
+                written = self._write(events)
+            except Exception:
+                logger.exception('could not flush %s post views', len(events))
+                written = 0
+            self.failed += len(events) - written
+            self.flushed += written
+            return written
+
+    def _write(self, events):
+        try:
+            self._insert(events)
+        except IntegrityError:
+            #a post was deleted while its views were waiting: drop those views and retry once
+            existing = set(Post.objects.filter(id__in={view.post_id for view in events}).values_list('id', flat=True))
+            events = [view for view in events if view.post_id in existing]
+            self._insert(events)
+        return len(events)
+
+    def _insert(self, events):
+        #the batch goes through the process' single writer, between the likes (see writer.py)
+        write_queue.run(self._insert_now, events)
+
+    def _insert_now(self, events):
+        with transaction.atomic():
+            PostView.objects.bulk_create(events, batch_size=self.flush_size)
+            add_views(view.post_id for view in events)
+            trending_scores.add((view.post_id, 'views', view.timestamp) for view in events)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._events)
+        return {
+            'pending': pending,
+            'accepted': self.accepted,
+            'dropped': self.dropped,
+            'flushed': self.flushed,
+            'failed': self.failed,
+        }
+
+    def _ensure_worker(self):
+        #started lazily and once per process (workers forked by gunicorn do not inherit threads)
+        if self._worker is not None and self._pid == os.getpid() and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is not None and self._pid == os.getpid() and self._worker.is_alive():
+                return
+            self._pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            self.flush()
+            close_old_connections()
+
+
+#a like, save or comment (sign=1) or its removal (sign=-1), see EngagementBuffer
+Engagement = namedtuple('Engagement', 'kind sign user_id post_id timestamp')
+
+
+class EngagementBuffer(ViewBuffer):
+    """
+    Likes, saves and comments (made or taken back) waiting to move the trending scores and
+    the readers' tag affinities (see trending.py and personalization.py)
+
+    The receivers append an Engagement once the change is committed and the flusher applies
+    a whole batch at once, so a like or a comment only writes its own rows in the request.
+    Scores and affinities lost with a process are recovered by their rebuild commands.
+    """
+    thread_name = 'engagement-flusher'
+
+    def _write(self, events):
+        try:
+            write_queue.run(self._apply, events)
+        except IntegrityError:
+            #a post or a reader was deleted while their events were waiting: drop those and retry once
+            posts = set(Post.objects.filter(id__in={event.post_id for event in events}).values_list('id', flat=True))
+            users = set(User.objects.filter(id__in={event.user_id for event in events}).values_list('id', flat=True))
+            events = [event for event in events if event.post_id in posts and event.user_id in users]
+            write_queue.run(self._apply, events)
+        return len(events)
+
+    def _apply(self, events):
+        scores = defaultdict(list)
+        engagements = defaultdict(list)
+        for event in events:
+            if event.kind in trending_scores.weights:
+                scores[event.sign].append((event.post_id, event.kind, event.timestamp))
+            engagements[(event.user_id, event.kind, event.sign)].append(event.post_id)
+        with transaction.atomic():
+            for sign, scored in scores.items():
+                trending_scores.add(scored, sign=sign)
+            for (user_id, kind, sign), post_ids in engagements.items():
+                for_you.engage(user_id, post_ids, kind, sign)
+
+
+def _build_buffer(buffer_class=ViewBuffer, setting='VIEW_BUFFER'):
+    options = {**DEFAULTS, **getattr(settings, setting, {})}
+    return buffer_class(
+        max_size=options['MAX_SIZE'],
+        flush_size=options['FLUSH_SIZE'],
+        flush_interval=options['FLUSH_INTERVAL'],
+        background=options['BACKGROUND'],
+    )
+
+
+view_buffer = _build_buffer()
+atexit.register(view_buffer.flush)
+
+engagement_buffer = _build_buffer(EngagementBuffer, 'ENGAGEMENT_BUFFER')
+atexit.register(engagement_buffer.flush)
+
+#their counters are served by /metrics
+BUFFERS.update(views=view_buffer, engagements=engagement_buffer)
+
+
+def record_view(**fields):
+    return view_buffer.add(PostView(**fields))
+
+
+def record_engagement(kind, sign, user_id, post_id, timestamp):
+    #buffered once the current transaction commits (right away outside of one)
+    event = Engagement(kind, sign, user_id, post_id, timestamp)
+    transaction.on_commit(lambda: engagement_buffer.add(event))
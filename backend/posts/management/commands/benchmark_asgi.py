@@ -0,0 +1,217 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import perf_counter
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from ai.signals import generate_summary
+from posts import benchmark
+from posts.ingestion import view_buffer
+from posts.models import Post, Tag
+
+HOST = 'testserver'
+
+
+def call_wsgi(app, path, query, token):
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': HOST,
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'HTTP_HOST': HOST,
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    if token:
+        environ['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    statuses = []
+    result = app(environ, lambda status, headers, exc_info=None: statuses.append(status))
+    try:
+        body = b''.join(result)
+    finally:
+        result.close()   #request_finished: the connection is closed as after a real request
+    return int(statuses[0].split()[0]), body
+
+
+async def call_asgi(app, path, query, token):
+    headers = [(b'host', HOST.encode())]
+    if token:
+        headers.append((b'authorization', f'Bearer {token}'.encode()))
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': headers,
+        'client': ('127.0.0.1', 50000),
+        'server': (HOST, 80),
+    }
+    messages = []
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        #the client never goes away, the handler cancels this wait once it has answered
+        await asyncio.Future()
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    status = next(message['status'] for message in messages if message['type'] == 'http.response.start')
+    body = b''.join(message.get('body', b'') for message in messages if message['type'] == 'http.response.body')
+    return status, body
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test the hot read endpoints (feed, post detail, comments, current user) through the '
+        'WSGI handler (sync DRF views, one thread per request) and the ASGI handler (async views on '
+        'one event loop) at the same concurrency, after checking both answer the same'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=32, help='requests in flight (threads for WSGI, tasks for ASGI)')
+        parser.add_argument('--seconds', type=float, default=10.0, help='duration of each run')
+        parser.add_argument('--anonymous', action='store_true', help='no JWT: the anonymous response cache answers most reads')
+        for name in ('users', 'posts'):
+            default = benchmark.DEFAULT_SIZES[name]
+            parser.add_argument(f'--{name}', type=int, default=default, help=f'dataset size (default {default})')
+
+    def handle(self, *args, **options):
+        workdir = tempfile.mkdtemp()
+        background = view_buffer.background
+        setup_test_environment()
+        #a file, not the in-memory test database: the requests run on several threads
+        connection.settings_dict['TEST']['NAME'] = os.path.join(workdir, 'loadtest.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        #the summary task is a celery round trip, it is not part of any request
+        post_save.disconnect(generate_summary, sender=Post)
+        try:
+            view_buffer.background = False
+            with override_settings(
+                MEDIA_ROOT=workdir,
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'loadtest'}},
+            ):
+                sizes = {**benchmark.DEFAULT_SIZES, 'users': options['users'], 'posts': options['posts']}
+                self.stdout.write(f'seeding {sizes}')
+                people = benchmark.seed(**sizes)
+                token = None if options['anonymous'] else str(RefreshToken.for_user(people[0]).access_token)
+                routes = self.routes()
+
+                from ink_smart.asgi import application as asgi_app
+                wsgi_app = WSGIHandler()
+                self.check_same_answers(wsgi_app, asgi_app, routes, token)
+
+                rows = []
+                for name, run in (('wsgi', self.run_wsgi), ('asgi', self.run_asgi)):
+                    self.stdout.write(f"{name}: {options['concurrency']} concurrent requests for {options['seconds']}s")
+                    rows.append((name, run(wsgi_app if name == 'wsgi' else asgi_app, routes, token, options)))
+        finally:
+            post_save.connect(generate_summary, sender=Post)
+            view_buffer.flush()
+            view_buffer.background = background
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(workdir, ignore_errors=True)
+        self.report(rows, options['seconds'])
+
+    def routes(self):
+        post = Post.objects.filter(status='PUBLISHED', comments__isnull=False).order_by('id').first()
+        tag = Tag.objects.order_by('id').first()
+        return [
+            ('/posts/', ''),
+            ('/posts/', f'tags={tag.name}'),
+            (f'/posts/{post.id}/', ''),
+            (f'/posts/{post.id}/comments/', ''),
+            ('/users/current/', ''),
+        ]
+
+    def check_same_answers(self, wsgi_app, asgi_app, routes, token):
+        for path, query in routes:
+            expected = call_wsgi(wsgi_app, path, query, token)
+            got = asyncio.run(call_asgi(asgi_app, path, query, token))
+            if expected[0] != 200 or got[0] != expected[0] or json.loads(got[1]) != json.loads(expected[1]):
+                raise CommandError(f'{path}?{query}: wsgi answered {expected[0]} {expected[1][:200]!r}, asgi {got[0]} {got[1][:200]!r}')
+
+    def run_wsgi(self, app, routes, token, options):
+        deadline = time.monotonic() + options['seconds']
+
+        def client(n):
+            latencies, errors = [], 0
+            while time.monotonic() < deadline:
+                path, query = routes[(n + len(latencies) + errors) % len(routes)]
+                start = perf_counter()
+                status, _ = call_wsgi(app, path, query, token)
+                if status == 200:
+                    latencies.append(perf_counter() - start)
+                else:
+                    errors += 1
+            return latencies, errors
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            return self.merge(pool.map(client, range(options['concurrency'])))
+
+    def run_asgi(self, app, routes, token, options):
+        async def client(n, deadline):
+            latencies, errors = [], 0
+            while time.monotonic() < deadline:
+                path, query = routes[(n + len(latencies) + errors) % len(routes)]
+                start = perf_counter()
+                status, _ = await call_asgi(app, path, query, token)
+                if status == 200:
+                    latencies.append(perf_counter() - start)
+                else:
+                    errors += 1
+            return latencies, errors
+
+        async def main():
+            deadline = time.monotonic() + options['seconds']
+            return await asyncio.gather(*(client(n, deadline) for n in range(options['concurrency'])))
+
+        return self.merge(asyncio.run(main()))
+
+    def merge(self, parts):
+        latencies, errors = [], 0
+        for part_latencies, part_errors in parts:
+            latencies.extend(part_latencies)
+            errors += part_errors
+        return latencies, errors
+
+    def report(self, rows, seconds):
+        self.stdout.write(f"{'interface':<10}{'requests/s':>12}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}")
+        for name, (latencies, errors) in rows:
+            latencies = latencies or [0]
+            self.stdout.write(
+                f'{name:<10}{len(latencies) / seconds:>12.1f}{errors:>8}'
+                f'{benchmark.percentile(latencies, 0.5) * 1000:>9.1f}{benchmark.percentile(latencies, 0.95) * 1000:>9.1f}'
+                f'{max(latencies) * 1000:>9.1f}'
+            )
@@ -0,0 +1,102 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+import ai.utils
+from ai.signals import generate_summary
+from posts import benchmark
+from posts.ingestion import engagement_buffer, view_buffer
+from posts.models import Post
+
+BUDGETS_PATH = os.path.join(os.path.dirname(benchmark.__file__), 'benchmark_budgets.json')
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a throwaway test database, call every API route and report the query count and '
+        'p50/p95 latency of each one; fails when a route goes over its committed budget'
+    )
+
+    def add_arguments(self, parser):
+        for name, default in benchmark.DEFAULT_SIZES.items():
+            parser.add_argument(f'--{name}', type=int, default=default, help=f'dataset size (default {default})')
+        parser.add_argument('--iterations', type=int, default=20, help='requests per route')
+        parser.add_argument('--only', default='', help='only the routes whose name contains this text')
+        parser.add_argument('--budgets', default=BUDGETS_PATH, help='budget file')
+        parser.add_argument('--skip-latency', action='store_true', help='only enforce the query budgets (slow or shared machines)')
+        parser.add_argument('--write-budgets', action='store_true', help='record this run as the new budgets instead of checking them')
+
+    def handle(self, *args, **options):
+        endpoints = [ep for ep in benchmark.ENDPOINTS if options['only'] in ep.name]
+        if not endpoints:
+            raise CommandError(f"no route matches {options['only']!r}")
+        sizes = {name: options[name] for name in benchmark.DEFAULT_SIZES}
+
+        results = self.run(endpoints, sizes, options['iterations'])
+        self.report(results)
+
+        if options['write_budgets']:
+            budgets = self.load_budgets(options['budgets']) if os.path.exists(options['budgets']) else {}
+            budgets.update(benchmark.make_budgets(results))
+            with open(options['budgets'], 'w') as f:
+                json.dump(dict(sorted(budgets.items())), f, indent=2)
+                f.write('\n')
+            self.stdout.write(self.style.SUCCESS(f"budgets written to {options['budgets']}"))
+            return
+
+        failures = benchmark.check_budgets(results, self.load_budgets(options['budgets']), latency=not options['skip_latency'])
+        if failures:
+            raise CommandError('over budget:\n' + '\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS(f'{len(results)} routes within budget'))
+
+    def run(self, endpoints, sizes, iterations):
+        media_root = tempfile.mkdtemp()
+        stub, stub_url = benchmark.start_stub_upstream()
+        hf_base_url = ai.utils.HF_BASE_URL
+        background = view_buffer.background, engagement_buffer.background
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        #the summary task is a celery round trip, it is not part of any request
+        post_save.disconnect(generate_summary, sender=Post)
+        try:
+            ai.utils.HF_BASE_URL = stub_url
+            view_buffer.background = engagement_buffer.background = False
+            with override_settings(
+                MEDIA_ROOT=media_root,
+                IMAGE_VARIANTS_IN_WORKER=False,   #no celery worker here: the inline fallback
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'}},
+            ):
+                self.stdout.write(f'seeding {sizes}')
+                people = benchmark.seed(**sizes)
+                ctx = benchmark.build_context(people)
+                self.stdout.write(f'{len(endpoints)} routes x {iterations} requests')
+                return benchmark.measure(ctx, endpoints, iterations)
+        except benchmark.BenchmarkError as e:
+            raise CommandError(str(e))
+        finally:
+            post_save.connect(generate_summary, sender=Post)
+            view_buffer.background, engagement_buffer.background = background
+            ai.utils.HF_BASE_URL = hf_base_url
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            stub.shutdown()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+    def report(self, results):
+        width = max(len(name) for name in results)
+        self.stdout.write(f"{'route'.ljust(width)}  queries  p50 ms  p95 ms")
+        for name, result in results.items():
+            self.stdout.write(f'{name.ljust(width)}  {result.queries:>7}  {result.p50:>6}  {result.p95:>6}')
+
+    def load_budgets(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'could not read the budgets: {e}')
@@ -0,0 +1,182 @@
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models.signals import post_save
+from django.test.utils import override_settings
+
+from ai.signals import generate_summary
+from posts import benchmark
+from posts.counters import add_views
+from posts.models import Post, PostView
+from posts.views_likes import toggle_post_like
+from posts.writer import write_queue
+
+#(name, DATABASES OPTIONS, likes and views go through the write queue)
+MODES = [
+    ('default', {}, False),
+    ('production', settings.SQLITE_PRODUCTION_OPTIONS, True),
+]
+
+
+def write_view(post_id, user_id):
+    #what a flush of a single buffered view writes (see ingestion.py)
+    with transaction.atomic():
+        PostView.objects.create(post_id=post_id, viewer_id=user_id)
+        add_views([post_id])
+
+
+def read_feed():
+    return list(Post.objects.filter(status='PUBLISHED').for_feed().order_by('-created_at', '-id')[:20])
+
+
+def client(deadline, posts, user_ids, read_ratio, seed, totals, lock):
+    #one request thread: likes, views and feed reads until the deadline
+    rng = random.Random(seed)
+    counts = {'writes': 0, 'reads': 0, 'lock_errors': 0, 'errors': 0}
+    latencies = []
+    try:
+        while time.monotonic() < deadline:
+            reading = rng.random() < read_ratio
+            post = rng.choice(posts)
+            start = perf_counter()
+            try:
+                if reading:
+                    read_feed()
+                elif rng.random() < 0.5:
+                    write_queue.run(toggle_post_like, post, rng.choice(user_ids))
+                else:
+                    write_queue.run(write_view, post.id, rng.choice(user_ids))
+            except OperationalError as e:
+                message = str(e)
+                counts['lock_errors' if 'locked' in message or 'busy' in message else 'errors'] += 1
+                continue
+            except Exception:
+                counts['errors'] += 1
+                continue
+            if reading:
+                counts['reads'] += 1
+            else:
+                counts['writes'] += 1
+                latencies.append(perf_counter() - start)
+    finally:
+        connection.close()
+    with lock:
+        for key, value in counts.items():
+            totals[key] += value
+        totals['latencies'].extend(latencies)
+
+
+def worker(queued, deadline, threads, read_ratio, seed, results):
+    #one server process (a gunicorn worker) running `threads` request threads
+    write_queue.enabled = queued
+    posts = list(Post.objects.select_related('owner__profile'))
+    user_ids = list(User.objects.values_list('id', flat=True))
+    connection.close()
+    totals = {'writes': 0, 'reads': 0, 'lock_errors': 0, 'errors': 0, 'latencies': []}
+    lock = threading.Lock()
+    pool = [
+        threading.Thread(target=client, args=(deadline, posts, user_ids, read_ratio, seed * 1000 + n, totals, lock))
+        for n in range(threads)
+    ]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put(totals)
+
+
+class Command(BaseCommand):
+    help = (
+        'Hammer a throwaway SQLite database with concurrent likes, views and feed reads from '
+        'several processes, with the default settings and with SQLITE_PROFILE=production, and '
+        'report the write throughput and the "database is locked" errors of each'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='server processes')
+        parser.add_argument('--threads', type=int, default=8, help='request threads per process')
+        parser.add_argument('--seconds', type=float, default=10.0, help='duration of each run')
+        parser.add_argument('--read-ratio', type=float, default=0.2, help='share of the requests that are feed reads')
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--posts', type=int, default=100)
+
+    def handle(self, *args, **options):
+        database = settings.DATABASES['default']
+        if database['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('this benchmark is about SQLite, DATABASES["default"] uses ' + database['ENGINE'])
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise CommandError('the worker processes are forked, which this platform does not support')
+
+        saved = {'NAME': database['NAME'], 'OPTIONS': database.get('OPTIONS', {})}
+        workdir = tempfile.mkdtemp()
+        #the summary task is a celery round trip, it is not part of any request
+        post_save.disconnect(generate_summary, sender=Post)
+        try:
+            with override_settings(
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'sqlite-benchmark'}},
+            ):
+                base = os.path.join(workdir, 'base.sqlite3')
+                self.use_database(base, {})
+                self.stdout.write('migrating and seeding a throwaway database')
+                call_command('migrate', verbosity=0)
+                benchmark.seed(users=options['users'], posts=options['posts'], tags=10, comments=1, replies=0, likes=0, views=0)
+                connections.close_all()
+
+                rows = []
+                for name, db_options, queued in MODES:
+                    path = os.path.join(workdir, f'{name}.sqlite3')
+                    shutil.copyfile(base, path)
+                    self.use_database(path, db_options)
+                    self.stdout.write(f"{name}: {options['processes']} processes x {options['threads']} threads for {options['seconds']}s")
+                    rows.append((name, self.run_mode(queued, options)))
+        finally:
+            post_save.connect(generate_summary, sender=Post)
+            self.use_database(saved['NAME'], saved['OPTIONS'])
+            shutil.rmtree(workdir, ignore_errors=True)
+        self.report(rows, options['seconds'])
+
+    def use_database(self, name, options):
+        #connections share this dict, new connections open the other file with the other options
+        connections.close_all()
+        settings.DATABASES['default']['NAME'] = name
+        settings.DATABASES['default']['OPTIONS'] = options
+
+    def run_mode(self, queued, options):
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        deadline = time.monotonic() + options['seconds']
+        processes = [
+            context.Process(target=worker, args=(queued, deadline, options['threads'], options['read_ratio'], n + 1, results))
+            for n in range(options['processes'])
+        ]
+        for process in processes:
+            process.start()
+        totals = {'writes': 0, 'reads': 0, 'lock_errors': 0, 'errors': 0, 'latencies': []}
+        for _ in processes:
+            part = results.get()
+            for key, value in part.items():
+                totals[key] += value
+        for process in processes:
+            process.join()
+        return totals
+
+    def report(self, rows, seconds):
+        self.stdout.write(f"{'mode':<12}{'writes/s':>10}{'reads/s':>10}{'lock errors':>13}{'errors':>8}{'p50 ms':>8}{'p95 ms':>8}{'max ms':>8}")
+        for name, totals in rows:
+            latencies = totals['latencies'] or [0]
+            p50, p95, worst = benchmark.percentile(latencies, 0.5), benchmark.percentile(latencies, 0.95), max(latencies)
+            self.stdout.write(
+                f"{name:<12}{totals['writes'] / seconds:>10.0f}{totals['reads'] / seconds:>10.0f}"
+                f"{totals['lock_errors']:>13}{totals['errors']:>8}{p50 * 1000:>8.1f}{p95 * 1000:>8.1f}{worst * 1000:>8.1f}"
+            )
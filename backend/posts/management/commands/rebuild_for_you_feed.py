@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from posts.personalization import for_you
+
+
+class Command(BaseCommand):
+    help = 'Recompute the tag affinities of every reader and the tag -> posts index of the "for you" feed (backfill after migrating)'
+
+    def handle(self, *args, **options):
+        affinities, entries = for_you.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'{affinities} tag affinities and {entries} tag entries have been built'))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from posts.related import related_posts
+
+
+class Command(BaseCommand):
+    help = 'Vectorize every published post and recompute the related posts of each (backfill after migrating)'
+
+    def handle(self, *args, **options):
+        total = related_posts.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'{total} posts have related posts'))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from posts.trending import trending_scores
+
+
+class Command(BaseCommand):
+    help = 'Recompute the trending scores from the recent views, likes and comments (backfill after migrating)'
+
+    def handle(self, *args, **options):
+        total = trending_scores.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'{total} posts are trending'))
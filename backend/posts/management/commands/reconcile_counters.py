@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from posts.counters import COMMENT_COUNTERS, POST_COUNTERS, reconcile
+from posts.models import Comment, Post
+
+
+class Command(BaseCommand):
+    help = 'Recount the stored likes/comments/views counters of posts and comments and fix any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        posts = reconcile(Post, POST_COUNTERS, batch_size=batch_size)
+        comments = reconcile(Comment, COMMENT_COUNTERS, batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f'{posts} posts and {comments} comments have been fixed'))
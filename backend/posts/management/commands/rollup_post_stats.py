@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from posts.rollups import roll_up
+
+
+class Command(BaseCommand):
+    help = 'Add the raw views, likes and comments since the last run to the daily post statistics'
+
+    def handle(self, *args, **options):
+        rows = roll_up()
+        self.stdout.write(self.style.SUCCESS(f'{rows} daily rows have been updated'))
@@ -0,0 +1,183 @@
+"""
+Per-request timings (SQL queries, DB time, serializer time, total time) exposed as a
+Server-Timing header and aggregated into histograms served in the Prometheus text format
+
+Queries are timed with a database execute_wrapper, not with the DEBUG query log, and a
+sample is a few additions under a lock, so the instrumentation stays on in production.
+The histograms live in the process: with several gunicorn workers each one is scraped
+(or reports) its own series.
+"""
+import os
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+#set for the duration of a request by ServerTimingMiddleware
+current_timings = ContextVar('current_timings', default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        #database execute_wrapper: count and time every statement of the request
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += perf_counter() - start
+            self.queries += 1
+
+    def server_timing(self, total):
+        return ', '.join([
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"',
+            f'serializer;dur={self.serializer_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+
+def timed_execute(execute, sql, params, many, context):
+    #installed on every connection: the statement counts for the request it runs for, if any
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    return timings(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_timer(sender, connection, **kwargs):
+    #a wrapper per connection rather than per request: the async views query from
+    #sync_to_async threads, where the request's ContextVar is copied but its connections are not
+    if timed_execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(timed_execute)
+
+
+class TimedSerializerMixin:
+    """
+    add the time spent turning objects into data to the current request's serializer time
+    only the outermost serializer is timed, nested ones are part of it
+    """
+    def to_representation(self, instance):
+        timings = current_timings.get()
+        if timings is None or timings.serializer_depth:
+            return super().to_representation(instance)
+        timings.serializer_depth += 1
+        start = perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            timings.serializer_depth -= 1
+            timings.serializer_time += perf_counter() - start
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}   #labels -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            snapshot = {labels: list(series) for labels, series in self.series.items()}
+        for labels, series in sorted(snapshot.items()):
+            label_text = ','.join(f'{key}="{escape(value)}"' for key, value in labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {series[-1]}')
+            lines.append(f'{self.name}_count{{{label_text}}} {cumulative}')
+        return lines
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_SECONDS = Histogram('inksmart_request_duration_seconds', 'Time spent answering the request', SECONDS_BUCKETS)
+DB_SECONDS = Histogram('inksmart_request_db_seconds', 'Time spent in SQL queries per request', SECONDS_BUCKETS)
+SERIALIZER_SECONDS = Histogram('inksmart_request_serializer_seconds', 'Time spent in serializers per request', SECONDS_BUCKETS)
+QUERIES = Histogram('inksmart_request_queries', 'SQL queries per request', QUERY_BUCKETS)
+HISTOGRAMS = (REQUEST_SECONDS, DB_SECONDS, SERIALIZER_SECONDS, QUERIES)
+
+
+def record(route, method, timings, total):
+    labels = (('route', route), ('method', method))
+    REQUEST_SECONDS.observe(labels, total)
+    DB_SECONDS.observe(labels, timings.db_time)
+    SERIALIZER_SECONDS.observe(labels, timings.serializer_time)
+    QUERIES.observe(labels, timings.queries)
+
+
+#the in-process buffers of posts/ingestion.py, registered there by name
+BUFFERS = {}
+BUFFER_OUTCOMES = ('accepted', 'dropped', 'flushed', 'failed')
+
+
+def render_buffers():
+    stats = {name: buffer.stats() for name, buffer in sorted(BUFFERS.items())}
+    lines = [
+        '# HELP inksmart_buffer_pending Events waiting in the buffer to be written',
+        '# TYPE inksmart_buffer_pending gauge',
+    ]
+    lines.extend(f'inksmart_buffer_pending{{buffer="{name}"}} {values["pending"]}' for name, values in stats.items())
+    lines.extend([
+        '# HELP inksmart_buffer_events_total Events offered to the buffer: accepted or dropped (full), then flushed or failed',
+        '# TYPE inksmart_buffer_events_total counter',
+    ])
+    for name, values in stats.items():
+        lines.extend(f'inksmart_buffer_events_total{{buffer="{name}",outcome="{outcome}"}} {values[outcome]}' for outcome in BUFFER_OUTCOMES)
+    return lines
+
+
+def render_metrics():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    lines.extend(render_buffers())
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """
+    Prometheus metrics
+
+    Goal: Expose the request histograms and the ingestion buffers' counters in the Prometheus text format
+    Path: GET /metrics
+    Authentication: "Authorization: Bearer <METRICS_TOKEN>" when the METRICS_TOKEN env variable is set
+
+    Response:
+    - 200: text/plain; version=0.0.4
+    - 403: wrong or missing token
+    """
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.META.get('HTTP_AUTHORIZATION') != f'Bearer {token}':
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
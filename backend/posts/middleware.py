@@ -1,28 +1,52 @@
 import re
-from .models import Post,PostView
+from time import perf_counter
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from .ingestion import record_view, view_buffer
+from .metrics import RequestTimings, current_timings, record
 
 class BlogMiddleWare:
+    #sync and async: under ASGI the async views are not pushed back to a thread by this middleware
+    sync_capable = True
+    async_capable = True
+
     def __init__(self,get_response):
         self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
         response = self.get_response(request)
+        self.track(request, response)
+        return response  #gg
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if view_buffer.background:
+            #only appends to the in-memory buffer
+            self.track(request, response)
+        else:
+            #the buffer may flush on this call
+            await sync_to_async(self.track)(request, response)
+        return response
+
+    def track(self, request, response):
         path = request.path
-        if response.status_code == 200 and request.method == 'GET' and self.verify_path(path):
+        if response.status_code in (200, 304) and request.method == 'GET' and self.verify_path(path):
             
             post_id = request.resolver_match.kwargs.get("post_id")
             if  post_id:
-                post = Post.objects.filter(id=post_id).first()
-                if post:
-                    PostView.objects.create( 
-                        post=post,
-                        viewer=request.user if request.user.is_authenticated else None,
-                        ip_address=self.get_client_ip(request),
-                        user_agent=request.META.get("HTTP_USER_AGENT", ""),
-                        referrer=request.META.get("HTTP_REFERER", ""),
-                    )
-
-        return response  #gg
+                #the view answered 200 (or 304 to a revalidation) so the post exists, no need to fetch it
+                #the event is buffered and written in batches (see ingestion.py)
+                record_view(
+                    post_id=post_id,
+                    viewer_id=request.user.id if request.user.is_authenticated else None,
+                    ip_address=self.get_client_ip(request),
+                    user_agent=request.META.get("HTTP_USER_AGENT", ""),
+                    referrer=request.META.get("HTTP_REFERER", ""),
+                )
 
 
 
@@ -35,4 +59,49 @@ class BlogMiddleWare:
     def verify_path(self,path:str)->bool:
         idk = re.search(r'/posts/(\d+)/$',path)
         return True if idk else False
-        
\ No newline at end of file
+        
+
+
+class ServerTimingMiddleware:
+    """
+    time every request (SQL queries and time, serializer time, total) per resolved route,
+    send it back in a Server-Timing header and add it to the /metrics histograms
+    put it first in MIDDLEWARE so the total covers the other middlewares
+    the queries are counted by metrics.timed_execute, installed on every connection
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self,get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        total = perf_counter() - timings.started
+        response['Server-Timing'] = timings.server_timing(total)
+        match = request.resolver_match
+        #the route pattern, not the path, keeps the number of series bounded
+        record(match.route if match else 'unresolved', request.method, timings, total)
+        return response
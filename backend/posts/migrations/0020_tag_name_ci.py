@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:40
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+def merge_case_duplicates(apps, schema_editor):
+    #"Django" and "django" become one tag (the oldest) before the unique index is created
+    Tag = apps.get_model('posts', 'Tag')
+    Through = apps.get_model('posts', 'Post').tags.through
+    kept = {}
+    for tag in Tag.objects.order_by('id'):
+        keeper = kept.setdefault(tag.name.lower(), tag)
+        if keeper.id == tag.id:
+            continue
+        tagged = set(Through.objects.filter(tag_id=keeper.id).values_list('post_id', flat=True))
+        Through.objects.filter(tag_id=tag.id).exclude(post_id__in=tagged).update(tag_id=keeper.id)
+        tag.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0019_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_case_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='tag',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('name'), name='unique_tag_name_ci'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-18 14:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0020_tag_name_ci'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['post', 'time_stamp', 'id'], name='posts_like_post_id_69af7f_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-18 14:35
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def drop_duplicate_likes(apps, schema_editor):
+    #double taps could create the same like twice, the oldest one is kept and the counters recounted
+    Like = apps.get_model('posts', 'Like')
+    Post = apps.get_model('posts', 'Post')
+    duplicates = (
+        Like.objects.values('user', 'post')
+        .annotate(total=Count('id'), first=Min('id'))
+        .filter(total__gt=1)
+    )
+    post_ids = set()
+    for row in duplicates:
+        Like.objects.filter(user_id=row['user'], post_id=row['post']).exclude(id=row['first']).delete()
+        post_ids.add(row['post'])
+    for post_id in post_ids:
+        Post.objects.filter(id=post_id).update(likes_count=Like.objects.filter(post_id=post_id).count())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0021_like_post_time_stamp_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_likes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='like',
+            constraint=models.UniqueConstraint(fields=('user', 'post'), name='unique_user_post_like'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.4 on 2026-10-18 14:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0022_unique_like'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'parent_comment', 'created_at', 'id'], name='posts_comme_post_id_91be66_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='posts_post_status_b22d03_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['owner', 'status', 'created_at', 'id'], name='posts_post_owner_i_6b025f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='postview',
+            index=models.Index(fields=['post', 'timestamp'], name='posts_postv_post_id_d390dc_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-18 15:14
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0024_post_scores'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagAffinity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weight', models.FloatField(default=0)),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='affinities', to='posts.tag')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tag_affinities', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-weight'], name='posts_tagaf_user_id_1ff8fc_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'tag'), name='unique_tag_affinity')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TagFeedEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField()),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to='posts.post')),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to='posts.tag')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['tag', '-created_at'], name='posts_tagfe_tag_id_b15b45_idx')],
+                'constraints': [models.UniqueConstraint(fields=('tag', 'post'), name='unique_tag_feed_entry')],
+            },
+        ),
+    ]
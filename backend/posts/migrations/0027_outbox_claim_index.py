@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-18 15:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0026_related_posts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboxmail',
+            name='claim',
+            field=models.CharField(blank=True, db_index=True, max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='outboxmail',
+            index=models.Index(fields=['status', 'sent_at'], name='posts_outbo_status_4fcd3d_idx'),
+        ),
+    ]
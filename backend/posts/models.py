@@ -1,5 +1,8 @@
 from django.db import models
+from django.db.models import Exists, OuterRef, Value
+from django.db.models.functions import Lower
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 # Create your models here.
 class Tag(models.Model):
@@ -7,17 +10,43 @@ class Tag(models.Model):
 
     def __str__(self):
         return self.name
+
+    class Meta:
+        #tag names are unique whatever their case, lets tags.py resolve names with bulk_create(ignore_conflicts=True)
+        constraints = [models.UniqueConstraint(Lower('name'),name='unique_tag_name_ci')]
     
 
 
+class PostQuerySet(models.QuerySet):
+    def for_feed(self, viewer=None):
+        """
+        annotate the viewer flags PostSerializer needs (the counts are stored on the post) and
+        load the owner and tags up front, so a page of posts costs a fixed number of queries
+        """
+        return self.select_related('owner').prefetch_related('tags').with_viewer_state(viewer)
+
+    def with_viewer_state(self, viewer=None):
+        #viewer_liked / viewer_saved as EXISTS subqueries, False for anonymous users
+        if viewer is not None and viewer.is_authenticated:
+            return self.annotate(
+                viewer_liked=Exists(Like.objects.filter(post=OuterRef('pk'), user=viewer)),
+                viewer_saved=Exists(Post.savers.through.objects.filter(post=OuterRef('pk'), user=viewer)),
+            )
+        return self.annotate(viewer_liked=Value(False), viewer_saved=Value(False))
+
+
 class Post(models.Model):
     owner = models.ForeignKey(User,related_name='posts',on_delete=models.CASCADE)
     title = models.CharField(max_length=256)
     content = models.TextField()
     image = models.ImageField(upload_to='post_images',null=True,blank=True)
+    image_variants = models.JSONField(default=dict,blank=True)   #resized copies of image, see images.py
     tags = models.ManyToManyField(Tag,related_name='posts')
     summary = models.TextField(null=True,blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    #last change of anything shown with the post except the view count (edits, tags, likes, saves...)
+    #used as Last-Modified / ETag by the conditional GETs, see conditional.py
+    updated_at = models.DateTimeField(auto_now=True)
     STATUS_CHOICES = [
         ('DRAFT','DRAFT'),
         ('PUBLISHED','PUBLISHED')
@@ -25,14 +54,35 @@ class Post(models.Model):
     savers = models.ManyToManyField(User,related_name='saved_posts',blank=True)
     status = models.CharField(choices=STATUS_CHOICES,null=True,blank=True,default='DRAFT')   #used later for drafts and validation
 
-
-    @property
-    def comments_count(self):
-        return self.comments.count()
-    
-    @property 
-    def likes_count(self):
-        return self.likes.count()
+    #denormalized counters, kept up to date with F() updates (see counters.py)
+    likes_count = models.PositiveIntegerField(default=0)
+    comments_count = models.PositiveIntegerField(default=0)
+    views_count = models.PositiveIntegerField(default=0)
+
+    objects = PostQuerySet.as_manager()
+
+    class Meta:
+        #the keyset-paginated feeds: published posts, a user's published posts and drafts (plans checked in tests.py)
+        indexes = [
+            models.Index(fields=['status','created_at','id']),
+            models.Index(fields=['owner','status','created_at','id']),
+            models.Index(fields=['updated_at']),   #posts changed since the related posts were refreshed (see related.py)
+        ]
+
+
+class CommentQuerySet(models.QuerySet):
+    def for_thread(self, viewer=None):
+        """
+        annotate the viewer flag read by CommentSerializer
+        """
+        qs = self
+        if viewer is not None and viewer.is_authenticated:
+            qs = qs.annotate(viewer_liked=Exists(
+                Comment.likes.through.objects.filter(comment=OuterRef('pk'), user=viewer)
+            ))
+        else:
+            qs = qs.annotate(viewer_liked=Value(False))
+        return qs
 
 
 class Comment(models.Model):
@@ -40,8 +90,16 @@ class Comment(models.Model):
     post = models.ForeignKey(Post,related_name='comments',on_delete=models.CASCADE)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)   #edits and likes
     parent_comment = models.ForeignKey('self',related_name='sub_comments',on_delete=models.CASCADE,null=True,blank=True)
     likes = models.ManyToManyField(User,related_name='liked_comments')
+    likes_count = models.PositiveIntegerField(default=0)
+
+    objects = CommentQuerySet.as_manager()
+
+    class Meta:
+        #top-level comments (parent_comment IS NULL) and replies of a post, newest first
+        indexes = [models.Index(fields=['post','parent_comment','created_at','id'])]
 
 
 
@@ -50,6 +108,12 @@ class Like(models.Model):
     post = models.ForeignKey(Post,related_name='likes',on_delete=models.CASCADE)
     time_stamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        #likers of a post, newest first (see LikeKeysetPagination)
+        indexes = [models.Index(fields=['post','time_stamp','id'])]
+        #one like per user and post, the like toggle relies on it (see toggles.py)
+        constraints = [models.UniqueConstraint(fields=['user','post'],name='unique_user_post_like')]
+
 
 
 class PostView(models.Model):
@@ -60,13 +124,131 @@ class PostView(models.Model):
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.TextField(blank=True)
     referrer = models.TextField(blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)   #set when the view happens, not when the buffer is flushed
 
     def __str__(self):
         return f"View of {self.post.title} at {self.timestamp}"
 
+    class Meta:
+        #the raw tail of a post's statistics, newer than the rollup watermark (see rollups.monthly_stats)
+        indexes = [models.Index(fields=['post','timestamp'])]
+
 
 class CommentLike(models.Model):
     user = models.ForeignKey(User,related_name='comment_likes',on_delete=models.CASCADE)
     comment = models.ForeignKey(Comment,related_name='comment_likes',on_delete=models.CASCADE)
     time_stamp = models.DateTimeField(auto_now_add=True)
+
+
+
+class SearchDocument(models.Model):
+    #one row per indexed post, holds the (weighted) length used by BM25
+    post = models.OneToOneField(Post,related_name='search_document',on_delete=models.CASCADE,primary_key=True)
+    length = models.PositiveIntegerField(default=0)
+
+
+class SearchPosting(models.Model):
+    #inverted index: (term -> post) with the weighted term frequency in that post
+    post = models.ForeignKey(Post,related_name='search_postings',on_delete=models.CASCADE)
+    term = models.CharField(max_length=64)
+    frequency = models.PositiveIntegerField()
+    doc_length = models.PositiveIntegerField()   #copy of SearchDocument.length so ranking needs no join
+
+    class Meta:
+        indexes = [models.Index(fields=['term','post'])]
+        constraints = [models.UniqueConstraint(fields=['post','term'],name='unique_search_posting')]
+
+
+
+class PostDailyStats(models.Model):
+    #daily rollup of the raw PostView / Like / Comment rows, see rollups.py
+    post = models.ForeignKey(Post,related_name='daily_stats',on_delete=models.CASCADE)
+    day = models.DateField()
+    views = models.PositiveIntegerField(default=0)
+    likes = models.PositiveIntegerField(default=0)
+    comments = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['post','day'],name='unique_post_day_stats')]
+
+
+class RollupWatermark(models.Model):
+    #raw events older than `until` have been added to the rollup (null: nothing rolled up yet)
+    name = models.CharField(max_length=50,unique=True)
+    until = models.DateTimeField(null=True,blank=True)
+
+
+class PostScore(models.Model):
+    #time-decayed engagement of the posts people currently engage with, see trending.py
+    post = models.OneToOneField(Post,related_name='trending_score',on_delete=models.CASCADE,primary_key=True)
+    score = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['-score'])]
+
+
+class PostVector(models.Model):
+    #sparse tf-idf vector of a published post (term -> weight), see related.py
+    post = models.OneToOneField(Post,related_name='vector',on_delete=models.CASCADE,primary_key=True)
+    terms = models.JSONField(default=dict)
+    digest = models.CharField(max_length=32)   #of the text it was computed from
+
+
+class RelatedPost(models.Model):
+    #precomputed nearest neighbours of a post, served best first (see related.py)
+    post = models.ForeignKey(Post,related_name='related_posts',on_delete=models.CASCADE)
+    related = models.ForeignKey(Post,related_name='related_to',on_delete=models.CASCADE)
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [models.Index(fields=['post','-score'])]
+        constraints = [models.UniqueConstraint(fields=['post','related'],name='unique_related_post')]
+
+
+class TagAffinity(models.Model):
+    #how much a reader engages with a tag (likes, saves, comments on its posts), see personalization.py
+    user = models.ForeignKey(User,related_name='tag_affinities',on_delete=models.CASCADE)
+    tag = models.ForeignKey(Tag,related_name='affinities',on_delete=models.CASCADE)
+    weight = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['user','-weight'])]
+        constraints = [models.UniqueConstraint(fields=['user','tag'],name='unique_tag_affinity')]
+
+
+class TagFeedEntry(models.Model):
+    #tag -> published posts index the "for you" feed draws its candidates from, see personalization.py
+    tag = models.ForeignKey(Tag,related_name='feed_entries',on_delete=models.CASCADE)
+    post = models.ForeignKey(Post,related_name='feed_entries',on_delete=models.CASCADE)
+    created_at = models.DateTimeField()   #copy of the post's so the newest posts of a tag are an index range
+
+    class Meta:
+        indexes = [models.Index(fields=['tag','-created_at'])]
+        constraints = [models.UniqueConstraint(fields=['tag','post'],name='unique_tag_feed_entry')]
+
+
+
+class OutboxMail(models.Model):
+    #notification emails waiting to be delivered by the outbox worker (see email.py)
+    STATUS_CHOICES = [
+        ('PENDING','PENDING'),
+        ('SENT','SENT'),
+        ('DEAD','DEAD'),
+    ]
+    receiver = models.EmailField()
+    subject = models.CharField(max_length=256)
+    body = models.TextField()
+    status = models.CharField(max_length=10,choices=STATUS_CHOICES,default='PENDING')
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claim = models.CharField(max_length=32,blank=True,db_index=True)   #set by the worker that is sending the row
+    claimed_until = models.DateTimeField(null=True,blank=True)
+    sent_at = models.DateTimeField(null=True,blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status','next_attempt_at']),
+            models.Index(fields=['status','sent_at']),   #sent mails past the retention are pruned (see email.prune_outbox)
+        ]
@@ -0,0 +1,148 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Opaque cursor pagination on (created_at, id)
+
+    The cursor holds the key of the row at the edge of the current page, so the next page
+    is a range condition on (created_at, id) + LIMIT: no COUNT(*) and no OFFSET, the cost
+    of a page does not depend on how deep the reader has scrolled.
+    Works on any queryset exposing created_at (posts, comments), filtered or not;
+    subclasses set `ordering_field` for models timestamped under another name.
+    Searched posts (annotated with `search_rank`, see search.py) are paged best match first
+    on (search_rank, id) instead, their cursor holds the rank.
+
+    Response:
+    {
+        "next": "http://.../?cursor=<opaque>" or null,
+        "previous": "http://.../?cursor=<opaque>" or null,
+        "results": [...]
+    }
+    """
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    newest_first = True
+    ordering_field = 'created_at'
+    rank_field = 'search_rank'
+    ranked = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request):
+        #same page, rows fetched with the async ORM (plain Django requests work too, see views_async.py)
+        return self.set_page([row async for row in self.page_queryset(queryset, request)])
+
+    def page_queryset(self, queryset, request):
+        self.base_url = request.build_absolute_uri()
+        self.ranked = self.rank_field in queryset.query.annotations
+        self.cursor = cursor = self.decode_cursor(request)
+        self.backwards = bool(cursor and cursor['previous'])
+
+        #walking backwards is the same range scan with the ordering flipped
+        descending = (self.ranked or self.newest_first) != self.backwards
+        sign = '-' if descending else ''
+        field = self.key_field()
+        queryset = queryset.order_by(f'{sign}{field}', f'{sign}id')
+        if cursor:
+            op = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{field}__{op}': cursor['key']}) |
+                Q(**{field: cursor['key'], f'id__{op}': cursor['id']})
+            )
+        return queryset[:self.page_size + 1]  #one extra row tells us if there is more
+
+    def key_field(self):
+        return self.rank_field if self.ranked else self.ordering_field
+
+    def set_page(self, rows):
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.backwards:
+            rows.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        self.page = rows
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_data(self, data):
+        return {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+
+    def get_next_link(self):
+        if not (self.has_next and self.page):
+            return None
+        return self.encode_cursor(self.page[-1], previous=False)
+
+    def get_previous_link(self):
+        if not (self.has_previous and self.page):
+            return None
+        return self.encode_cursor(self.page[0], previous=True)
+
+    def encode_cursor(self, row, previous):
+        key = getattr(row, self.key_field())
+        key = {'r': key} if self.ranked else {'c': key.isoformat()}
+        payload = json.dumps({**key, 'i': row.id, 'p': int(previous)})
+        token = urlsafe_b64encode(payload.encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, token)
+
+    def decode_cursor(self, request):
+        token = request.GET.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            payload = json.loads(urlsafe_b64decode(token.encode()).decode())
+            #a cursor of the other ordering (the search was added or removed) is a KeyError
+            key = float(payload['r']) if self.ranked else parse_datetime(payload['c'])
+            if key is None:
+                raise ValueError
+            return {'key': key, 'id': int(payload['i']), 'previous': bool(payload['p'])}
+        except (TypeError, ValueError, KeyError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            'name': self.cursor_query_param,
+            'required': False,
+            'in': 'query',
+            'description': 'The pagination cursor value.',
+            'schema': {'type': 'string'},
+        }]
+
+
+class OldestFirstKeysetPagination(KeysetPagination):
+    newest_first = False
+
+
+class LikeKeysetPagination(KeysetPagination):
+    #likes are timestamped with time_stamp
+    ordering_field = 'time_stamp'
@@ -0,0 +1,178 @@
+import heapq
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import Comment, Like, Post, TagAffinity, TagFeedEntry
+from .trending import trending_scores
+
+DEFAULTS = {
+    'WEIGHTS': {'likes': 3.0, 'saves': 5.0, 'comments': 2.0},   #affinity a reader gains with each tag of the post
+    'TAGS': 10,               #strongest tags of the reader a page is drawn from
+    'HALF_LIFE': 3 * 24 * 3600,   #seconds for a candidate's recency factor to halve
+    'MAX_PAGES': 10,          #candidate lists are read `page * page size` deep
+}
+
+
+class ForYouFeed:
+    """
+    Personalized feed from per-reader tag affinities
+
+    TagAffinity holds, for each reader and tag, the weighted count of the reader's likes, saves
+    and comments on posts with that tag; every event adds (or takes back) its weight to the
+    tags of its post. TagFeedEntry lists the published posts of each tag newest first.
+    A page reads the reader's strongest tags and the newest entries of each (short, indexed
+    lists), then ranks the candidates by the affinity of the tags they match times a recency
+    factor, so serving it never touches the reader's history.
+
+    An event taken back is debited from the post's tags of the moment: after a retag it misses
+    the tags it was credited to. rebuild() recomputes everything from the likes, saves and
+    comments still there and runs daily (rebuild-for-you-feed beat task).
+    """
+
+    def __init__(self, weights, tags, half_life, max_pages):
+        self.weights = weights
+        self.tags = tags
+        self.half_life = half_life
+        self.max_pages = max_pages
+
+    #----- affinities
+
+    def engage(self, user_id, post_ids, kind, sign=1):
+        """
+        add the weight of `kind` (a WEIGHTS key) to the affinity of the reader with every tag of the posts,
+        sign=-1 takes it back (unlike, unsave, deleted comment)
+        """
+        tag_counts = Counter(Post.tags.through.objects.filter(post_id__in=post_ids).values_list('tag_id', flat=True))
+        if not tag_counts:
+            return
+        if sign > 0:
+            TagAffinity.objects.bulk_create(
+                [TagAffinity(user_id=user_id, tag_id=tag_id) for tag_id in tag_counts], ignore_conflicts=True
+            )
+        by_count = defaultdict(list)
+        for tag_id, count in tag_counts.items():
+            by_count[count].append(tag_id)
+        for count, tag_ids in by_count.items():
+            delta = sign * self.weights[kind] * count
+            TagAffinity.objects.filter(user_id=user_id, tag_id__in=tag_ids).update(weight=Greatest(F('weight') + delta, Value(0.0)))
+
+    def forget_post(self, post_id):
+        """
+        take back the weight of every like, save and comment of a post about to be deleted,
+        one UPDATE per distinct weight whatever the number of readers
+        """
+        tag_ids = list(Post.tags.through.objects.filter(post_id=post_id).values_list('tag_id', flat=True))
+        if not tag_ids:
+            return
+        sources = [
+            (Like.objects, 'user_id', 'likes'),
+            (Post.savers.through.objects, 'user_id', 'saves'),
+            (Comment.objects, 'owner_id', 'comments'),
+        ]
+        deltas = defaultdict(float)
+        for rows, user_field, kind in sources:
+            counts = rows.filter(post_id=post_id).values(user_field).annotate(total=Count('*')).order_by()
+            for user_id, total in counts.values_list(user_field, 'total'):
+                deltas[user_id] += self.weights[kind] * total
+        by_delta = defaultdict(list)
+        for user_id, delta in deltas.items():
+            by_delta[delta].append(user_id)
+        for delta, user_ids in by_delta.items():
+            TagAffinity.objects.filter(user_id__in=user_ids, tag_id__in=tag_ids).update(weight=Greatest(F('weight') - delta, Value(0.0)))
+
+    #----- tag -> recent posts index
+
+    def index_post(self, post):
+        #the post's entries follow its status and tags
+        if post.status != 'PUBLISHED':
+            TagFeedEntry.objects.filter(post_id=post.id).delete()
+            return
+        self.index_tags(post, post.tags.values_list('id', flat=True))
+
+    def index_tags(self, post, tag_ids):
+        if post.status == 'PUBLISHED':
+            TagFeedEntry.objects.bulk_create(
+                [TagFeedEntry(tag_id=tag_id, post_id=post.id, created_at=post.created_at) for tag_id in tag_ids],
+                ignore_conflicts=True,
+            )
+
+    def rebuild(self, batch_size=2000):
+        """
+        recompute every affinity from the likes, saves and comments and the whole tag index
+        (backfill after migrating, drift), returns (affinities, entries)
+        """
+        sources = [
+            (Like.objects, 'user_id', 'post__tags', 'likes'),
+            (Post.savers.through.objects, 'user_id', 'post__tags', 'saves'),
+            (Comment.objects, 'owner_id', 'post__tags', 'comments'),
+        ]
+        with transaction.atomic():
+            TagAffinity.objects.all().delete()
+            TagFeedEntry.objects.all().delete()
+            weights = defaultdict(float)
+            for rows, user_field, tag_field, kind in sources:
+                counts = rows.filter(**{f'{tag_field}__isnull': False}).values(user_field, tag_field).annotate(total=Count('*')).order_by()
+                for row in counts.iterator(chunk_size=batch_size):
+                    weights[(row[user_field], row[tag_field])] += self.weights[kind] * row['total']
+            TagAffinity.objects.bulk_create(
+                [TagAffinity(user_id=user_id, tag_id=tag_id, weight=weight) for (user_id, tag_id), weight in weights.items()],
+                batch_size=500,
+            )
+            entries = (
+                Post.tags.through.objects.filter(post__status='PUBLISHED')
+                .values_list('tag_id', 'post_id', 'post__created_at')
+            )
+            TagFeedEntry.objects.bulk_create(
+                (TagFeedEntry(tag_id=tag_id, post_id=post_id, created_at=created_at)
+                 for tag_id, post_id, created_at in entries.iterator(chunk_size=batch_size)),
+                batch_size=500,
+            )
+            return TagAffinity.objects.count(), TagFeedEntry.objects.count()
+
+    #----- serving
+
+    def page(self, user, page, page_size):
+        """
+        ids of the posts of `page` (from 1) for `user`, best first, and whether there is another page
+        readers without any affinity yet get the trending posts
+        """
+        depth = page * page_size + 1   #one extra row tells if there is more
+        affinities = dict(
+            TagAffinity.objects.filter(user=user, weight__gt=0).order_by('-weight')
+            .values_list('tag_id', 'weight')[:self.tags]
+        )
+        if not affinities:
+            return self.slice(trending_scores.top(depth), page, page_size)
+        now = timezone.now()
+        scores = defaultdict(float)
+        for tag_id, weight in affinities.items():
+            #one short range of the (tag, created_at) index per tag, sqlite can not UNION limited selects
+            newest = (
+                TagFeedEntry.objects.filter(tag_id=tag_id).exclude(post__owner=user)
+                .order_by('-created_at').values_list('post_id', 'created_at')[:depth]
+            )
+            for post_id, created_at in newest:
+                scores[post_id] += weight * 2 ** (-(now - created_at).total_seconds() / self.half_life)
+        return self.slice(heapq.nlargest(depth, scores, key=lambda post_id: (scores[post_id], post_id)), page, page_size)
+
+    def slice(self, ranked, page, page_size):
+        start = (page - 1) * page_size
+        return ranked[start:start + page_size], len(ranked) > start + page_size and page < self.max_pages
+
+
+def _build_feed():
+    options = {**DEFAULTS, **getattr(settings, 'FOR_YOU', {})}
+    return ForYouFeed(
+        weights=options['WEIGHTS'],
+        tags=options['TAGS'],
+        half_life=options['HALF_LIFE'],
+        max_pages=options['MAX_PAGES'],
+    )
+
+
+for_you = _build_feed()
@@ -0,0 +1,271 @@
+import hashlib
+import heapq
+import math
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from .models import Post, PostVector, RelatedPost, RollupWatermark, SearchDocument, SearchPosting
+from .search import tokenize
+
+WATERMARK = 'related_posts'
+
+#weight of every vectorized field in the term counts
+FIELD_WEIGHTS = {
+    'title': 3,
+    'tags': 3,
+    'content': 1,
+}
+
+DEFAULTS = {
+    'NEIGHBOURS': 10,        #related posts stored (and served) per post
+    'MAX_TERMS': 64,         #strongest terms kept in a post's vector
+    'MAX_DF': 0.5,           #terms found in more than this share of the posts say nothing about similarity
+    'MAX_CANDIDATES': 1000,  #posts compared with a refreshed post, the ones sharing the most terms with it
+    'MAX_POSTINGS': 500,     #posts a term compares a post with in rebuild(), the ones weighing it the most
+}
+
+
+class RelatedPosts:
+    """
+    Precomputed nearest neighbours of every published post, served by /posts/<id>/related/
+
+    Each published post is vectorized once: tf-idf of the words of its title, tags and content,
+    (1 + log tf) * idf, the idf coming from the search index's postings (see search.py),
+    truncated to its `max_terms` strongest terms and L2-normalized, stored in PostVector.
+    The similarity of two posts is the dot product (cosine) of their vectors and the
+    `neighbours` most similar posts of each one are stored in RelatedPost.
+
+    rebuild() recomputes everything with an in-memory inverted index (nightly), whose postings
+    are cut to the `max_postings` strongest of every term so that a common term costs
+    len(posts) * max_postings products rather than len(posts) squared; refresh()
+    only revectorizes the posts changed since its watermark and compares them with the posts
+    sharing the most terms with them: a post's score is updated in place in the lists already
+    holding it, and it is slotted into the lists of its new neighbours.
+    Vectors are plain dicts: numpy is not a dependency of the project.
+    """
+
+    def __init__(self, neighbours, max_terms, max_df, max_candidates, max_postings):
+        self.neighbours = neighbours
+        self.max_terms = max_terms
+        self.max_df = max_df
+        self.max_candidates = max_candidates
+        self.max_postings = max_postings
+
+    #----- vectors
+
+    def term_counts(self, post):
+        counts = Counter()
+        texts = {
+            'title': post.title,
+            'tags': ' '.join(tag.name for tag in post.tags.all()),
+            'content': post.content,
+        }
+        for field, text in texts.items():
+            for token in tokenize(text):
+                counts[token] += FIELD_WEIGHTS[field]
+        return counts
+
+    def digest(self, counts):
+        #unchanged text, unchanged vector: edits that do not touch it are skipped by refresh()
+        return hashlib.md5(repr(sorted(counts.items())).encode()).hexdigest()
+
+    def document_frequencies(self, terms=None):
+        postings = SearchPosting.objects.all()
+        if terms is not None:
+            postings = postings.filter(term__in=terms)
+        frequencies = dict(postings.values_list('term').annotate(total=Count('post')).order_by())
+        return frequencies, SearchDocument.objects.count()
+
+    def vectorize(self, counts, frequencies, total):
+        weights = {}
+        for term, count in counts.items():
+            df = frequencies.get(term, 0)
+            if total and df / total > self.max_df:
+                continue
+            weights[term] = (1 + math.log(count)) * (math.log((1 + total) / (1 + df)) + 1)
+        strongest = heapq.nlargest(self.max_terms, weights.items(), key=lambda item: item[1])
+        norm = math.sqrt(sum(weight * weight for _, weight in strongest)) or 1.0
+        return {term: weight / norm for term, weight in strongest}
+
+    def similarity(self, vector, other):
+        if len(other) < len(vector):
+            vector, other = other, vector
+        return sum(weight * other.get(term, 0.0) for term, weight in vector.items())
+
+    #----- batch
+
+    def inverted_index(self, vectors):
+        #term -> [(post_id, weight)], only the `max_postings` posts weighing the term the most
+        postings = defaultdict(list)
+        for post_id, vector in vectors.items():
+            for term, weight in vector.items():
+                postings[term].append((post_id, weight))
+        for term, posting in postings.items():
+            if len(posting) > self.max_postings:
+                postings[term] = heapq.nlargest(self.max_postings, posting, key=lambda item: item[1])
+        return postings
+
+    def rebuild(self, now=None):
+        """
+        vectorize every published post and recompute every neighbour list,
+        returns the number of posts that have related posts
+        """
+        now = now or timezone.now()
+        frequencies, total = self.document_frequencies()
+        vectors, digests = {}, {}
+        for post in Post.objects.filter(status='PUBLISHED').prefetch_related('tags').iterator(chunk_size=500):
+            counts = self.term_counts(post)
+            digests[post.id] = self.digest(counts)
+            vectors[post.id] = self.vectorize(counts, frequencies, total)
+
+        #inverted index: every post sharing a term with a post is a candidate, the dot products add up term by term
+        #(through a common term a post only meets the posts weighing that term the most)
+        postings = self.inverted_index(vectors)
+        rows = []
+        for post_id, vector in vectors.items():
+            scores = defaultdict(float)
+            for term, weight in vector.items():
+                for other_id, other_weight in postings[term]:
+                    if other_id != post_id:
+                        scores[other_id] += weight * other_weight
+            best = heapq.nlargest(self.neighbours, scores.items(), key=lambda item: item[1])
+            rows.extend(RelatedPost(post_id=post_id, related_id=other_id, score=score) for other_id, score in best)
+
+        with transaction.atomic():
+            PostVector.objects.all().delete()
+            RelatedPost.objects.all().delete()
+            PostVector.objects.bulk_create(
+                [PostVector(post_id=post_id, terms=vector, digest=digests[post_id]) for post_id, vector in vectors.items()],
+                batch_size=500,
+            )
+            RelatedPost.objects.bulk_create(rows, batch_size=500)
+            RollupWatermark.objects.update_or_create(name=WATERMARK, defaults={'until': now})
+        return len({row.post_id for row in rows})
+
+    #----- incremental
+
+    def refresh(self, now=None):
+        """
+        bring the posts changed since the watermark (new, edited, retagged, unpublished) up to date,
+        returns the number of posts whose vector changed
+        """
+        now = now or timezone.now()
+        with transaction.atomic():
+            mark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=WATERMARK)
+            if mark.until is None:
+                #never built: nothing to be incremental about
+                mark.until = now
+                mark.save(update_fields=['until'])
+                transaction.on_commit(lambda: self.rebuild(now))
+                return 0
+            changed = Post.objects.filter(updated_at__gte=mark.until, updated_at__lt=now).prefetch_related('tags')
+            refreshed = 0
+            for post in changed.iterator(chunk_size=100):
+                refreshed += self.refresh_post(post)
+            mark.until = now
+            mark.save(update_fields=['until'])
+        return refreshed
+
+    def refresh_post(self, post):
+        stored = PostVector.objects.filter(post=post).first()
+        if post.status != 'PUBLISHED':
+            if stored is None:
+                return 0
+            self.forget(post.id)
+            return 1
+        counts = self.term_counts(post)
+        digest = self.digest(counts)
+        if stored is not None and stored.digest == digest:
+            #a like, a comment... moved updated_at, the text is the same
+            return 0
+
+        frequencies, total = self.document_frequencies(list(counts))
+        vector = self.vectorize(counts, frequencies, total)
+        PostVector.objects.update_or_create(post=post, defaults={'terms': vector, 'digest': digest})
+
+        #candidates: the published posts sharing the most of its terms
+        candidates = (
+            SearchPosting.objects.filter(term__in=list(vector), post__vector__isnull=False)
+            .exclude(post=post).values('post').annotate(shared=Count('*')).order_by('-shared')
+            .values_list('post', flat=True)[:self.max_candidates]
+        )
+        others = PostVector.objects.filter(post__in=list(candidates)).values_list('post_id', 'terms')
+        scores = {other_id: self.similarity(vector, terms) for other_id, terms in others}
+        best = heapq.nlargest(
+            self.neighbours, ((other_id, score) for other_id, score in scores.items() if score > 0), key=lambda item: item[1]
+        )
+
+        RelatedPost.objects.filter(post=post).delete()
+        RelatedPost.objects.bulk_create([RelatedPost(post=post, related_id=other_id, score=score) for other_id, score in best])
+        listed_in = self.rescore(post.id, vector, scores)
+        self.slot_into(post.id, [(other_id, score) for other_id, score in best if other_id not in listed_in])
+        return 1
+
+    def rescore(self, post_id, vector, scores):
+        """
+        update the score of the post in the lists it already is in (it leaves the ones it no longer
+        shares a term with), returns the ids of the posts whose list still holds it
+        """
+        rows = list(RelatedPost.objects.filter(related_id=post_id))
+        missing = [row.post_id for row in rows if row.post_id not in scores]
+        for other_id, terms in PostVector.objects.filter(post__in=missing).values_list('post_id', 'terms'):
+            scores[other_id] = self.similarity(vector, terms)
+        kept = [row for row in rows if scores.get(row.post_id, 0) > 0]
+        for row in kept:
+            row.score = scores[row.post_id]
+        RelatedPost.objects.bulk_update(kept, ['score'], batch_size=500)
+        RelatedPost.objects.filter(related_id=post_id).exclude(id__in=[row.id for row in kept]).delete()
+        return {row.post_id for row in kept}
+
+    def forget(self, post_id):
+        #an unpublished post leaves every neighbour list (the lists it was in are refilled by the next rebuild)
+        RelatedPost.objects.filter(post_id=post_id).delete()
+        RelatedPost.objects.filter(related_id=post_id).delete()
+        PostVector.objects.filter(post_id=post_id).delete()
+
+    def slot_into(self, post_id, neighbours):
+        #the post enters the list of each of its neighbours it beats the weakest entry of (or that is not full)
+        if not neighbours:
+            return
+        lists = {
+            row['post_id']: row
+            for row in RelatedPost.objects.filter(post_id__in=[other_id for other_id, _ in neighbours])
+            .values('post_id').annotate(size=Count('*'), weakest=Min('score')).order_by()
+        }
+        added = []
+        for other_id, score in neighbours:
+            current = lists.get(other_id)
+            if current is None or current['size'] < self.neighbours:
+                added.append(RelatedPost(post_id=other_id, related_id=post_id, score=score))
+            elif score > current['weakest']:
+                weakest = RelatedPost.objects.filter(post_id=other_id).order_by('score').values_list('id', flat=True)[:1]
+                RelatedPost.objects.filter(id__in=list(weakest)).delete()
+                added.append(RelatedPost(post_id=other_id, related_id=post_id, score=score))
+        RelatedPost.objects.bulk_create(added)
+
+    #----- serving
+
+    def related(self, post_id, viewer=None):
+        #the stored neighbours of the post, best first, as feed posts: one lookup of the (post, score) index
+        return list(
+            Post.objects.filter(related_to__post_id=post_id, status='PUBLISHED')
+            .for_feed(viewer).order_by('-related_to__score')[:self.neighbours]
+        )
+
+
+def _build_related():
+    options = {**DEFAULTS, **getattr(settings, 'RELATED_POSTS', {})}
+    return RelatedPosts(
+        neighbours=options['NEIGHBOURS'],
+        max_terms=options['MAX_TERMS'],
+        max_df=options['MAX_DF'],
+        max_candidates=options['MAX_CANDIDATES'],
+        max_postings=options['MAX_POSTINGS'],
+    )
+
+
+related_posts = _build_related()
@@ -0,0 +1,98 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+
+CACHE_TTL = 60 * 5   #safety net only, entries are invalidated by version bumps
+VERSION_PREFIX = 'ver:'
+
+
+def get_versions(scopes):
+    """
+    current version of every scope (one cache round trip), a missing version is
+    (re)initialised to the current time so an evicted counter never goes back to an old value
+    """
+    keys = [VERSION_PREFIX + scope for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time.time_ns())
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+async def aget_versions(scopes):
+    #get_versions through the async cache API (views_async.py)
+    keys = [VERSION_PREFIX + scope for scope in scopes]
+    versions = await cache.aget_many(keys)
+    for key in keys:
+        if key not in versions:
+            await cache.aadd(key, time.time_ns())
+            versions[key] = await cache.aget(key)
+    return [versions[key] for key in keys]
+
+
+def bump_versions(*scopes):
+    for scope in scopes:
+        key = VERSION_PREFIX + scope
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), None)
+
+
+def bump_versions_on_commit(*scopes):
+    #a reader must not cache the old rows under the new version: bump once they are committed (now outside a transaction)
+    transaction.on_commit(lambda: bump_versions(*scopes))
+
+
+def post_scopes(post_id, owner_id):
+    #everything showing a given post: the feed, the post itself and its author's post list
+    return ['posts', f'post:{post_id}', f'user_posts:{owner_id}']
+
+
+def response_cache_key(request, scopes):
+    return make_key(request, scopes, get_versions(scopes))
+
+
+async def aresponse_cache_key(request, scopes):
+    return make_key(request, scopes, await aget_versions(scopes))
+
+
+def make_key(request, scopes, versions):
+    #DRF and plain Django requests alike: the query params are read from request.GET
+    params = sorted((key, value) for key, values in request.GET.lists() for value in values if value != '')
+    raw = '|'.join([
+        request.get_host(),
+        request.path,
+        repr(params),
+        repr(list(zip(scopes, versions))),
+    ])
+    return 'response:' + hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class AnonymousResponseCacheMixin:
+    """
+    Cache the serialized GET responses served to anonymous users
+
+    The key is made of the path, the normalized query params and the versions of the
+    scopes returned by `cache_scopes()`; the versions are bumped by signals (see signals.py)
+    when a post, tag, like or comment changes, so a stale entry is simply never read again.
+    """
+
+    def cache_scopes(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            return super().get(request, *args, **kwargs)
+        key = response_cache_key(request, self.cache_scopes())
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+        response = super().get(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, CACHE_TTL)
+        return response
@@ -0,0 +1,118 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear, TruncDate
+from django.utils import timezone
+
+from .models import Comment, Like, PostDailyStats, PostView, RollupWatermark
+
+WATERMARK = 'post_daily_stats'
+
+#events younger than this are left to the live tail, buffered views may still be on their way to the db
+ROLLUP_LAG = timedelta(minutes=5)
+
+#raw event table, its timestamp field and the PostDailyStats column it is rolled into
+SOURCES = [
+    (PostView, 'timestamp', 'views'),
+    (Like, 'time_stamp', 'likes'),
+    (Comment, 'created_at', 'comments'),
+]
+COLUMNS = [column for _, _, column in SOURCES]
+
+
+def get_watermark():
+    return RollupWatermark.objects.filter(name=WATERMARK).values_list('until', flat=True).first()
+
+
+def roll_up(now=None):
+    """
+    add the raw events between the watermark and (now - ROLLUP_LAG) to PostDailyStats
+    and move the watermark, returns the number of (post, day) rows touched
+    """
+    cutoff = (now or timezone.now()) - ROLLUP_LAG
+    with transaction.atomic():
+        mark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=WATERMARK)
+        start = mark.until
+        if start is not None and start >= cutoff:
+            return 0
+
+        totals = defaultdict(lambda: dict.fromkeys(COLUMNS, 0))
+        for model, field, column in SOURCES:
+            rows = model.objects.filter(**{f'{field}__lt': cutoff})
+            if start is not None:
+                rows = rows.filter(**{f'{field}__gte': start})
+            rows = rows.annotate(day=TruncDate(field)).values('post_id', 'day').annotate(total=Count('id')).order_by()
+            for row in rows:
+                totals[(row['post_id'], row['day'])][column] = row['total']
+
+        existing = {
+            (stats.post_id, stats.day): stats
+            for stats in PostDailyStats.objects.filter(
+                post_id__in={post_id for post_id, _ in totals},
+                day__in={day for _, day in totals},
+            )
+        }
+        created = []
+        for (post_id, day), counts in totals.items():
+            stats = existing.get((post_id, day))
+            if stats is None:
+                created.append(PostDailyStats(post_id=post_id, day=day, **counts))
+                continue
+            for column, total in counts.items():
+                setattr(stats, column, getattr(stats, column) + total)
+        PostDailyStats.objects.bulk_create(created, batch_size=500)
+        PostDailyStats.objects.bulk_update(existing.values(), COLUMNS, batch_size=500)
+
+        mark.until = cutoff
+        mark.save(update_fields=['until'])
+    return len(totals)
+
+
+def forget_event(post_id, column, timestamp):
+    """
+    take a deleted like / comment out of the rollup if it had already been rolled up
+    """
+    mark = get_watermark()
+    if mark is None or timestamp >= mark:
+        return
+    PostDailyStats.objects.filter(
+        post_id=post_id, day=timezone.localdate(timestamp), **{f'{column}__gt': 0}
+    ).update(**{column: F(column) - 1})
+
+
+def monthly_stats(**lookup):
+    """
+    {(year, month): {"views": n, "likes": n, "comments": n}} for the posts matching `lookup`
+    (a lookup on the `post` relation, e.g. post_id=1 or post__owner=user)
+
+    The rolled up days are read from PostDailyStats and only the raw events newer than
+    the watermark are aggregated, so the cost does not grow with the raw event volume.
+    """
+    result = defaultdict(lambda: dict.fromkeys(COLUMNS, 0))
+    mark = get_watermark()
+
+    if mark is not None:
+        rolled = PostDailyStats.objects.filter(**lookup).annotate(
+            year=ExtractYear('day'),
+            month=ExtractMonth('day')
+        ).values('year', 'month').annotate(
+            **{f'total_{column}': Sum(column) for column in COLUMNS}
+        ).order_by()
+        for row in rolled:
+            for column in COLUMNS:
+                result[(row['year'], row['month'])][column] += row[f'total_{column}']
+
+    for model, field, column in SOURCES:
+        tail = model.objects.filter(**lookup)
+        if mark is not None:
+            tail = tail.filter(**{f'{field}__gte': mark})
+        tail = tail.annotate(
+            year=ExtractYear(field),
+            month=ExtractMonth(field)
+        ).values('year', 'month').annotate(total=Count('id')).order_by()
+        for row in tail:
+            result[(row['year'], row['month'])][column] += row['total']
+
+    return {key: result[key] for key in sorted(result) if any(result[key].values())}
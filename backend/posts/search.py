@@ -0,0 +1,201 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+from django.db import connection, transaction
+from django.db.models import Avg, Case, Count, ExpressionWrapper, F, FloatField, Max, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Greatest
+
+from .models import Post, SearchDocument, SearchPosting
+
+#weight of every indexed field in the term frequency (title and tags matter more than the body)
+FIELD_WEIGHTS = {
+    'title': 3,
+    'tags': 2,
+    'author': 2,
+    'summary': 1,
+    'content': 1,
+}
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+
+#BM25 parameters
+K1 = 1.2
+B = 0.75
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall(text.lower())]
+
+
+def post_fields(post):
+    owner = post.owner
+    return {
+        'title': post.title,
+        'tags': ' '.join(tag.name for tag in post.tags.all()),
+        'author': ' '.join([owner.username, owner.first_name, owner.last_name]),
+        'summary': post.summary,
+        'content': post.content,
+    }
+
+
+def term_frequencies(post):
+    frequencies = Counter()
+    for field, text in post_fields(post).items():
+        for token in tokenize(text):
+            frequencies[token] += FIELD_WEIGHTS[field]
+    return frequencies
+
+
+def index_post(post):
+    """
+    (re)build the postings of a single post: one delete and one bulk insert
+    """
+    frequencies = term_frequencies(post)
+    length = sum(frequencies.values())
+
+    with transaction.atomic():
+        SearchDocument.objects.update_or_create(post=post, defaults={'length': length})
+        SearchPosting.objects.filter(post=post).delete()
+        SearchPosting.objects.bulk_create([
+            SearchPosting(post=post, term=term, frequency=frequency, doc_length=length)
+            for term, frequency in frequencies.items()
+        ])
+
+
+def index_posts(post_ids):
+    """
+    (re)build the postings of several posts at once (a renamed tag or author, a batch of the backfill):
+    the same deletes and inserts as index_post() whatever the number of posts, the inserts being split
+    into the largest batches the database accepts
+    """
+    posts = Post.objects.filter(id__in=post_ids).select_related('owner').prefetch_related('tags')
+    documents, postings = [], []
+    for post in posts:
+        frequencies = term_frequencies(post)
+        length = sum(frequencies.values())
+        documents.append(SearchDocument(post=post, length=length))
+        postings.extend(
+            SearchPosting(post=post, term=term, frequency=frequency, doc_length=length)
+            for term, frequency in frequencies.items()
+        )
+
+    with transaction.atomic():
+        SearchDocument.objects.filter(post__in=post_ids).delete()
+        SearchPosting.objects.filter(post__in=post_ids).delete()
+        SearchDocument.objects.bulk_create(documents)
+        SearchPosting.objects.bulk_create(postings)
+
+
+def rename_tag(tag, old_name):
+    """
+    move the postings of the tag's posts from the words of `old_name` to the words of its name in place,
+    only the frequencies of those words and the lengths change: a fixed number of statements whatever
+    the number of posts, where index_posts() would rebuild (and insert) all of their postings
+    """
+    deltas = Counter()
+    for token in tokenize(tag.name):
+        deltas[token] += FIELD_WEIGHTS['tags']
+    for token in tokenize(old_name):
+        deltas[token] -= FIELD_WEIGHTS['tags']
+    deltas = {term: delta for term, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    length_delta = sum(deltas.values())
+    tagged = Post.tags.through.objects.filter(tag=tag).values('post_id')
+    by_delta = defaultdict(list)
+    for term, delta in deltas.items():
+        by_delta[delta].append(term)
+
+    with transaction.atomic():
+        if length_delta:
+            SearchDocument.objects.filter(post__in=tagged).update(length=Greatest(F('length') + length_delta, Value(0)))
+            SearchPosting.objects.filter(post__in=tagged).update(doc_length=Greatest(F('doc_length') + length_delta, Value(0)))
+        for delta, terms in by_delta.items():
+            SearchPosting.objects.filter(post__in=tagged, term__in=terms).update(frequency=Greatest(F('frequency') + delta, Value(0)))
+        SearchPosting.objects.filter(post__in=tagged, term__in=list(deltas), frequency=0).delete()
+        #the new words the posts did not contain yet: INSERT ... SELECT, the ORM can only insert rows it was given
+        added = [(term, delta) for term, delta in deltas.items() if delta > 0]
+        if added:
+            with connection.cursor() as cursor:
+                for term, delta in added:
+                    cursor.execute(
+                        f'''
+                        INSERT INTO {SearchPosting._meta.db_table} (post_id, term, frequency, doc_length)
+                        SELECT document.post_id, %s, %s, document.length
+                        FROM {SearchDocument._meta.db_table} document
+                        INNER JOIN {Post.tags.through._meta.db_table} tagged ON tagged.post_id = document.post_id
+                        WHERE tagged.tag_id = %s AND NOT EXISTS (
+                            SELECT 1 FROM {SearchPosting._meta.db_table} posting
+                            WHERE posting.post_id = document.post_id AND posting.term = %s
+                        )
+                        ''',
+                        [term, delta, tag.id, term],
+                    )
+
+
+def rebuild_index(batch_size=500):
+    """
+    index every post, used to backfill the index (see the rebuild_search_index command)
+    """
+    ids = list(Post.objects.order_by('id').values_list('id', flat=True))
+    SearchDocument.objects.exclude(post_id__in=ids).delete()
+    for start in range(0, len(ids), batch_size):
+        index_posts(ids[start:start + batch_size])
+    return len(ids)
+
+
+def prefix_q(token):
+    #a range on the term rather than LIKE 'token%' so the (term, post) index is used on every backend
+    return Q(term__gte=token, term__lt=token + '\uffff')
+
+
+def bm25(idf, avgdl):
+    tf = Cast('frequency', FloatField())
+    dl = Cast('doc_length', FloatField())
+    return ExpressionWrapper(
+        Value(idf) * tf * Value(K1 + 1) / (tf + Value(K1) * (Value(1 - B) + Value(B) * dl / Value(avgdl))),
+        output_field=FloatField(),
+    )
+
+
+def search_posts(queryset, value):
+    """
+    restrict a Post queryset to the posts containing every word of `value` (prefix match)
+    and annotate each post with its BM25 score as `search_rank`
+    """
+    tokens = list(dict.fromkeys(tokenize(value)))[:MAX_QUERY_TERMS]
+    if not tokens:
+        return queryset.none()
+
+    stats = SearchDocument.objects.aggregate(total=Count('post'), avgdl=Avg('length'))
+    total = stats['total'] or 0
+    avgdl = stats['avgdl'] or 1.0
+
+    hits = {}
+    score = Value(0.0, output_field=FloatField())
+    for i, token in enumerate(tokens):
+        condition = prefix_q(token)
+        df = SearchPosting.objects.filter(condition).values('post').distinct().count()
+        if not df:
+            return queryset.none()
+        idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+        hits[f'hit_{i}'] = Max(Case(When(condition, then=Value(1)), default=Value(0)))
+        score = score + Sum(Case(When(condition, then=bm25(idf, avgdl)), default=Value(0.0), output_field=FloatField()))
+
+    any_token = Q()
+    for token in tokens:
+        any_token |= prefix_q(token)
+    matches = (
+        SearchPosting.objects.filter(any_token)
+        .values('post')
+        .annotate(score=score, **hits)
+        .filter(**{name: 1 for name in hits})
+    )
+    return queryset.filter(id__in=matches.values('post')).annotate(
+        search_rank=Subquery(matches.filter(post=OuterRef('pk')).values('score')[:1], output_field=FloatField())
+    )
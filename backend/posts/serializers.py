@@ -1,27 +1,55 @@
 from rest_framework.serializers import Serializer,ModelSerializer
 from rest_framework import serializers
+from .metrics import TimedSerializerMixin
 from .models import Post,Comment,Tag
+from .personalization import for_you
+from .images import variant_urls
+from .tags import attach_tags, clean_tag_names, resolve_tags
 from users.serializers import UserSerializer
 from drf_spectacular.utils import extend_schema_field
 from typing import List, Dict, Any
 
 
-class TagSerializer(ModelSerializer):
+class TagSerializer(TimedSerializerMixin,ModelSerializer):
     class Meta:
         model = Tag
         fields = ['id','name']
 
-class PostSerializer(ModelSerializer):
+class PostStateRequestSerializer(Serializer):
+    post_ids = serializers.ListField(child=serializers.IntegerField(min_value=1),allow_empty=False,max_length=500)
+
+
+class TrendingRequestSerializer(Serializer):
+    limit = serializers.IntegerField(min_value=1,max_value=100,default=20)
+
+
+class ForYouRequestSerializer(Serializer):
+    page = serializers.IntegerField(min_value=1,max_value=for_you.max_pages,default=1)
+
+
+class PostStateSerializer(TimedSerializerMixin,Serializer):
+    #rows of Post.objects.with_viewer_state(...).values(...)
+    id = serializers.IntegerField()
+    is_liked = serializers.BooleanField(source='viewer_liked')
+    is_saved = serializers.BooleanField(source='viewer_saved')
+    likes_count = serializers.IntegerField()
+    comments_count = serializers.IntegerField()
+    views_count = serializers.IntegerField()
+
+
+class PostSerializer(TimedSerializerMixin,ModelSerializer):
     owner = UserSerializer(read_only=True)
     is_liked = serializers.SerializerMethodField()
     is_saved = serializers.SerializerMethodField()
     likes_count = serializers.ReadOnlyField()
     comments_count = serializers.ReadOnlyField()
+    views_count = serializers.ReadOnlyField()
     tags = TagSerializer(many=True,read_only=True)
+    image_variants = serializers.SerializerMethodField()
     
     class Meta:
         model = Post
-        fields = ['id','owner','title','content','image','tags','summary','created_at','status','is_liked','is_saved','likes_count','comments_count','owner']
+        fields = ['id','owner','title','content','image','image_variants','tags','summary','created_at','status','is_liked','is_saved','likes_count','comments_count','views_count','owner']
         extra_kwargs = {
             'created_at' : {'read_only' : True},
             'image' : {'read_only' : True},
@@ -31,21 +59,41 @@ class PostSerializer(ModelSerializer):
             'tags' : {'read_only' : True}
         }
 
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if self.instance is None:
+            #"tags" is read only (nested TagSerializer), the names are taken from the raw payload
+            raw = self.initial_data.getlist('tags') if hasattr(self.initial_data, 'getlist') else self.initial_data.get('tags', [])
+            try:
+                attrs['tags'] = clean_tag_names(raw)
+            except serializers.ValidationError as e:
+                raise serializers.ValidationError({'tags': e.detail})
+        return attrs
+
     def create(self, validated_data):
-        tags_data = validated_data.pop('tags', [])
+        tag_names = validated_data.pop('tags', [])
         post = Post.objects.create(**validated_data)
-        for tag_data in tags_data:
-            tag, created = Tag.objects.get_or_create(name=tag_data['name'])
-            post.tags.add(tag)
+        tags, created = resolve_tags(tag_names)
+        attach_tags(post, tags)
         return post
 
+    @extend_schema_field(Dict[str, Dict[str, str]])
+    def get_image_variants(self, obj):
+        #{"thumb": {"webp": url, "jpeg": url}, "card": {...}, "full": {...}}, empty until generated
+        return variant_urls(obj.image_variants, self.context.get('request'))
+
     def get_is_liked(self, obj):
+        #posts loaded with Post.objects.for_feed() already carry the flag
+        if hasattr(obj, 'viewer_liked'):
+            return obj.viewer_liked
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return obj.likes.filter(user=request.user).exists()
         return False
     
     def get_is_saved(self, obj):
+        if hasattr(obj, 'viewer_saved'):
+            return obj.viewer_saved
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return obj.savers.filter(id=request.user.id).exists()
@@ -53,10 +101,10 @@ class PostSerializer(ModelSerializer):
 
 
 
-class CommentSerializer(ModelSerializer):
+class CommentSerializer(TimedSerializerMixin,ModelSerializer):
     sub_comments = serializers.SerializerMethodField()
     is_liked = serializers.SerializerMethodField()
-    likes_count = serializers.SerializerMethodField()
+    likes_count = serializers.ReadOnlyField()
     
     class Meta:
         model = Comment
@@ -71,17 +119,23 @@ class CommentSerializer(ModelSerializer):
 
     @extend_schema_field(List[Dict[str, Any]])
     def get_sub_comments(self, obj):
-        children = obj.sub_comments.all().order_by('-created_at')
-        return CommentSerializer(children, many=True).data
+        #the whole reply tree can be handed over in the context (parent id -> replies), see CommentListCreate
+        replies = self.context.get('replies')
+        if replies is not None:
+            children = replies.get(obj.id, [])
+        else:
+            children = obj.sub_comments.all().order_by('-created_at')
+        return CommentSerializer(children, many=True, context=self.context).data
 
     def get_is_liked(self, obj):
+        #comments loaded with Comment.objects.for_thread() already carry the flag
+        if hasattr(obj, 'viewer_liked'):
+            return obj.viewer_liked
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return obj.likes.filter(id=request.user.id).exists()
         return False
-    
-    def get_likes_count(self, obj):
-        return obj.likes.count()
+
 
 
 
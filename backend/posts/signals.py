@@ -0,0 +1,336 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete, pre_save
+from django.db.models import F, QuerySet, Value
+from django.db.models.functions import Greatest, Now
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import Comment, Like, Post, Tag, TagFeedEntry
+from .counters import bump
+from .ingestion import record_engagement
+from .personalization import for_you
+from .response_cache import bump_versions_on_commit, post_scopes
+from .rollups import forget_event
+from .search import index_post, index_posts, rename_tag
+from .tags import tags_created
+
+
+#keep the search index in sync: a post is re-indexed whenever something it is indexed on changes
+
+INDEXED_POST_FIELDS = {'title', 'content', 'summary', 'owner'}
+
+#the author fields shown (and indexed) with posts and comments, a login or a password change touches none of them
+AUTHOR_FIELDS = ('username', 'first_name', 'last_name')
+
+
+@receiver(post_save, sender=Post)
+def index_saved_post(sender, instance, raw=False, update_fields=None, **kwargs):
+    #saves limited to fields that are not indexed (image variants...) leave the index alone
+    if raw or (update_fields is not None and not INDEXED_POST_FIELDS & set(update_fields)):
+        return
+    index_post(instance)
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def index_tagged_posts(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        #tag.posts.clear() does not tell post_clear which posts lost the tag
+        instance._cleared_post_ids = list(instance.posts.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        index_post(instance)
+    elif action == 'post_clear':
+        index_posts(getattr(instance, '_cleared_post_ids', []))
+    else:
+        index_posts(pk_set or [])
+
+
+@receiver(post_init, sender=Tag)
+def remember_tag_name(sender, instance, **kwargs):
+    instance._indexed_name = instance.__dict__.get('name')
+
+
+@receiver(pre_save, sender=Tag)
+def detect_renamed_tag(sender, instance, **kwargs):
+    #read by the post_save receivers below, _old_name is None when the name was deferred
+    name = instance.__dict__.get('name')
+    instance._renamed = name != instance._indexed_name
+    instance._old_name = instance._indexed_name
+    instance._indexed_name = name
+
+
+@receiver(post_save, sender=Tag)
+def index_renamed_tag(sender, instance, created, raw=False, **kwargs):
+    if created or raw or not instance._renamed:
+        return
+    if instance._old_name is None:
+        index_posts(instance.posts.values_list('id', flat=True))
+    else:
+        rename_tag(instance, instance._old_name)
+
+
+@receiver(pre_delete, sender=Tag)
+def remember_tag_posts(sender, instance, **kwargs):
+    instance._deleted_post_ids = list(instance.posts.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def index_untagged_posts(sender, instance, **kwargs):
+    index_posts(getattr(instance, '_deleted_post_ids', []))
+
+
+def author_names(user):
+    #read from __dict__: deferred fields must not cost a query
+    return tuple(user.__dict__.get(field) for field in AUTHOR_FIELDS)
+
+
+@receiver(post_init, sender=User)
+def remember_author_names(sender, instance, **kwargs):
+    instance._author_names = author_names(instance)
+
+
+@receiver(pre_save, sender=User)
+def detect_renamed_author(sender, instance, update_fields=None, **kwargs):
+    #read by the post_save receivers below: is there anything to re-index, expire and touch
+    if update_fields is not None and not set(update_fields) & set(AUTHOR_FIELDS):
+        instance._renamed = False
+        return
+    names = author_names(instance)
+    instance._renamed = names != instance._author_names
+    instance._author_names = names
+
+
+@receiver(post_save, sender=User)
+def index_author_posts(sender, instance, created, raw=False, **kwargs):
+    #author names are part of the index
+    if not created and not raw and instance._renamed:
+        index_posts(instance.posts.values_list('id', flat=True))
+
+
+
+#likes and comments deleted with their post: the rollup rows, the counters, the score and the cache
+#entries go with the post, the tag affinities are taken back once (forget_post_engagement)
+#the receivers of the rows skip them rather than costing queries per row of the cascade
+
+def deleted_with_post(origin):
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return model is Post
+
+
+@receiver(pre_delete, sender=Post)
+def forget_post_engagement(sender, instance, **kwargs):
+    for_you.forget_post(instance.id)
+
+
+
+#deleted likes and comments have to leave the daily rollup as well
+
+@receiver(post_delete, sender=Like)
+def forget_deleted_like(sender, instance, origin=None, **kwargs):
+    if not deleted_with_post(origin):
+        forget_event(instance.post_id, 'likes', instance.time_stamp)
+
+
+@receiver(post_delete, sender=Comment)
+def forget_deleted_comment(sender, instance, origin=None, **kwargs):
+    if not deleted_with_post(origin):
+        forget_event(instance.post_id, 'comments', instance.created_at)
+
+
+
+#comment deletes are counted here rather than in the views so cascades (of a comment's replies) are counted as well;
+#an unlike is counted by its view (views_likes.py), and the likes deleted with their user in one UPDATE below
+#(a user likes a post at most once)
+
+@receiver(pre_delete, sender=User)
+def uncount_user_likes(sender, instance, **kwargs):
+    Post.objects.filter(likes__user=instance).update(likes_count=Greatest(F('likes_count') - 1, Value(0)), updated_at=Now())
+
+
+@receiver(post_delete, sender=Comment)
+def uncount_deleted_comment(sender, instance, origin=None, **kwargs):
+    if not deleted_with_post(origin):
+        bump(Post, instance.post_id, comments_count=-1)
+
+
+
+#likes, saves and comments move the trending score of their post and the tag affinities of their author,
+#applied in batches by the engagement buffer (see ingestion.py); views are scored when their buffer is flushed
+
+@receiver(post_save, sender=Like)
+def record_like(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record_engagement('likes', 1, instance.user_id, instance.post_id, instance.time_stamp)
+
+
+@receiver(post_save, sender=Comment)
+def record_comment(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record_engagement('comments', 1, instance.owner_id, instance.post_id, instance.created_at)
+
+
+@receiver(post_delete, sender=Like)
+def record_deleted_like(sender, instance, origin=None, **kwargs):
+    if not deleted_with_post(origin):
+        record_engagement('likes', -1, instance.user_id, instance.post_id, instance.time_stamp)
+
+
+@receiver(post_delete, sender=Comment)
+def record_deleted_comment(sender, instance, origin=None, **kwargs):
+    if not deleted_with_post(origin):
+        record_engagement('comments', -1, instance.owner_id, instance.post_id, instance.created_at)
+
+
+@receiver(m2m_changed, sender=Post.savers.through)
+def record_saves(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        #post.savers.clear() / user.saved_posts.clear() do not tell post_clear which rows they removed
+        rows = sender.objects.filter(**{instance._meta.model_name: instance})
+        instance._unsaved_ids = list(rows.values_list('post_id' if reverse else 'user_id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    ids = getattr(instance, '_unsaved_ids', []) if action == 'post_clear' else pk_set or []
+    sign = 1 if action == 'post_add' else -1
+    now = timezone.now()
+    for other_id in ids:
+        user_id, post_id = (instance.id, other_id) if reverse else (other_id, instance.id)
+        record_engagement('saves', sign, user_id, post_id, now)
+
+
+
+#published posts are listed under their tags for the "for you" feed (see personalization.py)
+
+@receiver(post_init, sender=Post)
+def remember_listed_status(sender, instance, **kwargs):
+    #read from __dict__: a deferred status must not cost a query per loaded post
+    instance._listed_status = instance.__dict__.get('status')
+
+
+@receiver(post_save, sender=Post)
+def list_post_under_tags(sender, instance, created, raw=False, **kwargs):
+    #only a status change moves the post in or out of the index, a new post has no tags yet (see list_tagged_post)
+    status = instance.__dict__.get('status')
+    if raw or created or status == instance._listed_status:
+        return
+    for_you.index_post(instance)
+    instance._listed_status = status
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def list_tagged_post(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add':
+        if reverse:
+            for post in Post.objects.filter(id__in=pk_set, status='PUBLISHED'):
+                for_you.index_tags(post, [instance.id])
+        else:
+            for_you.index_tags(instance, pk_set)
+    elif action == 'post_remove':
+        lookup = {'tag': instance, 'post_id__in': pk_set} if reverse else {'post': instance, 'tag_id__in': pk_set}
+        TagFeedEntry.objects.filter(**lookup).delete()
+    elif action == 'post_clear':
+        TagFeedEntry.objects.filter(**{'tag' if reverse else 'post': instance}).delete()
+
+
+
+#invalidate the anonymous response cache once the change is committed (see response_cache.py)
+
+OWNER_TTL = 24 * 3600
+
+
+def owner_of(post_id):
+    #a post never changes owner: memoized, so likes and comments deleted one by one (unlikes, replies
+    #of a deleted comment) do not cost a query each
+    return cache.get_or_set(
+        f'post_owner:{post_id}',
+        lambda: Post.objects.filter(id=post_id).values_list('owner_id', flat=True).first(),
+        OWNER_TTL,
+    )
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def expire_post_responses(sender, instance, **kwargs):
+    bump_versions_on_commit(*post_scopes(instance.id, instance.owner_id))
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def expire_tagged_post_responses(sender, instance, action, reverse, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        bump_versions_on_commit('tags')
+    else:
+        bump_versions_on_commit(*post_scopes(instance.id, instance.owner_id))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(tags_created)
+def expire_tag_responses(sender, **kwargs):
+    bump_versions_on_commit('tags')
+
+
+@receiver(post_save, sender=Like)
+@receiver(post_delete, sender=Like)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def expire_engagement_responses(sender, instance, origin=None, **kwargs):
+    if deleted_with_post(origin):
+        return
+    #likes and comments change the counters shown with the post (created with their post: no query for its owner)
+    owner_id = instance.post.owner_id if sender.post.is_cached(instance) else owner_of(instance.post_id)
+    bump_versions_on_commit(*post_scopes(instance.post_id, owner_id))
+
+
+@receiver(post_save, sender=User)
+def expire_author_responses(sender, instance, created, **kwargs):
+    #author names are shown with every post of the user
+    if not created and instance._renamed:
+        post_ids = instance.posts.values_list('id', flat=True)
+        bump_versions_on_commit('posts', f'user_posts:{instance.id}', *[f'post:{post_id}' for post_id in post_ids])
+
+
+
+#keep updated_at current when something shown with a post changes outside Post.save() (see conditional.py)
+
+def touch_posts(post_ids):
+    Post.objects.filter(id__in=list(post_ids)).update(updated_at=timezone.now())
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+@receiver(m2m_changed, sender=Post.savers.through)
+def touch_related_posts(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        #tag.posts.clear() / user.saved_posts.clear()
+        lookup = {instance._meta.model_name: instance}
+        instance._touched_post_ids = list(sender.objects.filter(**lookup).values_list('post_id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        touch_posts([instance.id])
+    elif action == 'post_clear':
+        touch_posts(getattr(instance, '_touched_post_ids', []))
+    else:
+        touch_posts(pk_set or [])
+
+
+@receiver(post_save, sender=Tag)
+def touch_renamed_tag_posts(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw and instance._renamed:
+        touch_posts(instance.posts.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def touch_untagged_posts(sender, instance, **kwargs):
+    touch_posts(getattr(instance, '_deleted_post_ids', []))
+
+
+@receiver(post_save, sender=User)
+def touch_author_content(sender, instance, created, raw=False, **kwargs):
+    #the author is shown with each of their posts and comments
+    if not created and not raw and instance._renamed:
+        now = timezone.now()
+        instance.posts.update(updated_at=now)
+        instance.comments.update(updated_at=now)
@@ -1,10 +1,9 @@
 from rest_framework.decorators import api_view,permission_classes
 from rest_framework.permissions import IsAuthenticated
 from django.shortcuts import get_object_or_404
-from .models import Post,User,PostView,Like,Comment
+from .models import Post
 from rest_framework.response import Response
-from django.db.models import Count
-from django.db.models.functions import ExtractYear, ExtractMonth
+from .rollups import monthly_stats
 
 @api_view(['GET'])
 #@permission_classes([IsAuthenticated])
@@ -15,66 +14,19 @@ def get_post_statistics(request,post_id:int):
     # if post.status != 'PUBLISHED':
     #     return Response('this post has not been published yet',400)
     
-    monthly_views = PostView.objects.filter(post_id=post_id).annotate(
-        year=ExtractYear('timestamp'),
-        month=ExtractMonth('timestamp')
-    ).values('year', 'month').annotate(
-        view_count=Count('id')
-    ).order_by('year', 'month')
-
-    monthly_comments = Comment.objects.filter(post_id=post_id).annotate(
-        year=ExtractYear('created_at'),
-        month=ExtractMonth('created_at')
-    ).values('year', 'month').annotate(
-        comment_count=Count('id')
-    ).order_by('year', 'month')
-
-    monthly_likes = Like.objects.filter(post_id=post_id).annotate(
-        year=ExtractYear('time_stamp'),
-        month=ExtractMonth('time_stamp')
-    ).values('year', 'month').annotate(
-        like_count=Count('id')
-    ).order_by('year', 'month')
+    #rolled up days + the raw tail of today (see rollups.py)
+    monthly = monthly_stats(post_id=post_id)
 
     result = {}
-    for item in monthly_views:
-        index = str(item['year'])+'-'+str(item['month'])
-        if not index in result:
-            result[index] = {
-                "views": 0,
-                "comments": 0,
-                "likes" : 0
-            }
-        inst = result[index]
-        inst['views'] = item['view_count']
-    
-    for item in monthly_likes:
-        index = str(item['year'])+'-'+str(item['month'])
-        if not index in result:
-            result[index] = {
-                "views": 0,
-                "comments": 0,
-                "likes" : 0
-            }
-        inst = result[index]
-        inst['likes'] = item['like_count']
-
-    for item in monthly_comments:
-        index = str(item['year'])+'-'+str(item['month'])
-        if not index in result:
-            result[index] = {
-                "views": 0,
-                "comments": 0,
-                "likes" : 0
-            }
-        inst = result[index]
-        inst['comments'] = item['comment_count']
+    for (year, month), counts in monthly.items():
+        index = str(year)+'-'+str(month)
+        result[index] = counts
     
     return Response({
         'detailed_stats':result,
-        'total_views' : sum(item['view_count'] for item in monthly_views),
-        'total_likes': sum(item['like_count'] for item in monthly_likes),
-        'total_comments': sum(item['comment_count'] for item in monthly_comments),
+        'total_views' : sum(item['views'] for item in monthly.values()),
+        'total_likes': sum(item['likes'] for item in monthly.values()),
+        'total_comments': sum(item['comments'] for item in monthly.values()),
     })
 
 
@@ -84,70 +36,20 @@ def get_user_statistics(request):
     # Get all published posts owned by the user
     user_posts = Post.objects.filter(owner=request.user, status='PUBLISHED')
     
-    # Get post IDs for filtering
-    post_ids = user_posts.values_list('id', flat=True)
-    
-    # Get monthly views for all user's posts
-    monthly_views = PostView.objects.filter(post_id__in=post_ids).annotate(
-        year=ExtractYear('timestamp'),
-        month=ExtractMonth('timestamp')
-    ).values('year', 'month').annotate(
-        view_count=Count('id')
-    ).order_by('year', 'month')
-
-    # Get monthly comments for all user's posts
-    monthly_comments = Comment.objects.filter(post_id__in=post_ids).annotate(
-        year=ExtractYear('created_at'),
-        month=ExtractMonth('created_at')
-    ).values('year', 'month').annotate(
-        comment_count=Count('id')
-    ).order_by('year', 'month')
-
-    # Get monthly likes for all user's posts
-    monthly_likes = Like.objects.filter(post_id__in=post_ids).annotate(
-        year=ExtractYear('time_stamp'),
-        month=ExtractMonth('time_stamp')
-    ).values('year', 'month').annotate(
-        like_count=Count('id')
-    ).order_by('year', 'month')
+    # Monthly views, likes and comments of the user's posts, read from the daily rollup
+    monthly = monthly_stats(post__owner=request.user, post__status='PUBLISHED')
 
     # Combine the data
     result = {}
-    for item in monthly_views:
-        index = f"{item['year']}-{item['month']:02d}"
-        if index not in result:
-            result[index] = {
-                "views": 0,
-                "comments": 0,
-                "likes": 0
-            }
-        result[index]['views'] = item['view_count']
-    
-    for item in monthly_likes:
-        index = f"{item['year']}-{item['month']:02d}"
-        if index not in result:
-            result[index] = {
-                "views": 0,
-                "comments": 0,
-                "likes": 0
-            }
-        result[index]['likes'] = item['like_count']
-
-    for item in monthly_comments:
-        index = f"{item['year']}-{item['month']:02d}"
-        if index not in result:
-            result[index] = {
-                "views": 0,
-                "comments": 0,
-                "likes": 0
-            }
-        result[index]['comments'] = item['comment_count']
+    for (year, month), counts in monthly.items():
+        index = f"{year}-{month:02d}"
+        result[index] = counts
     
     # Calculate additional statistics
     total_posts = user_posts.count()
-    total_views = sum(item['view_count'] for item in monthly_views)
-    total_likes = sum(item['like_count'] for item in monthly_likes)
-    total_comments = sum(item['comment_count'] for item in monthly_comments)
+    total_views = sum(item['views'] for item in monthly.values())
+    total_likes = sum(item['likes'] for item in monthly.values())
+    total_comments = sum(item['comments'] for item in monthly.values())
     
     # Calculate averages per post
     avg_views_per_post = total_views / total_posts if total_posts > 0 else 0
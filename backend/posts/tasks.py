@@ -0,0 +1,86 @@
+import logging
+
+from celery import current_app, shared_task
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from kombu.exceptions import OperationalError
+from .email import deliver_outbox, prune_outbox
+from .images import build_variants
+from .personalization import for_you
+from .related import related_posts
+from .rollups import roll_up
+from .trending import trending_scores
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task()
+def roll_up_post_stats():
+    return roll_up()
+
+
+@shared_task()
+def decay_post_scores():
+    return trending_scores.decay()
+
+
+@shared_task()
+def refresh_related_posts():
+    return related_posts.refresh()
+
+
+@shared_task()
+def rebuild_related_posts():
+    return related_posts.rebuild()
+
+
+@shared_task()
+def rebuild_for_you_feed():
+    affinities, entries = for_you.rebuild()
+    return {'affinities': affinities, 'entries': entries}
+
+
+@shared_task()
+def deliver_outbox_mail():
+    sent, failed = deliver_outbox()
+    return {'sent': sent, 'failed': failed}
+
+
+@shared_task()
+def prune_outbox_mail():
+    return prune_outbox()
+
+
+@shared_task()
+def build_image_variants(model_label, pk, image_field, variants_field, image_name=None):
+    #image_name: the upload the task was queued for, a task outrun by a newer upload has nothing to do
+    instance = apps.get_model(model_label).objects.filter(pk=pk).first()
+    if instance is None or (image_name is not None and getattr(instance, image_field).name != image_name):
+        return False
+    return build_variants(instance, image_field, variants_field)
+
+
+def send(task, *args):
+    """
+    queue the task, False when the broker can not be reached
+    a single connection attempt: delay() retries the publish for about 20s before giving up
+    """
+    try:
+        with current_app.connection_for_write() as connection:
+            connection.ensure_connection(max_retries=1, interval_start=0)
+            task.apply_async(args, connection=connection, retry=False)
+    except OperationalError:
+        logger.warning('could not queue %s, the broker is unreachable', task.name, exc_info=True)
+        return False
+    return True
+
+
+def schedule_image_variants(instance, image_field, variants_field):
+    #resizing runs in the celery worker, in the request when IMAGE_VARIANTS_IN_WORKER is turned off
+    #or the broker is down (the upload itself is already committed by then)
+    if settings.IMAGE_VARIANTS_IN_WORKER:
+        args = (instance._meta.label, instance.pk, image_field, variants_field, getattr(instance, image_field).name)
+        transaction.on_commit(lambda: send(build_image_variants, *args) or build_image_variants(*args))
+    else:
+        build_variants(instance, image_field, variants_field)
@@ -1,3 +1,1648 @@
-from django.test import TestCase
+import json
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from base64 import urlsafe_b64encode
+from collections import defaultdict
+from concurrent.futures import Future
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.cache import cc_delim_re
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+from users.models import Profile
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:   #a development dependency (requirements.txt)
+    Controller = None
+
+from . import email
+from .checks import check_shared_cache
+from .images import build_variants
+from .ingestion import ViewBuffer, engagement_buffer, view_buffer
+from .metrics import QUERY_BUCKETS, render_metrics
+from .models import Comment, Like, OutboxMail, Post, PostScore, PostVector, PostView, RelatedPost, RollupWatermark, SearchDocument, SearchPosting, Tag, TagAffinity
+from .pagination import KeysetPagination
+from .personalization import ForYouFeed, for_you
+from .related import RelatedPosts
+from .response_cache import get_versions
+from .rollups import COLUMNS, SOURCES, WATERMARK, monthly_stats, roll_up
+from .search import rebuild_index
+from .tags import resolve_tags
+from .tasks import build_image_variants, schedule_image_variants
+from .toggles import toggle
+from .trending import EPOCH, TrendingScores
+from .writer import WriteQueue, WriteTimeout
+
+#a SCAN of a table (or of a whole index) reads every row, SCAN CONSTANT ROW / SCAN (subquery-n) do not
+TABLE_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)(?!\(subquery)')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite syntax')
+class QueryPlanTests(TestCase):
+    """
+    Run the hot read paths (feeds, threads, likers, statistics) and fail when the plan of one of
+    their queries falls back to a full table scan, e.g. because an index was dropped or a filter
+    stopped matching one. The plans come from EXPLAIN QUERY PLAN of the SQL the views really sent.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='x')
+        cls.reader = User.objects.create_user(username='reader', password='x')
+        cls.tag = Tag.objects.create(name='python')
+        #bulk_create: no post_save, the summary task is not part of these tests
+        cls.post, cls.draft = Post.objects.bulk_create([
+            Post(owner=cls.author, title='published', content='text', status='PUBLISHED'),
+            Post(owner=cls.author, title='draft', content='text', status='DRAFT'),
+        ])
+        cls.post.tags.add(cls.tag)
+        cls.comment = Comment.objects.create(owner=cls.reader, post=cls.post, content='first')
+        Comment.objects.create(owner=cls.author, post=cls.post, content='reply', parent_comment=cls.comment)
+        Like.objects.create(user=cls.reader, post=cls.post)
+        #what the engagement buffer makes of the like once flushed
+        for_you.engage(cls.reader.id, [cls.post.id], 'likes')
+        PostView.objects.create(post=cls.post, viewer=cls.reader)
+        RollupWatermark.objects.create(name=WATERMARK, until=timezone.now() - timedelta(days=1))
+        PostScore.objects.bulk_create([PostScore(post=cls.draft, score=5.0)])
+        other, = Post.objects.bulk_create([Post(owner=cls.reader, title='related', content='text', status='PUBLISHED')])
+        RelatedPost.objects.create(post=cls.post, related=other, score=0.5)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+
+    def tearDown(self):
+        view_buffer.flush()
+
+    def cursor(self, row):
+        #the cursor KeysetPagination puts in a "next" link after `row`
+        paginator = KeysetPagination()
+        paginator.base_url = 'http://testserver/'
+        return paginator.encode_cursor(row, previous=False).split('cursor=')[1]
+
+    def plan(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoTableScan(self, path, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200, path)
+        selects = [query['sql'] for query in ctx.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertTrue(selects, path)
+        for sql in selects:
+            plan = self.plan(sql)
+            scans = [step for step in plan if TABLE_SCAN.match(step)]
+            self.assertFalse(scans, f'{path} scans a table:\n{sql}\n' + '\n'.join(plan))
+
+    def test_published_feed(self):
+        self.assertNoTableScan('/posts/')
+        self.assertNoTableScan('/posts/', cursor=self.cursor(self.post))
+
+    def test_published_feed_filters(self):
+        since = (timezone.now() - timedelta(days=7)).isoformat()
+        self.assertNoTableScan('/posts/', created_after=since)
+        self.assertNoTableScan('/posts/', created_after=since, created_before=timezone.now().isoformat())
+        self.assertNoTableScan('/posts/', tags='python')
+
+    def test_user_posts(self):
+        self.assertNoTableScan(f'/users/{self.author.id}/posts/')
+        self.assertNoTableScan(f'/users/{self.author.id}/posts/', cursor=self.cursor(self.post))
+
+    def test_post_detail(self):
+        self.assertNoTableScan(f'/posts/{self.post.id}/')
+
+    def test_comment_thread(self):
+        self.assertNoTableScan(f'/posts/{self.post.id}/comments/')
+        self.assertNoTableScan(f'/posts/{self.post.id}/comments/', cursor=self.cursor(self.comment))
+
+    def test_user_comments(self):
+        self.assertNoTableScan('/posts/user_comments/')
+        #the replies come from the reply map, whatever the number of comments on the page
+        reply = Comment.objects.create(owner=self.author, post=self.post, content='nested', parent_comment=self.comment.sub_comments.get())
+        with self.assertNumQueries(4):
+            results = self.client.get('/posts/user_comments/').data['results']
+        self.assertEqual(results[0]['sub_comments'][0]['sub_comments'][0]['id'], reply.id)
+
+    def test_likers(self):
+        self.assertNoTableScan(f'/posts/{self.post.id}/all_likes/')
+
+    def test_statistics(self):
+        self.assertNoTableScan(f'/posts/statistics/post_stats/{self.post.id}/')
+        self.client.force_authenticate(self.author)
+        self.assertNoTableScan('/posts/statistics/')
+
+    def test_trending(self):
+        self.assertNoTableScan('/posts/trending/')
+        self.client.force_authenticate(None)
+        self.assertNoTableScan('/posts/trending/', limit=5)
+
+    def test_for_you(self):
+        #the reader's like gave them an affinity with the post's tag
+        self.assertTrue(TagAffinity.objects.filter(user=self.reader, tag=self.tag, weight__gt=0).exists())
+        self.assertNoTableScan('/posts/for_you/')
+        self.assertNoTableScan('/posts/for_you/', page=2)
+
+    def test_related_posts(self):
+        self.assertNoTableScan(f'/posts/{self.post.id}/related/')
+
+
+
+
+class FeedQueryCountTests(TestCase):
+    """
+    a page of posts costs the same number of queries whatever its size (Post.objects.for_feed)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        owners = [User.objects.create_user(username=f'author{n}', password='x') for n in range(3)]
+        cls.author = owners[0]
+        cls.reader = User.objects.create_user(username='reader', password='x')
+        tags = [Tag.objects.create(name=name) for name in ('python', 'django', 'sqlite')]
+        cls.posts = Post.objects.bulk_create([
+            Post(owner=owners[n % 3] if n % 2 else cls.author, title=f'post {n}', content='text', status='PUBLISHED')
+            for n in range(14)
+        ])
+        for n, post in enumerate(cls.posts):
+            post.tags.add(tags[n % 3], tags[(n + 1) % 3])
+        Like.objects.bulk_create([Like(user=cls.reader, post=post) for post in cls.posts[::2]])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.addCleanup(view_buffer.flush)
+
+    def queries(self, path, page_size):
+        #from the database, not from the anonymous response cache
+        cache.clear()
+        with mock.patch.object(KeysetPagination, 'page_size', page_size), CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200, path)
+        self.assertEqual(len(response.data['results']), page_size, path)
+        return len(queries)
+
+    def assertConstant(self, path):
+        self.assertEqual(self.queries(path, 2), self.queries(path, 7), path)
+
+    def test_published_feed(self):
+        self.assertConstant('/posts/')
+        self.client.force_authenticate(self.reader)
+        self.assertConstant('/posts/')
+
+    def test_user_posts(self):
+        self.client.force_authenticate(self.reader)
+        self.assertConstant(f'/users/{self.author.id}/posts/')
+
+    def test_saved_posts(self):
+        self.client.force_authenticate(self.reader)
+        self.reader.saved_posts.add(*self.posts[:2])
+        with CaptureQueriesContext(connection) as few:
+            self.assertEqual(len(self.client.get('/posts/saved_posts/').data), 2)
+        self.reader.saved_posts.add(*self.posts[2:])
+        with CaptureQueriesContext(connection) as many:
+            self.assertEqual(len(self.client.get('/posts/saved_posts/').data), len(self.posts))
+        self.assertEqual(len(few), len(many))
+
+
+
+class SearchPaginationTests(TestCase):
+    """
+    searched posts come best match first, the cursor pages on (search_rank, id)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(username='author', password='x')
+        #the more often "django" comes up in a post the better it ranks, two posts tie
+        cls.posts = Post.objects.bulk_create([
+            Post(owner=author, title=f'post {n}', content='django ' * count + 'filler ' * 20, status='PUBLISHED')
+            for n, count in enumerate([1, 5, 3, 3, 8, 2])
+        ])
+        Post.objects.bulk_create([Post(owner=author, title='other', content='flask', status='PUBLISHED')])
+        rebuild_index()
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        patcher = mock.patch.object(KeysetPagination, 'page_size', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pages(self, params):
+        ids, url = [], '/posts/'
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            ids.append([post['id'] for post in response.data['results']])
+            url, params = response.data['next'], None
+        return ids, response
+
+    def test_best_match_first(self):
+        by_rank = sorted(self.posts, key=lambda post: (-post.content.count('django'), -post.id))
+        ids, last = self.pages({'search': 'django'})
+        self.assertEqual(sum(ids, []), [post.id for post in by_rank])
+
+        #and back from the last page
+        previous = self.client.get(last.data['previous'])
+        self.assertEqual([post['id'] for post in previous.data['results']], [post.id for post in by_rank][-4:-2])
+
+    def test_cursor_of_another_ordering(self):
+        newest = self.client.get('/posts/').data['next']
+        cursor = newest.split('cursor=')[1]
+        self.assertEqual(self.client.get('/posts/', {'search': 'django', 'cursor': cursor}).status_code, 404)
+
+
+
+
+class KeysetPaginationTests(TestCase):
+    """
+    pages follow each other on (created_at, id), rows sharing a timestamp are neither skipped nor repeated
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(username='author', password='x')
+        Post.objects.bulk_create([Post(owner=author, title=f'post {n}', content='text', status='PUBLISHED') for n in range(8)])
+        #five posts of the same instant, across page boundaries
+        same = timezone.now() - timedelta(hours=1)
+        ids = list(Post.objects.order_by('id').values_list('id', flat=True))
+        Post.objects.filter(id__in=ids[1:6]).update(created_at=same)
+        cls.newest_first = list(Post.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        patcher = mock.patch.object(KeysetPagination, 'page_size', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ids(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [post['id'] for post in response.data['results']]
+
+    def test_forward_and_back(self):
+        pages, response = [], self.client.get('/posts/')
+        pages.append(self.ids(response))
+        self.assertIsNone(response.data['previous'])
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            pages.append(self.ids(response))
+        self.assertEqual(sum(pages, []), self.newest_first)
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+
+        #and back to the first page, one page at a time
+        back = [pages[-1]]
+        while response.data['previous']:
+            response = self.client.get(response.data['previous'])
+            back.insert(0, self.ids(response))
+        self.assertEqual(back, pages)
+
+    def test_tampered_cursor(self):
+        def token(payload):
+            return urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+        for cursor in [
+            'not-a-cursor',
+            urlsafe_b64encode(b'\xff\xfe').decode(),
+            token({'c': 'yesterday', 'i': 1, 'p': 0}),
+            token({'c': timezone.now().isoformat(), 'i': 'x', 'p': 0}),
+            token({'c': timezone.now().isoformat(), 'i': 1}),
+            token(['c', 'i', 'p']),
+        ]:
+            response = self.client.get('/posts/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+            self.assertEqual(response.data['detail'], 'Invalid cursor')
+
+
+
+
+class LikersPaginationTests(TestCase):
+    """
+    the likers of a post, newest like first on (time_stamp, id), paged like the feeds
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(username='author', password='x')
+        readers = User.objects.bulk_create([User(username=f'reader{n}') for n in range(7)])
+        Profile.objects.bulk_create([Profile(user=reader, first_name=f'reader{n}', last_name='x') for n, reader in enumerate(readers)])
+        cls.post, = Post.objects.bulk_create([Post(owner=author, title='published', content='text', status='PUBLISHED', likes_count=7)])
+        likes = Like.objects.bulk_create([Like(user=reader, post=cls.post) for reader in readers])
+        #four likes of the same instant, across page boundaries
+        Like.objects.filter(id__in=[like.id for like in likes[2:6]]).update(time_stamp=timezone.now() - timedelta(minutes=1))
+        cls.newest_first = list(
+            Like.objects.filter(post=cls.post).order_by('-time_stamp', '-id').values_list('user__profile__id', flat=True)
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        patcher = mock.patch.object(KeysetPagination, 'page_size', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ids(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total'], 7)
+        return [profile['id'] for profile in response.data['likers']]
+
+    def test_forward_and_back(self):
+        response = self.client.get(f'/posts/{self.post.id}/all_likes/')
+        pages = [self.ids(response)]
+        self.assertIsNone(response.data['previous'])
+        while response.data['next']:
+            with self.assertNumQueries(2):
+                response = self.client.get(response.data['next'])
+            pages.append(self.ids(response))
+        self.assertEqual(sum(pages, []), self.newest_first)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+
+        back = [pages[-1]]
+        while response.data['previous']:
+            response = self.client.get(response.data['previous'])
+            back.insert(0, self.ids(response))
+        self.assertEqual(back, pages)
+
+    def test_unknown_post_and_bad_cursor(self):
+        self.assertEqual(self.client.get(f'/posts/{self.post.id + 1000}/all_likes/').status_code, 404)
+        self.assertEqual(self.client.get(f'/posts/{self.post.id}/all_likes/', {'cursor': 'tampered'}).status_code, 404)
+
+
+
+class ResolveTagsTests(TestCase):
+    """
+    tag names are matched with the database's own lowering, the one of the unique index
+    """
+
+    def test_non_ascii_names(self):
+        economy = Tag.objects.create(name='Économie')
+        python = Tag.objects.create(name='python')
+        tags, created = resolve_tags(['Économie', 'PYTHON'])
+        self.assertEqual({tag.id for tag in tags}, {economy.id, python.id})
+        self.assertEqual(created, 0)
+        self.assertEqual(Tag.objects.count(), 2)
+
+    def test_created_count(self):
+        Tag.objects.create(name='python')
+        tags, created = resolve_tags(['Python', 'Django', 'Société', ' ', 'django'])
+        self.assertEqual(sorted(tag.name for tag in tags), ['Django', 'Société', 'python'])
+        self.assertEqual(created, 2)
+        self.assertEqual(resolve_tags(['Société', 'DJANGO'])[1], 0)
+
+
+
+class AuthorRenameTests(TestCase):
+    """
+    the author's posts are re-indexed, touched and expired when a displayed name changes, and only then
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='x', first_name='Ada')
+        cls.post, = Post.objects.bulk_create([Post(owner=cls.author, title='published', content='text', status='PUBLISHED')])
+        rebuild_index()
+
+    def test_login_touches_nothing(self):
+        author = User.objects.get(id=self.author.id)
+        updated_at = Post.objects.get(id=self.post.id).updated_at
+        with self.captureOnCommitCallbacks() as callbacks, self.assertNumQueries(1):
+            author.last_login = timezone.now()
+            author.save(update_fields=['last_login'])
+        with self.assertNumQueries(1):
+            author.set_unusable_password()
+            author.save()
+        self.assertEqual(callbacks, [])
+        self.assertEqual(Post.objects.get(id=self.post.id).updated_at, updated_at)
+
+    def test_rename(self):
+        author = User.objects.get(id=self.author.id)
+        updated_at = Post.objects.get(id=self.post.id).updated_at
+        author.first_name = 'Grace'
+        with self.captureOnCommitCallbacks() as callbacks:
+            author.save()
+        self.assertTrue(callbacks)
+        self.assertGreater(Post.objects.get(id=self.post.id).updated_at, updated_at)
+        terms = set(SearchPosting.objects.filter(post=self.post).values_list('term', flat=True))
+        self.assertIn('grace', terms)
+        self.assertNotIn('ada', terms)
+
+
+
+
+class TagRenameTests(TestCase):
+    """
+    a renamed tag moves the postings of its posts in place: the index ends up as a full re-index would leave it
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(username='author', password='x')
+        cls.tag, cls.other = Tag.objects.bulk_create([Tag(name='python tips'), Tag(name='web')])
+        cls.posts = Post.objects.bulk_create([
+            Post(owner=author, title=f'post {i}', content='django tips for the web', status='PUBLISHED') for i in range(12)
+        ])
+        through = Post.tags.through
+        through.objects.bulk_create(
+            [through(post_id=post.id, tag_id=cls.tag.id) for post in cls.posts]
+            + [through(post_id=post.id, tag_id=cls.other.id) for post in cls.posts[::2]]
+        )
+        rebuild_index()
+
+    def index(self):
+        return (
+            set(SearchPosting.objects.values_list('post_id', 'term', 'frequency', 'doc_length')),
+            set(SearchDocument.objects.values_list('post_id', 'length')),
+        )
+
+    def rename(self, name):
+        tag = Tag.objects.get(id=self.tag.id)
+        tag.name = name
+        with CaptureQueriesContext(connection) as queries:
+            tag.save()
+        return len(queries)
+
+    def test_rename_matches_a_full_reindex(self):
+        for name in ['Web Django', 'django', 'tips tips tips', 'Python']:
+            self.rename(name)
+            index = self.index()
+            rebuild_index()
+            self.assertEqual(index, self.index(), name)
+
+    def test_rename_costs_the_same_for_any_number_of_posts(self):
+        queries = self.rename('web django')
+        Post.tags.through.objects.filter(tag=self.tag, post__in=self.posts[4:]).delete()
+        rebuild_index()
+        self.assertEqual(self.rename('python tips'), queries)
+
+    def test_unchanged_name_touches_nothing(self):
+        tag = Tag.objects.get(id=self.tag.id)
+        with self.captureOnCommitCallbacks() as callbacks, self.assertNumQueries(1):
+            tag.save()
+        #the tag list is still expired, nothing else
+        self.assertEqual(len(callbacks), 1)
+
+
+def png_file(name='pic.png', size=(400, 300)):
+    buffer = BytesIO()
+    Image.new('RGB', size, 'teal').save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class ImageVariantsTests(TestCase):
+    """
+    variants are built by the worker by default, a task (or a resize) outrun by a newer upload writes nothing
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='x')
+        cls.post, = Post.objects.bulk_create([Post(owner=cls.author, title='published', content='text', status='PUBLISHED')])
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        override = self.settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def upload(self, post, name):
+        post.image = png_file(name)
+        post.save()
+        return post.image.name
+
+    @override_settings(IMAGE_VARIANTS_IN_WORKER=True)
+    def test_queued_for_the_worker(self):
+        post = Post.objects.get(id=self.post.id)
+        name = self.upload(post, 'first.png')
+        with mock.patch.object(build_image_variants, 'apply_async') as apply_async, mock.patch('posts.tasks.current_app.connection_for_write'):
+            with self.captureOnCommitCallbacks(execute=True):
+                schedule_image_variants(post, 'image', 'image_variants')
+                apply_async.assert_not_called()
+        self.assertEqual(apply_async.call_args.args[0], ('posts.Post', post.id, 'image', 'image_variants', name))
+        self.assertEqual(Post.objects.get(id=post.id).image_variants, {})
+
+    @override_settings(IMAGE_VARIANTS_IN_WORKER=True)
+    def test_built_in_the_request_when_the_broker_is_down(self):
+        post = Post.objects.get(id=self.post.id)
+        self.upload(post, 'first.png')
+        #nothing listens on port 1
+        with mock.patch.dict(os.environ, {'CELERY_BROKER_WRITE_URL': 'redis://127.0.0.1:1/0'}):
+            started = time.monotonic()
+            with self.assertLogs('posts.tasks', 'WARNING'), self.captureOnCommitCallbacks(execute=True):
+                schedule_image_variants(post, 'image', 'image_variants')
+            self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(set(Post.objects.get(id=post.id).image_variants), {'thumb', 'card', 'full'})
+
+    def test_task_builds_the_variants(self):
+        name = self.upload(Post.objects.get(id=self.post.id), 'first.png')
+        self.assertTrue(build_image_variants('posts.Post', self.post.id, 'image', 'image_variants', name))
+        variants = Post.objects.get(id=self.post.id).image_variants
+        self.assertEqual(set(variants), {'thumb', 'card', 'full'})
+        self.assertTrue(default_storage.exists(variants['thumb']['webp']))
+
+    def test_stale_task_does_nothing(self):
+        post = Post.objects.get(id=self.post.id)
+        first = self.upload(post, 'first.png')
+        self.upload(post, 'second.png')
+        self.assertFalse(build_image_variants('posts.Post', post.id, 'image', 'image_variants', first))
+        self.assertEqual(Post.objects.get(id=post.id).image_variants, {})
+
+    def test_image_replaced_during_the_resize(self):
+        stale = Post.objects.get(id=self.post.id)
+        self.upload(stale, 'first.png')
+        #another request uploads a new image while `stale` is being resized
+        self.upload(Post.objects.get(id=self.post.id), 'second.png')
+        self.assertFalse(build_variants(stale, 'image', 'image_variants'))
+        self.assertEqual(Post.objects.get(id=self.post.id).image_variants, {})
+        #the variants of the replaced image are not left behind
+        self.assertEqual(default_storage.listdir('post_images/variants')[1], [])
+
+
+
+class EngagementTests(TestCase):
+    """
+    a like only writes its own rows, scores and affinities follow when the engagement buffer is flushed
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='x')
+        cls.reader = User.objects.create_user(username='reader', password='x')
+        Profile.objects.create(user=cls.author, accept_notifications=False)
+        cls.tag = Tag.objects.create(name='python')
+        cls.post, = Post.objects.bulk_create([Post(owner=cls.author, title='published', content='text', status='PUBLISHED')])
+        cls.post.tags.add(cls.tag)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+        self.addCleanup(engagement_buffer.flush)
+
+    def like(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/posts/{self.post.id}/like/')
+
+    def affinity(self):
+        return TagAffinity.objects.filter(user=self.reader, tag=self.tag).values_list('weight', flat=True).first()
+
+    def test_like_and_unlike(self):
+        pending = engagement_buffer.stats()['pending']
+        response = self.like()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['likes_count'], 1)
+        self.assertEqual(engagement_buffer.stats()['pending'], pending + 1)
+        self.assertFalse(PostScore.objects.filter(post=self.post).exists())
+
+        engagement_buffer.flush()
+        self.assertGreater(PostScore.objects.get(post=self.post).score, 0)
+        self.assertEqual(self.affinity(), for_you.weights['likes'])
+
+        response = self.like()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['likes_count'], 0)
+        engagement_buffer.flush()
+        self.assertAlmostEqual(PostScore.objects.get(post=self.post).score, 0)
+        self.assertEqual(self.affinity(), 0)
+
+    def test_counter_moved_by_the_view_both_ways(self):
+        #one UPDATE in either direction, and the count comes back from it rather than from a re-read of the post
+        for status in (201, 200):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.like().status_code, status)
+            post_queries = [query['sql'] for query in queries if '"posts_post"' in query['sql'].split('WHERE')[0]]
+            self.assertEqual(sum(sql.startswith('UPDATE "posts_post" SET "likes_count"') for sql in post_queries), 1)
+            self.assertTrue(post_queries[-1].startswith('UPDATE'))
+
+    def test_likes_of_a_deleted_user_are_uncounted(self):
+        self.like()
+        engagement_buffer.flush()
+        self.reader.delete()
+        self.assertEqual(Post.objects.get(id=self.post.id).likes_count, 0)
+
+    def test_rolled_back_like_is_not_buffered(self):
+        pending = engagement_buffer.stats()['pending']
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Like.objects.create(user=self.reader, post=self.post)
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(engagement_buffer.stats()['pending'], pending)
+
+    def test_toggle_only_swallows_the_unique_constraint(self):
+        with self.assertRaises(IntegrityError):
+            toggle(Like, post=self.post, user_id=None)
+        self.assertTrue(toggle(Like, post=self.post, user_id=self.reader.id))
+        self.assertFalse(toggle(Like, post=self.post, user_id=self.reader.id))
+        self.assertFalse(Like.objects.exists())
+
+
+
+
+
+class ViewBufferTests(TestCase):
+    """
+    views are written once enough of them wait, dropped (and counted) when the buffer is full
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='x')
+        cls.post, = Post.objects.bulk_create([Post(owner=cls.author, title='published', content='text', status='PUBLISHED')])
+
+    def view(self, post_id=None):
+        return PostView(post_id=post_id or self.post.id, ip_address='127.0.0.1')
+
+    def test_flushed_once_flush_size_is_reached(self):
+        buffer = ViewBuffer(max_size=10, flush_size=3, flush_interval=60, background=False)
+        buffer.add(self.view())
+        buffer.add(self.view())
+        self.assertFalse(PostView.objects.exists())
+        buffer.add(self.view())
+        self.assertEqual(PostView.objects.count(), 3)
+        self.assertEqual(Post.objects.get(id=self.post.id).views_count, 3)
+        self.assertEqual(buffer.stats(), {'pending': 0, 'accepted': 3, 'dropped': 0, 'flushed': 3, 'failed': 0})
+
+    def test_dropped_when_full(self):
+        buffer = ViewBuffer(max_size=2, flush_size=10, flush_interval=60, background=False)
+        self.assertEqual([buffer.add(self.view()) for _ in range(3)], [True, True, False])
+        self.assertEqual(buffer.stats()['dropped'], 1)
+        with self.assertLogs('posts.ingestion', 'WARNING') as logs:
+            self.assertEqual(buffer.flush(), 2)
+        self.assertIn('dropped 1 events', logs.output[0])
+
+    def test_views_of_a_deleted_post_are_dropped_on_retry(self):
+        buffer = ViewBuffer(max_size=10, flush_size=10, flush_interval=60, background=False)
+        insert_now = buffer._insert_now
+        posts = set(Post.objects.values_list('id', flat=True))
+
+        def foreign_keys_checked(events):
+            #sqlite only checks the deferred foreign keys on commit, after the test's transaction
+            if any(view.post_id not in posts for view in events):
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            insert_now(events)
+
+        buffer.add(self.view())
+        buffer.add(self.view(post_id=self.post.id + 1000))
+        with mock.patch.object(buffer, '_insert_now', side_effect=foreign_keys_checked) as insert:
+            self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(insert.call_count, 2)
+        self.assertEqual(list(PostView.objects.values_list('post_id', flat=True)), [self.post.id])
+        self.assertEqual(buffer.stats()['failed'], 1)
+
+    def test_served_by_metrics(self):
+        self.assertIn('inksmart_buffer_events_total{buffer="views",outcome="dropped"}', render_metrics())
+        self.assertIn('inksmart_buffer_pending{buffer="engagements"}', render_metrics())
+
+
+
+
+
+class PostDeleteTests(TestCase):
+    """
+    the likes and comments deleted with their post cost no queries of their own
+    """
+
+    def make_post(self, engaged):
+        author = User.objects.create_user(username=f'author{engaged}', password='x')
+        readers = User.objects.bulk_create([User(username=f'reader{engaged}-{i}') for i in range(engaged)])
+        tag = Tag.objects.create(name=f'tag{engaged}')
+        post, = Post.objects.bulk_create([Post(owner=author, title='published', content='text', status='PUBLISHED')])
+        post.tags.add(tag)
+        Like.objects.bulk_create([Like(user=reader, post=post) for reader in readers])
+        comments = Comment.objects.bulk_create([Comment(owner=reader, post=post, content='nice') for reader in readers])
+        Comment.objects.bulk_create([Comment(owner=author, post=post, content='thanks', parent_comment=comment) for comment in comments])
+        post.savers.add(*readers[:engaged // 2])
+        return Post.objects.get(id=post.id), readers, tag
+
+    def delete(self, post):
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            post.delete()
+        return len(queries)
+
+    def test_cost_does_not_grow_with_the_likes_and_comments(self):
+        #under 100 rows per table: django deletes the rows it collected 100 ids at a time
+        small = self.delete(self.make_post(6)[0])
+        post = self.make_post(45)[0]
+        with self.assertNumQueries(small):
+            with self.captureOnCommitCallbacks(execute=True):
+                post.delete()
+        self.assertFalse(Like.objects.exists())
+        self.assertFalse(Comment.objects.exists())
+
+    def test_affinities_are_taken_back_once(self):
+        post, readers, tag = self.make_post(4)
+        other, = Post.objects.bulk_create([Post(owner=post.owner, title='other', content='text', status='PUBLISHED')])
+        other.tags.add(tag)
+        Like.objects.create(user=readers[0], post=other)
+        for_you.rebuild()
+        weights = for_you.weights
+        self.assertEqual(
+            TagAffinity.objects.get(user=readers[0], tag=tag).weight,
+            2 * weights['likes'] + weights['comments'] + weights['saves'],
+        )
+        self.delete(post)
+        affinities = dict(TagAffinity.objects.filter(tag=tag).values_list('user_id', 'weight'))
+        self.assertEqual(affinities[readers[0].id], weights['likes'])
+        self.assertEqual(affinities[readers[3].id], 0)
+        #the author's replies
+        self.assertEqual(affinities[post.owner_id], 0)
+
+
+class RollupTests(TestCase):
+    """
+    rolled up days plus the raw tail count the same as the raw events, deletes included
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='x')
+        cls.readers = User.objects.bulk_create([User(username=f'reader{i}') for i in range(6)])
+        cls.first, cls.second = Post.objects.bulk_create([
+            Post(owner=cls.author, title=f'post {n}', content='text', status='PUBLISHED') for n in range(2)
+        ])
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.addCleanup(engagement_buffer.flush)
+
+    def ago(self, **delta):
+        return self.now - timedelta(**delta)
+
+    def engage(self, post, when, readers):
+        #a view, a like and a comment per reader at `when`
+        PostView.objects.bulk_create([PostView(post=post, timestamp=when) for _ in readers])
+        likes = Like.objects.bulk_create([Like(user=reader, post=post) for reader in readers])
+        comments = Comment.objects.bulk_create([Comment(owner=reader, post=post, content='hi') for reader in readers])
+        Like.objects.filter(id__in=[like.id for like in likes]).update(time_stamp=when)
+        Comment.objects.filter(id__in=[comment.id for comment in comments]).update(created_at=when)
+
+    def raw(self, **lookup):
+        #the monthly counts straight from the event tables
+        expected = defaultdict(lambda: dict.fromkeys(COLUMNS, 0))
+        for model, field, column in SOURCES:
+            for timestamp in model.objects.filter(**lookup).values_list(field, flat=True):
+                local = timezone.localtime(timestamp)
+                expected[(local.year, local.month)][column] += 1
+        return dict(sorted(expected.items()))
+
+    def assertMatchesRaw(self):
+        for lookup in ({'post_id': self.first.id}, {'post_id': self.second.id}, {'post__owner': self.author}):
+            self.assertEqual(monthly_stats(**lookup), self.raw(**lookup), lookup)
+
+    def test_rolled_up_days_plus_tail(self):
+        self.engage(self.first, self.ago(days=70), self.readers[:3])
+        self.engage(self.second, self.ago(days=40), self.readers[:2])
+        self.engage(self.first, self.ago(days=3), self.readers[3:5])
+        self.assertMatchesRaw()
+
+        self.assertGreater(roll_up(now=self.ago(days=2)), 0)
+        #the last events are only in the tail
+        self.engage(self.second, self.ago(hours=1), self.readers[2:6])
+        self.assertMatchesRaw()
+
+        #a second run adds to the days already rolled up
+        roll_up(now=self.now + timedelta(hours=1))
+        self.assertFalse(roll_up(now=self.now + timedelta(hours=1)))
+        self.assertMatchesRaw()
+
+    def test_forgotten_events(self):
+        self.engage(self.first, self.ago(days=40), self.readers[:4])
+        self.engage(self.first, self.ago(minutes=30), self.readers[4:])
+        roll_up(now=self.ago(days=1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            #rolled up, then in the tail
+            Like.objects.get(post=self.first, user=self.readers[0]).delete()
+            Comment.objects.filter(post=self.first, owner=self.readers[1]).get().delete()
+            Like.objects.get(post=self.first, user=self.readers[4]).delete()
+            Comment.objects.filter(post=self.first, owner=self.readers[5]).get().delete()
+        self.assertMatchesRaw()
+
+        roll_up(now=self.now + timedelta(hours=1))
+        self.assertMatchesRaw()
+
+
+
+class TrendingScoresTests(TestCase):
+    """
+    TrendingScores at a fixed now: one hour half-life, the epoch three hours back
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create_user(username='reader', password='x')
+        cls.first, cls.second, cls.draft = Post.objects.bulk_create([
+            Post(owner=cls.reader, title='first', content='text', status='PUBLISHED'),
+            Post(owner=cls.reader, title='second', content='text', status='PUBLISHED'),
+            Post(owner=cls.reader, title='draft', content='text', status='DRAFT'),
+        ])
+
+    def setUp(self):
+        cache.clear()
+        self.now = timezone.now().replace(microsecond=0)
+        RollupWatermark.objects.create(name=EPOCH, until=self.now - timedelta(hours=3))
+        self.scores = TrendingScores(half_life=3600, weights={'views': 1.0, 'likes': 5.0, 'comments': 10.0}, min_score=0.05)
+
+    def ago(self, **kwargs):
+        return self.now - timedelta(**kwargs)
+
+    def stored(self):
+        return dict(PostScore.objects.values_list('post_id', 'score'))
+
+    def test_add_decay_and_rebuild_agree(self):
+        PostView.objects.bulk_create([
+            PostView(post=self.first, timestamp=self.ago(hours=2)),
+            PostView(post=self.first, timestamp=self.ago(hours=1)),
+        ])
+        like = Like.objects.create(user=self.reader, post=self.second)
+        Like.objects.filter(id=like.id).update(time_stamp=self.ago(minutes=30))
+        self.scores.add([
+            (self.first.id, 'views', self.ago(hours=2)),
+            (self.first.id, 'views', self.ago(hours=1)),
+            (self.second.id, 'likes', self.ago(minutes=30)),
+        ])
+        expected = {self.first.id: 0.25 + 0.5, self.second.id: 5 * 2 ** -0.5}
+
+        self.assertEqual(self.scores.decay(self.now), 2)
+        for post_id, score in self.stored().items():
+            self.assertAlmostEqual(score, expected[post_id])
+        self.assertEqual(self.scores.rebuild(self.now), 2)
+        for post_id, score in self.stored().items():
+            self.assertAlmostEqual(score, expected[post_id])
+
+    def test_unlike_takes_the_like_back(self):
+        self.scores.add([(self.first.id, 'likes', self.ago(minutes=10)), (self.first.id, 'views', self.ago(minutes=10))])
+        self.scores.add([(self.first.id, 'likes', self.ago(minutes=10))], sign=-1)
+        self.scores.decay(self.now)
+        self.assertAlmostEqual(self.stored()[self.first.id], 2 ** (-10 / 60))
+
+        #taking back from a post without a score creates no row
+        self.scores.add([(self.second.id, 'likes', self.ago(minutes=5))], sign=-1)
+        self.assertNotIn(self.second.id, self.stored())
+
+    def test_old_epoch_is_moved_before_it_overflows(self):
+        #the decay beat stopped: the epoch is years (tens of thousands of half-lives) old
+        RollupWatermark.objects.filter(name=EPOCH).update(until=self.ago(days=3 * 365))
+        cache.clear()
+        self.scores.add([(self.first.id, 'likes', self.ago(days=400))])
+        self.scores.add([(self.second.id, 'likes', self.ago(minutes=30)), (self.first.id, 'views', self.ago(minutes=30))])
+        self.assertEqual(RollupWatermark.objects.get(name=EPOCH).until, self.ago(minutes=30))
+        self.assertEqual(self.stored(), {self.first.id: 1.0, self.second.id: 5.0})
+
+        self.assertEqual(self.scores.decay(self.now), 2)
+        self.assertAlmostEqual(self.stored()[self.second.id], 5 * 2 ** -0.5)
+
+    def test_decay_of_an_old_epoch(self):
+        self.scores.add([(self.first.id, 'likes', self.ago(minutes=10))])
+        RollupWatermark.objects.filter(name=EPOCH).update(until=self.ago(days=3 * 365))
+        self.assertEqual(self.scores.decay(self.now), 0)
+
+    def test_decayed_scores_are_pruned(self):
+        #5 hours: 2^-5 of a view is under MIN_SCORE, a like of the same age is not
+        PostView.objects.create(post=self.first, timestamp=self.ago(hours=5))
+        self.scores.add([(self.first.id, 'views', self.ago(hours=5)), (self.second.id, 'likes', self.ago(hours=5))])
+        self.assertEqual(self.scores.decay(self.now), 1)
+        self.assertEqual(list(self.stored()), [self.second.id])
+
+        self.assertEqual(self.scores.rebuild(self.now), 0)
+        self.assertEqual(self.stored(), {})
+
+    def test_top_skips_drafts(self):
+        PostScore.objects.bulk_create([
+            PostScore(post=self.draft, score=30),
+            PostScore(post=self.second, score=20),
+            PostScore(post=self.first, score=10),
+        ])
+        self.assertEqual(self.scores.top(1), [self.second.id])
+        self.assertEqual(self.scores.top(2), [self.second.id, self.first.id])
+        self.assertEqual(self.scores.top(5), [self.second.id, self.first.id])
+
+
+
+class ForYouFeedTests(TestCase):
+    """
+    ranking, page limits and the trending fallback of the "for you" feed (one hour half-life, 2 pages at most)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='x')
+        cls.reader = User.objects.create_user(username='reader', password='x')
+        cls.python, cls.cooking = Tag.objects.bulk_create([Tag(name='python'), Tag(name='cooking')])
+        posts = Post.objects.bulk_create([
+            Post(owner=cls.author, title=f'post {i}', content='text', status='PUBLISHED') for i in range(6)
+        ])
+        cls.posts = posts
+        now = timezone.now()
+        #post i is i hours old
+        for i, post in enumerate(posts):
+            Post.objects.filter(id=post.id).update(created_at=now - timedelta(hours=i))
+        through = Post.tags.through
+        through.objects.bulk_create(
+            [through(post_id=post.id, tag_id=cls.python.id) for post in posts[:4]]
+            + [through(post_id=post.id, tag_id=cls.cooking.id) for post in posts[3:]]
+        )
+        #the reader's own post is never suggested to them
+        cls.own, = Post.objects.bulk_create([Post(owner=cls.reader, title='own', content='text', status='PUBLISHED')])
+        through.objects.create(post_id=cls.own.id, tag_id=cls.python.id)
+
+    def setUp(self):
+        cache.clear()
+        self.feed = ForYouFeed(weights={'likes': 3.0, 'saves': 5.0, 'comments': 2.0}, tags=10, half_life=3600, max_pages=2)
+
+    def ids(self, *indexes):
+        return [self.posts[i].id for i in indexes]
+
+    def test_ranking(self):
+        #python: 3 (a like), cooking: 10 (two saves)
+        Like.objects.create(user=self.reader, post=self.posts[0])
+        self.posts[4].savers.add(self.reader)
+        self.posts[5].savers.add(self.reader)
+        self.feed.rebuild()
+        affinities = dict(TagAffinity.objects.filter(user=self.reader).values_list('tag_id', 'weight'))
+        self.assertEqual(affinities, {self.python.id: 3.0, self.cooking.id: 10.0})
+
+        post_ids, has_next = self.feed.page(self.reader, 1, 10)
+        #affinity of the matched tags halved per hour of age: post 3 (both tags) 13/8 ranks between
+        #post 0 (3) and post 1 (3/2), the cooking posts 4 and 5 (10/16, 10/32) come last
+        self.assertEqual(post_ids, self.ids(0, 3, 1, 2, 4, 5))
+        self.assertFalse(has_next)
+
+    def test_page_limits(self):
+        Like.objects.create(user=self.reader, post=self.posts[0])
+        self.feed.rebuild()
+        self.assertEqual(self.feed.page(self.reader, 1, 2), (self.ids(0, 1), True))
+        #more candidates left, but page 2 is the last one
+        self.assertEqual(self.feed.page(self.reader, 2, 2), (self.ids(2, 3), False))
+        self.assertEqual(self.feed.page(self.reader, 3, 2), ([], False))
+
+        client = APIClient()
+        client.force_authenticate(self.reader)
+        response = client.get('/posts/for_you/', {'page': for_you.max_pages + 1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_trending_fallback(self):
+        PostScore.objects.bulk_create([PostScore(post=self.posts[5], score=2), PostScore(post=self.posts[2], score=1)])
+        self.assertEqual(self.feed.page(self.reader, 1, 10), (self.ids(5, 2), False))
+
+    def test_rebuild_follows_retagged_posts(self):
+        Like.objects.create(user=self.reader, post=self.posts[0])
+        self.feed.engage(self.reader.id, [self.posts[0].id], 'likes')
+        self.posts[0].tags.set([self.cooking])
+        #taken back from the current tags, python keeps the weight of a like that is gone
+        Like.objects.filter(user=self.reader).delete()
+        self.feed.engage(self.reader.id, [self.posts[0].id], 'likes', sign=-1)
+        self.assertEqual(TagAffinity.objects.get(user=self.reader, tag=self.python).weight, 3.0)
+
+        self.feed.rebuild()
+        self.assertFalse(TagAffinity.objects.filter(user=self.reader).exists())
+
+
+class RelatedPostsTests(TestCase):
+    """
+    rebuild() and refresh() on a corpus of three topics (no term is in more than half of the posts)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(username='author', password='x')
+        texts = {
+            'orm': ('python django', 'queryset migrations models'),
+            'views': ('python django', 'serializers routers models'),
+            'pasta': ('italian cooking', 'tomato basil garlic'),
+            'risotto': ('italian cooking', 'rice parmesan garlic'),
+            'roses': ('gardening', 'pruning soil compost'),
+            'tulips': ('gardening', 'bulbs spring compost'),
+        }
+        posts = Post.objects.bulk_create([
+            Post(owner=author, title=title, content=content, status='PUBLISHED')
+            for title, content in texts.values()
+        ])
+        cls.posts = dict(zip(texts, posts))
+        rebuild_index()
+
+    def setUp(self):
+        cache.clear()
+        self.related = RelatedPosts(neighbours=2, max_terms=64, max_df=0.5, max_candidates=100, max_postings=100)
+        self.built_at = timezone.now()
+        self.related.rebuild(self.built_at)
+
+    def neighbours(self, name):
+        return [post.id for post in self.related.related(self.posts[name].id)]
+
+    def edit(self, name, **fields):
+        post = Post.objects.get(id=self.posts[name].id)
+        for field, value in fields.items():
+            setattr(post, field, value)
+        post.save()
+        return self.related.refresh(timezone.now() + timedelta(seconds=1))
+
+    def test_rebuild(self):
+        self.assertEqual(self.neighbours('orm'), [self.posts['views'].id])
+        self.assertEqual(self.neighbours('pasta'), [self.posts['risotto'].id])
+        self.assertEqual(self.neighbours('tulips'), [self.posts['roses'].id])
+        self.assertEqual(PostVector.objects.count(), len(self.posts))
+
+    def test_postings_are_capped(self):
+        vectors = dict(PostVector.objects.values_list('post_id', 'terms'))
+        capped = RelatedPosts(neighbours=2, max_terms=64, max_df=0.5, max_candidates=100, max_postings=1)
+        postings = capped.inverted_index(vectors)
+        self.assertEqual(max(len(posting) for posting in postings.values()), 1)
+        #the post kept for a term is the one weighing it the most
+        orm, views = vectors[self.posts['orm'].id], vectors[self.posts['views'].id]
+        strongest = self.posts['orm'].id if orm['python'] >= views['python'] else self.posts['views'].id
+        self.assertEqual(postings['python'], [(strongest, max(orm['python'], views['python']))])
+
+        #a cap above every term's posting list changes nothing
+        rows = sorted(RelatedPost.objects.values_list('post_id', 'related_id', 'score'))
+        RelatedPosts(neighbours=2, max_terms=64, max_df=0.5, max_candidates=100, max_postings=2).rebuild(self.built_at)
+        self.assertEqual(sorted(RelatedPost.objects.values_list('post_id', 'related_id', 'score')), rows)
+
+    def test_refresh_skips_unchanged_text(self):
+        vectors = dict(PostVector.objects.values_list('post_id', 'digest'))
+        rows = list(RelatedPost.objects.order_by('id').values_list('id', 'post_id', 'related_id', 'score'))
+        #a like moves updated_at, the text is the same
+        Post.objects.filter(id=self.posts['orm'].id).update(updated_at=self.built_at + timedelta(seconds=1))
+        self.assertEqual(self.related.refresh(self.built_at + timedelta(seconds=2)), 0)
+        self.assertEqual(dict(PostVector.objects.values_list('post_id', 'digest')), vectors)
+        self.assertEqual(list(RelatedPost.objects.order_by('id').values_list('id', 'post_id', 'related_id', 'score')), rows)
+
+    def test_edit_updates_the_lists_in_place(self):
+        row = RelatedPost.objects.get(post=self.posts['orm'], related=self.posts['views'])
+        self.assertEqual(self.edit('views', content='serializers routers models queryset'), 1)
+        updated = RelatedPost.objects.get(post=self.posts['orm'], related=self.posts['views'])
+        self.assertEqual(updated.id, row.id)
+        self.assertGreater(updated.score, row.score)
+        self.assertEqual(self.neighbours('views'), [self.posts['orm'].id])
+
+    def test_edit_moves_the_post_to_other_lists(self):
+        #pasta becomes a post about gardening
+        self.assertEqual(self.edit('pasta', title='gardening', content='pruning soil compost bulbs'), 1)
+        self.assertEqual(set(self.neighbours('pasta')), {self.posts['roses'].id, self.posts['tulips'].id})
+        self.assertEqual(self.neighbours('risotto'), [])
+        self.assertIn(self.posts['pasta'].id, self.neighbours('roses'))
+
+    def test_unpublished_post_leaves_every_list(self):
+        post = Post.objects.get(id=self.posts['views'].id)
+        post.status = 'DRAFT'
+        post.save()
+        self.assertEqual(self.related.refresh(timezone.now() + timedelta(seconds=1)), 1)
+        self.assertEqual(self.neighbours('orm'), [])
+        self.assertFalse(PostVector.objects.filter(post=post).exists())
+
+
+class PostsStateTests(TestCase):
+    """
+    POST /posts/state/: the viewer's flags and the counters of the posts asked for, in one query
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='x')
+        cls.reader = User.objects.create_user(username='reader', password='x')
+        cls.liked, cls.saved, cls.both, cls.draft = Post.objects.bulk_create([
+            Post(owner=cls.author, title='liked', content='text', status='PUBLISHED', likes_count=1),
+            Post(owner=cls.author, title='saved', content='text', status='PUBLISHED'),
+            Post(owner=cls.author, title='both', content='text', status='PUBLISHED', likes_count=1, comments_count=2),
+            Post(owner=cls.author, title='draft', content='text', status='DRAFT'),
+        ])
+        Like.objects.bulk_create([Like(user=cls.reader, post=cls.liked), Like(user=cls.reader, post=cls.both)])
+        cls.reader.saved_posts.add(cls.saved, cls.both)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+
+    def state(self, post_ids, client=None):
+        return (client or self.client).post('/posts/state/', {'post_ids': post_ids}, format='json')
+
+    def test_mixed_state(self):
+        with self.assertNumQueries(1):
+            response = self.state([self.both.id, self.liked.id, self.saved.id])
+        self.assertEqual(response.status_code, 200)
+        flags = [(row['id'], row['is_liked'], row['is_saved']) for row in response.data['results']]
+        self.assertEqual(flags, [
+            (self.both.id, True, True),
+            (self.liked.id, True, False),
+            (self.saved.id, False, True),
+        ])
+        self.assertEqual(response.data['results'][0]['comments_count'], 2)
+
+    def test_unknown_and_hidden_posts_left_out(self):
+        response = self.state([self.saved.id + 1000, self.draft.id, self.saved.id, self.saved.id])
+        self.assertEqual([row['id'] for row in response.data['results']], [self.saved.id])
+
+        #the author sees their own draft
+        author = APIClient()
+        author.force_authenticate(self.author)
+        response = self.state([self.draft.id], author)
+        self.assertEqual([row['id'] for row in response.data['results']], [self.draft.id])
+
+    def test_anonymous_flags_are_false(self):
+        response = self.state([self.both.id], APIClient())
+        self.assertEqual(response.status_code, 200)
+        row, = response.data['results']
+        self.assertEqual((row['is_liked'], row['is_saved'], row['likes_count']), (False, False, 1))
+
+    def test_request_size(self):
+        self.assertEqual(self.state(list(range(1, 501))).status_code, 200)
+        response = self.state(list(range(1, 502)))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('post_ids', response.data)
+        self.assertEqual(self.state([]).status_code, 400)
+        self.assertEqual(self.state(['x']).status_code, 400)
+
+
+
+class MetricsTests(TestCase):
+    """
+    every response carries its Server-Timing, /metrics serves the histograms in the Prometheus text format
+    """
+    SAMPLE = re.compile(r'^[a-z_]+(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})? -?[0-9.e+-]+$')
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(username='author', password='x')
+        Post.objects.bulk_create([Post(owner=author, title='published', content='text', status='PUBLISHED')])
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/posts/')
+        timing = dict(entry.split(';', 1) for entry in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'db', 'serializer', 'total'})
+        self.assertRegex(timing['db'], rf'^dur=[0-9.]+;desc="{len(queries)} queries"$')
+        self.assertRegex(timing['total'], r'^dur=[0-9.]+$')
+        self.assertGreater(float(timing['serializer'][4:]), 0)
+
+    def test_metrics_format(self):
+        self.client.get('/posts/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        for line in lines:
+            if line.startswith('#'):
+                self.assertRegex(line, r'^# (HELP [a-z_]+ .+|TYPE [a-z_]+ (histogram|gauge|counter))$')
+            else:
+                self.assertRegex(line, self.SAMPLE)
+
+        #cumulative buckets, the +Inf one is the count
+        series = 'inksmart_request_queries_bucket{route="posts/",method="GET",le='
+        buckets = [int(line.rsplit(' ', 1)[1]) for line in lines if line.startswith(series)]
+        self.assertEqual(len(buckets), len(QUERY_BUCKETS) + 1)
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertIn(f'inksmart_request_queries_count{{route="posts/",method="GET"}} {buckets[-1]}', lines)
+
+    def test_metrics_token(self):
+        with mock.patch.dict(os.environ, {'METRICS_TOKEN': 'secret'}):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='secret').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        with mock.patch.dict(os.environ):
+            os.environ.pop('METRICS_TOKEN', None)
+            self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+
+class AsyncViewsParityTests(TestCase):
+    """
+    the async views of urls_async.py (ASGI) answer like the DRF views of urls.py
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='x')
+        cls.reader = User.objects.create_user(username='reader', password='x')
+        tag = Tag.objects.create(name='python')
+        posts = Post.objects.bulk_create([
+            Post(owner=cls.author, title=f'post {n}', content=f'django text {n}', status='PUBLISHED') for n in range(4)
+        ])
+        Post.objects.bulk_create([Post(owner=cls.author, title='draft', content='text', status='DRAFT')])
+        posts[0].tags.add(tag)
+        cls.post = posts[0]
+        Like.objects.bulk_create([Like(user=cls.reader, post=cls.post)])
+        comment, = Comment.objects.bulk_create([Comment(owner=cls.reader, post=cls.post, content='first')])
+        Comment.objects.bulk_create([
+            Comment(owner=cls.author, post=cls.post, parent_comment=comment, content='reply'),
+            Comment(owner=cls.author, post=cls.post, content='second'),
+        ])
+        rebuild_index()
+        cls.token = str(RefreshToken.for_user(cls.reader).access_token)
+
+    def setUp(self):
+        self.addCleanup(view_buffer.flush)
+        patcher = mock.patch.object(KeysetPagination, 'page_size', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def both(self, path, **headers):
+        #the same request through both url configurations, from an empty response cache
+        responses = []
+        for urlconf in ('ink_smart.urls', 'ink_smart.urls_async'):
+            cache.clear()
+            with override_settings(ROOT_URLCONF=urlconf):
+                responses.append(self.client.get(path, **headers))
+        return responses
+
+    def assertSameResponse(self, path, **headers):
+        sync, async_ = self.both(path, **headers)
+        self.assertEqual(sync.status_code, async_.status_code, path)
+        self.assertEqual(sync.content and sync.json(), async_.content and async_.json(), path)
+        for header in ('ETag', 'Last-Modified', 'WWW-Authenticate'):
+            self.assertEqual(sync.get(header), async_.get(header), f'{path} {header}')
+        self.assertEqual(sorted(cc_delim_re.split(sync['Vary'])), sorted(cc_delim_re.split(async_['Vary'])), path)
+        return sync
+
+    def test_same_responses(self):
+        paths = [
+            '/posts/',
+            '/posts/?tags=python',
+            '/posts/?search=django',
+            '/posts/?created_after=yesterday',
+            '/posts/?cursor=tampered',
+            f'/posts/{self.post.id}/',
+            f'/posts/{self.post.id + 1000}/',
+            f'/posts/{self.post.id}/comments/',
+            f'/posts/{self.post.id + 1000}/comments/',
+            '/users/current/',
+        ]
+        for headers in ({}, {'HTTP_AUTHORIZATION': f'Bearer {self.token}'}):
+            for path in paths:
+                self.assertSameResponse(path, **headers)
+
+    def test_same_pages(self):
+        for path in ('/posts/', f'/posts/{self.post.id}/comments/'):
+            while path:
+                path = self.assertSameResponse(path).json()['next']
+
+    def test_same_revalidations(self):
+        for path in (f'/posts/{self.post.id}/', f'/posts/{self.post.id}/comments/'):
+            etag = self.client.get(path)['ETag']
+            self.assertSameResponse(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(self.both(path, HTTP_IF_NONE_MATCH=etag)[1].status_code, 304)
+
+    def test_bad_token(self):
+        self.assertSameResponse('/posts/', HTTP_AUTHORIZATION='Bearer wrong')
+
+
+
+class ConditionalGetTests(TestCase):
+    """
+    a revalidation is answered with a 304 from one query until the post (or its thread) changes
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='x')
+        cls.reader = User.objects.create_user(username='reader', password='x')
+        Profile.objects.create(user=cls.author, accept_notifications=False)
+        cls.post, = Post.objects.bulk_create([Post(owner=cls.author, title='published', content='text', status='PUBLISHED')])
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+        self.addCleanup(view_buffer.flush)
+        self.addCleanup(engagement_buffer.flush)
+
+    def get(self, path='', **headers):
+        return self.client.get(f'/posts/{self.post.id}/{path}', **headers)
+
+    def test_not_modified_with_if_none_match(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1):
+            revalidated = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.content, b'')
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+
+    def test_not_modified_with_if_modified_since(self):
+        response = self.get()
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:00:00 GMT').status_code, 200)
+
+    def test_etag_changes_after_an_edit(self):
+        etag = self.get()['ETag']
+        author = APIClient()
+        author.force_authenticate(self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(author.patch(f'/posts/{self.post.id}/', {'title': 'edited'}, format='json').status_code, 200)
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['title'], 'edited')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_changes_after_a_like(self):
+        etag = self.get()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/posts/{self.post.id}/like/')
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['is_liked'])
+
+    def test_etag_depends_on_the_viewer(self):
+        anonymous = APIClient().get(f'/posts/{self.post.id}/')
+        self.assertNotEqual(anonymous['ETag'], self.get()['ETag'])
+        self.assertIn('Authorization', anonymous['Vary'])
+
+    def test_thread_etag_changes_after_a_comment(self):
+        etag = self.get('comments/')['ETag']
+        self.assertEqual(self.get('comments/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Comment.objects.bulk_create([Comment(owner=self.reader, post=self.post, content='first')])
+        self.assertEqual(self.get('comments/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+
+class ResponseCacheTests(TestCase):
+    """
+    the cached anonymous responses are invalidated when the change is committed, not before
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_versions_move_on_commit(self):
+        before = get_versions(['tags'])
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Tag.objects.create(name='django')
+            #a reader would still cache the old tag list under the old version: nothing is bumped yet
+            self.assertEqual(get_versions(['tags']), before)
+        self.assertTrue(callbacks)
+        self.assertNotEqual(get_versions(['tags']), before)
+
+    def test_rolled_back_change_keeps_the_versions(self):
+        before = get_versions(['tags'])
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    Tag.objects.create(name='django')
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(get_versions(['tags']), before)
+
+    def test_owner_looked_up_once_per_post(self):
+        author = User.objects.create_user(username='author', password='x')
+        post, = Post.objects.bulk_create([Post(owner=author, title='published', content='text', status='PUBLISHED')])
+        Comment.objects.bulk_create([Comment(owner=author, post=post, content=str(i)) for i in range(3)])
+        self.addCleanup(engagement_buffer.flush)
+        before = get_versions([f'user_posts:{author.id}'])
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            for comment in Comment.objects.all():
+                comment.delete()
+        owner_queries = [query for query in queries if '"posts_post"."owner_id"' in query['sql'] and 'SELECT' in query['sql']]
+        self.assertEqual(len(owner_queries), 1)
+        self.assertNotEqual(get_versions([f'user_posts:{author.id}']), before)
+
+    def test_deploy_check_wants_a_shared_cache(self):
+        self.assertEqual([error.id for error in check_shared_cache(None)], ['posts.W001'])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://x'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+
+class WriteQueueTests(TransactionTestCase):
+    """
+    the writer thread commits on its own connection: no TestCase transaction around these tests
+    """
+
+    def setUp(self):
+        self.queue = WriteQueue(enabled=True, batch_size=10, timeout=5.0)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def block_writer(self):
+        #occupies the writer thread until self.release is set
+        def wait():
+            self.started.set()
+            self.release.wait(5)
+        blocker = threading.Thread(target=self.queue.run, args=(wait,))
+        blocker.start()
+        self.addCleanup(blocker.join)
+        self.addCleanup(self.release.set)
+        self.started.wait(5)
+
+    def submit(self, func, *args):
+        #run() from another request thread, returns the future of its outcome
+        future = Future()
+
+        def call():
+            try:
+                future.set_result(self.queue.run(func, *args))
+            except Exception as e:
+                future.set_exception(e)
+        thread = threading.Thread(target=call)
+        thread.start()
+        self.addCleanup(thread.join)
+        return future
+
+    def wait_queued(self, count):
+        deadline = time.monotonic() + 5
+        while self.queue.stats()['pending'] < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def create_tag(self, name):
+        return Tag.objects.create(name=name).id
+
+    def fail_after_tag(self, name):
+        Tag.objects.create(name=name)
+        raise ValueError(name)
+
+    def test_waiting_writes_are_committed_together(self):
+        self.block_writer()
+        futures = [self.submit(self.create_tag, f'tag{n}') for n in range(3)]
+        self.wait_queued(3)
+        self.release.set()
+        ids = [future.result(5) for future in futures]
+        self.assertEqual(set(Tag.objects.values_list('id', flat=True)), set(ids))
+        #the blocking write's batch, then one for the three writes that waited
+        self.assertEqual(self.queue.stats(), {'pending': 0, 'written': 4, 'failed': 0, 'batches': 2})
+
+    def test_failing_write_only_rolls_itself_back(self):
+        self.block_writer()
+        futures = [
+            self.submit(self.create_tag, 'before'),
+            self.submit(self.fail_after_tag, 'failed'),
+            self.submit(self.create_tag, 'after'),
+        ]
+        self.wait_queued(3)
+        self.release.set()
+        with self.assertRaises(ValueError):
+            futures[1].result(5)
+        futures[0].result(5)
+        futures[2].result(5)
+        self.assertEqual(set(Tag.objects.values_list('name', flat=True)), {'before', 'after'})
+        self.assertEqual(self.queue.stats()['failed'], 1)
+
+    def test_inline_inside_a_transaction(self):
+        with transaction.atomic():
+            Tag.objects.create(name='uncommitted')
+            #the writer thread's connection would not see the row (and would wait on our write lock)
+            thread, count = self.queue.run(lambda: (threading.current_thread(), Tag.objects.count()))
+        self.assertIs(thread, threading.current_thread())
+        self.assertEqual(count, 1)
+        self.assertIsNone(self.queue._worker)
+
+    def test_timed_out_write_is_withdrawn(self):
+        self.queue.timeout = 0.1
+        self.block_writer()
+        with self.assertRaises(WriteTimeout):
+            self.queue.run(self.create_tag, 'late')
+        self.release.set()
+        #the next write goes through, the withdrawn one never ran
+        self.queue.timeout = 5.0
+        self.queue.run(self.create_tag, 'next')
+        self.assertEqual(list(Tag.objects.values_list('name', flat=True)), ['next'])
+
+    def test_running_write_is_waited_for(self):
+        self.queue.timeout = 0.1
+
+        def slow():
+            time.sleep(0.3)
+            return self.create_tag('slow')
+        tag_id = self.queue.run(slow)
+        self.assertTrue(Tag.objects.filter(id=tag_id).exists())
+
+
+class RecordingSMTPHandler:
+    #aiosmtpd handler: keeps the delivered mails and the client port of the connection each came on
+    def __init__(self, refused=()):
+        self.refused = set(refused)
+        self.messages = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refused:
+            return '550 no such mailbox'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((session.peer[1], envelope.rcpt_tos[0], envelope.content.decode()))
+        return '250 Message accepted for delivery'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@skipUnless(Controller is not None, 'aiosmtpd is not installed')
+class OutboxTests(TestCase):
+    """
+    deliver_outbox against a local SMTP server (no TLS, no login)
+    """
+
+    def serve(self, refused=()):
+        handler = RecordingSMTPHandler(refused)
+        controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+        controller.start()
+        self.addCleanup(controller.stop)
+        self.mailer = lambda: email.Mailer(host='127.0.0.1', port=controller.port, use_tls=False, credentials=('blog@example.com', ''))
+        return handler
+
+    def deliver(self, batch_size=email.BATCH_SIZE):
+        return email.deliver_outbox(batch_size=batch_size, mailer=self.mailer())
+
+    def test_batch_over_one_connection(self):
+        handler = self.serve()
+        for n in range(3):
+            email.queue_mail(f'reader{n}@example.com', 'New like', f'like {n}')
+        self.assertEqual(self.deliver(), (3, 0))
+        self.assertEqual(sorted(to for _, to, _ in handler.messages), [f'reader{n}@example.com' for n in range(3)])
+        self.assertEqual(len({port for port, _, _ in handler.messages}), 1)
+        self.assertFalse(OutboxMail.objects.exclude(status='SENT').exists())
+        self.assertEqual(self.deliver(), (0, 0))
+
+    def test_refused_mail_is_retried_with_backoff(self):
+        handler = self.serve(refused={'gone@example.com'})
+        email.queue_mail('gone@example.com', 'New like', 'lost')
+        email.queue_mail('reader@example.com', 'New like', 'delivered')
+        before = timezone.now()
+        self.assertEqual(self.deliver(), (1, 1))
+        self.assertEqual([to for _, to, _ in handler.messages], ['reader@example.com'])
+        mail = OutboxMail.objects.get(receiver='gone@example.com')
+        self.assertEqual((mail.status, mail.attempts, mail.claimed_until), ('PENDING', 1, None))
+        self.assertGreaterEqual(mail.next_attempt_at, before + timedelta(minutes=2))
+        #not due yet: the next run leaves it alone
+        self.assertEqual(self.deliver(), (0, 0))
+
+        OutboxMail.objects.filter(id=mail.id).update(next_attempt_at=timezone.now())
+        self.assertEqual(self.deliver(), (0, 1))
+        mail.refresh_from_db()
+        self.assertEqual(mail.attempts, 2)
+        self.assertGreaterEqual(mail.next_attempt_at, timezone.now() + timedelta(minutes=3))
+
+    def test_dead_after_max_attempts(self):
+        self.serve(refused={'gone@example.com'})
+        mail = email.queue_mail('gone@example.com', 'New like', 'lost')
+        OutboxMail.objects.filter(id=mail.id).update(attempts=email.MAX_ATTEMPTS - 1)
+        self.assertEqual(self.deliver(), (0, 1))
+        mail.refresh_from_db()
+        self.assertEqual((mail.status, mail.attempts), ('DEAD', email.MAX_ATTEMPTS))
+        OutboxMail.objects.filter(id=mail.id).update(next_attempt_at=timezone.now())
+        self.assertEqual(self.deliver(), (0, 0))
+
+    def test_unreachable_server_keeps_the_batch(self):
+        email.queue_mail('reader@example.com', 'New like', 'later')
+        mailer = email.Mailer(host='127.0.0.1', port=free_port(), use_tls=False, credentials=('blog@example.com', ''))
+        self.assertEqual(email.deliver_outbox(mailer=mailer), (0, 1))
+        mail = OutboxMail.objects.get()
+        self.assertEqual((mail.status, mail.attempts), ('PENDING', 1))
+
+    def test_claim_lease(self):
+        handler = self.serve()
+        mail = email.queue_mail('reader@example.com', 'New like', 'once')
+        #another worker is sending it
+        OutboxMail.objects.filter(id=mail.id).update(claim='other', claimed_until=timezone.now() + email.CLAIM_LEASE)
+        self.assertEqual(self.deliver(), (0, 0))
+        self.assertEqual(handler.messages, [])
+        #that worker died: once its lease is over the mail is picked up again
+        OutboxMail.objects.filter(id=mail.id).update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.deliver(), (1, 0))
+        self.assertEqual(len(handler.messages), 1)
+
+    def test_batch_size(self):
+        handler = self.serve()
+        for n in range(5):
+            email.queue_mail(f'reader{n}@example.com', 'New like', 'batched')
+        self.assertEqual(self.deliver(batch_size=2), (2, 0))
+        self.assertEqual(OutboxMail.objects.filter(status='PENDING').count(), 3)
+        self.assertEqual(len(handler.messages), 2)
+
+    def test_prune_sent_mails(self):
+        now = timezone.now()
+        old, recent, dead = (email.queue_mail('reader@example.com', 'New like', body) for body in ('old', 'recent', 'dead'))
+        OutboxMail.objects.filter(id=old.id).update(status='SENT', sent_at=now - email.SENT_RETENTION - timedelta(hours=1))
+        OutboxMail.objects.filter(id=recent.id).update(status='SENT', sent_at=now - timedelta(hours=1))
+        OutboxMail.objects.filter(id=dead.id).update(status='DEAD')
+        self.assertEqual(email.prune_outbox(now=now, batch_size=1), 1)
+        self.assertEqual(set(OutboxMail.objects.values_list('body', flat=True)), {'recent', 'dead'})
@@ -0,0 +1,42 @@
+from django.db import IntegrityError, router, transaction
+from django.db.models.signals import m2m_changed
+
+
+def toggle(model, **key):
+    """
+    insert the row identified by `key`, or delete it when it already exists
+    returns True when the row exists afterwards
+
+    There is no SELECT first: the unique constraint on `key` decides, so two concurrent
+    taps can never create the row twice (the second one removes it, as a toggle should).
+    Any other integrity error (a missing row `key` points at, a NULL...) is raised: when
+    nothing matches `key` to be deleted, the insert did not fail on the unique constraint.
+    """
+    try:
+        with transaction.atomic():
+            model.objects.create(**key)
+        return True
+    except IntegrityError:
+        deleted, _ = model.objects.filter(**key).delete()
+        if not deleted:
+            raise
+        return False
+
+
+def toggle_m2m(descriptor, instance, target_id):
+    """
+    toggle the link between `instance` and `target_id` of a many to many field,
+    e.g. toggle_m2m(Post.savers, post, user.id), then send the m2m_changed
+    that add() / remove() would have sent
+    """
+    field = descriptor.field
+    through = descriptor.through
+    added = toggle(through, **{
+        f'{field.m2m_field_name()}_id': instance.pk,
+        f'{field.m2m_reverse_field_name()}_id': target_id,
+    })
+    m2m_changed.send(
+        sender=through, instance=instance, action='post_add' if added else 'post_remove', reverse=False,
+        model=field.related_model, pk_set={target_id}, using=router.db_for_write(through, instance=instance),
+    )
+    return added
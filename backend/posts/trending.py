@@ -0,0 +1,168 @@
+import math
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import Post, PostScore, RollupWatermark
+from .rollups import SOURCES
+
+EPOCH = 'post_scores'
+
+#the epoch only moves when decay() runs; a process may go on with the previous one this long,
+#which over-weights its events by 2^(EPOCH_TTL / half_life) - 1 (0.05% for a day)
+EPOCH_TTL = 60
+
+#an event this many half-lives past the epoch (decay() has not run for that long) first moves the epoch:
+#its growth, 2^32, stays far from the float limit (2^1024) and from the precision the older scores need
+MAX_EPOCH_AGE = 32
+
+DEFAULTS = {
+    'HALF_LIFE': 24 * 3600,   #seconds for an event to lose half of its weight
+    'WEIGHTS': {'views': 1.0, 'likes': 5.0, 'comments': 10.0},
+    'MIN_SCORE': 0.05,        #scores that decayed below this are deleted, the table only holds live posts
+}
+
+
+class TrendingScores:
+    """
+    Time-decayed engagement score of every post, kept in PostScore for the trending feed
+
+    An event of weight w that happened at t is worth w * 2^-((now - t) / half_life). Every
+    stored score is expressed at a shared epoch (a RollupWatermark row): a new event adds
+    w * 2^((t - epoch) / half_life) to its post, which keeps all the rows comparable without
+    touching the other posts. The periodic decay() multiplies every row by 2^-((now - epoch) / half_life)
+    in a single UPDATE, moves the epoch to now and drops the posts nobody engages with anymore.
+    Events added right after decay() may still be scaled against the previous epoch (see
+    EPOCH_TTL), they are then over-weighted by a fraction of a percent until they fade.
+    When decay() stops running, add() moves the epoch itself once it is MAX_EPOCH_AGE half-lives old.
+    """
+
+    def __init__(self, half_life, weights, min_score):
+        self.half_life = half_life
+        self.weights = weights
+        self.min_score = min_score
+
+    def growth(self, timestamp, epoch):
+        #past the epoch only up to MAX_EPOCH_AGE half-lives (see add()), before it this underflows to 0.0
+        return 2 ** ((timestamp - epoch).total_seconds() / self.half_life)
+
+    def epoch(self):
+        epoch = cache.get(EPOCH)
+        if epoch is None:
+            mark, _ = RollupWatermark.objects.get_or_create(name=EPOCH, defaults={'until': timezone.now()})
+            epoch = mark.until
+            cache.set(EPOCH, epoch, EPOCH_TTL)
+        return epoch
+
+    def move_epoch(self, mark, now):
+        mark.until = now
+        mark.save(update_fields=['until'])
+        transaction.on_commit(lambda: cache.set(EPOCH, now, EPOCH_TTL))
+
+    def add(self, events, sign=1):
+        """
+        add (post_id, kind, timestamp) events to the scores, kind being a WEIGHTS key
+        sign=-1 takes deleted events (unlikes, deleted comments) back out
+        """
+        events = list(events)
+        if not events:
+            return
+        epoch = self.epoch()
+        newest = max(timestamp for _, _, timestamp in events)
+        if (newest - epoch).total_seconds() > MAX_EPOCH_AGE * self.half_life:
+            epoch = self.rebase(newest)
+        deltas = defaultdict(float)
+        for post_id, kind, timestamp in events:
+            deltas[post_id] += sign * self.weights[kind] * self.growth(timestamp, epoch)
+        #rows first so the increments below can not race each other into a lost update
+        PostScore.objects.bulk_create(
+            [PostScore(post_id=post_id) for post_id, delta in deltas.items() if delta > 0], ignore_conflicts=True
+        )
+        for post_id, delta in deltas.items():
+            PostScore.objects.filter(post_id=post_id).update(score=Greatest(F('score') + delta, Value(0.0)))
+
+    def rebase(self, now):
+        """
+        bring every score to `now` and make it the epoch (one UPDATE), returns the epoch
+        """
+        with transaction.atomic():
+            mark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=EPOCH, defaults={'until': now})
+            if mark.until < now:
+                #the epoch's growth seen from now: a decay, however old the epoch is
+                PostScore.objects.update(score=F('score') * self.growth(mark.until, now))
+                self.move_epoch(mark, now)
+            return mark.until
+
+    def decay(self, now=None):
+        """
+        bring every score to now and make now the epoch, returns the number of posts still trending
+        """
+        now = now or timezone.now()
+        with transaction.atomic():
+            self.rebase(now)
+            PostScore.objects.filter(score__lt=self.min_score).delete()
+            return PostScore.objects.count()
+
+    def horizon(self):
+        #the age at which even the heaviest event has decayed below MIN_SCORE
+        return timedelta(seconds=self.half_life * math.log2(max(self.weights.values()) / self.min_score))
+
+    def rebuild(self, now=None):
+        """
+        recompute every score from the raw events younger than horizon() (backfill, drift),
+        returns the number of posts trending
+        """
+        now = now or timezone.now()
+        since = now - self.horizon()
+        with transaction.atomic():
+            mark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=EPOCH, defaults={'until': now})
+            self.move_epoch(mark, now)
+            PostScore.objects.all().delete()
+            scores = defaultdict(float)
+            for model, field, kind in SOURCES:
+                rows = model.objects.filter(**{f'{field}__gte': since, f'{field}__lte': now}).values_list('post_id', field)
+                for post_id, timestamp in rows.iterator(chunk_size=2000):
+                    scores[post_id] += self.weights[kind] * self.growth(timestamp, now)
+            PostScore.objects.bulk_create(
+                [PostScore(post_id=post_id, score=score) for post_id, score in scores.items() if score >= self.min_score],
+                batch_size=500,
+            )
+            return PostScore.objects.count()
+
+    def top(self, limit):
+        """
+        ids of the `limit` best published posts, best first
+        the score index is read on its own (joined with the posts the planner would rather sort
+        every published post), drafts are then filtered out by primary key
+        """
+        post_ids = []
+        offset = 0
+        while len(post_ids) < limit:
+            best = list(
+                PostScore.objects.filter(score__gt=0).order_by('-score')
+                .values_list('post_id', flat=True)[offset:offset + limit]
+            )
+            published = set(Post.objects.filter(id__in=best, status='PUBLISHED').values_list('id', flat=True))
+            post_ids.extend(post_id for post_id in best if post_id in published)
+            if len(best) < limit:
+                break
+            offset += limit
+        return post_ids[:limit]
+
+
+def _build_scores():
+    options = {**DEFAULTS, **getattr(settings, 'TRENDING', {})}
+    return TrendingScores(
+        half_life=options['HALF_LIFE'],
+        weights=options['WEIGHTS'],
+        min_score=options['MIN_SCORE'],
+    )
+
+
+trending_scores = _build_scores()
@@ -1,5 +1,5 @@
 from django.urls import path,include
-from .views_posts import PostsListCreate,PostRetrieveUpdateDelete,PostImage, save_post, get_saved_posts, publish_draft
+from .views_posts import PostsListCreate,PostRetrieveUpdateDelete,PostImage, save_post, get_saved_posts, publish_draft, get_posts_state, get_trending_posts, get_for_you_posts, get_related_posts
 from .views_likes import like_post,get_all_likes
 from .views_comments import CommentListCreate,CommentRetrieveUpdateDelete,UserComments,LikeComment
 from .views_tags import TagsListCreate,TagsViewUpdateDelete,tagsBulkCreate
@@ -11,6 +11,10 @@ urlpatterns = [
    path('<int:post_id>/',PostRetrieveUpdateDelete.as_view()),
    path('<int:post_id>/image/',PostImage.as_view()),
    path('<int:post_id>/publish/',publish_draft),
+   path('<int:post_id>/related/',get_related_posts),
+   path('state/',get_posts_state),
+   path('trending/',get_trending_posts),
+   path('for_you/',get_for_you_posts),
 
    path('<int:post_id>/like/',like_post),
    path('<int:post_id>/all_likes/',get_all_likes),
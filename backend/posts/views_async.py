@@ -0,0 +1,163 @@
+"""
+Async versions of the hot read endpoints, served under ASGI (see ink_smart/urls_async.py)
+
+Only GET goes through these views: the JWT user, the validators, the page and the anonymous
+response cache are read with the async ORM / cache API and the serializers only work on rows
+that are already loaded, so a request waiting on the database does not hold a thread.
+Any other method (creating a post or a comment...) is handed to the regular DRF view.
+The responses are the same as the ones of the DRF views.
+"""
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotFound, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from .conditional import add_validators, apost_validators, athread_validators, not_modified
+from .filters import PostFilter
+from .models import Comment, Post
+from .pagination import KeysetPagination
+from .response_cache import CACHE_TTL, aresponse_cache_key
+from .serializers import CommentSerializer, PostSerializer
+from .views_comments import CommentListCreate, group_replies, replies_of
+from .views_posts import PostRetrieveUpdateDelete, PostsListCreate
+
+#the message of get_object_or_404's Http404, as the DRF views answer it
+POST_NOT_FOUND = 'No Post matches the given query.'
+
+
+async def authenticate(request):
+    """
+    the user of the request's JWT, AnonymousUser without one
+    same checks as JWTAuthentication, the user is loaded with the async ORM
+    """
+    authenticator = JWTAuthentication()
+    header = authenticator.get_header(request)
+    raw_token = authenticator.get_raw_token(header) if header is not None else None
+    if raw_token is None:
+        return AnonymousUser()
+    token = authenticator.get_validated_token(raw_token)
+    try:
+        user_id = token[jwt_settings.USER_ID_CLAIM]
+    except KeyError:
+        raise InvalidToken('Token contained no recognizable user identification')
+    user = await User.objects.filter(**{jwt_settings.USER_ID_FIELD: user_id}).afirst()
+    if user is None:
+        raise AuthenticationFailed('User not found', code='user_not_found')
+    if not user.is_active:
+        raise AuthenticationFailed('User is inactive', code='user_inactive')
+    return user
+
+
+def json_response(data, status=200):
+    #rendered like DRF's Response
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+
+
+def error_response(exc):
+    #what DRF's exception handler answers
+    data = exc.detail if isinstance(exc.detail, (dict, list)) else {'detail': exc.detail}
+    response = json_response(data, exc.status_code)
+    if isinstance(exc, (AuthenticationFailed, InvalidToken)):
+        response['WWW-Authenticate'] = JWTAuthentication().authenticate_header(None)
+    return response
+
+
+def async_read(async_view, sync_view):
+    """
+    a view answering GET with `async_view` and every other method with the DRF `sync_view`,
+    run in a thread so writes keep their permissions, throttles and validation
+    """
+    sync_view = sync_to_async(sync_view)
+
+    async def view(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return await sync_view(request, *args, **kwargs)
+        try:
+            #read by the serializers and BlogMiddleWare, as DRF does
+            request.user = await authenticate(request)
+            response = await async_view(request, *args, **kwargs)
+        except APIException as exc:
+            response = error_response(exc)
+        #DRF varies every response (304s included) on the negotiated Accept header
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    #like DRF's views: the JWT is not a cookie
+    view.csrf_exempt = True
+    return view
+
+
+async def cached(request, scopes, render):
+    #the data built by `render`, from the anonymous response cache when possible (see response_cache.py)
+    if request.user.is_authenticated:
+        return await render()
+    key = await aresponse_cache_key(request, scopes)
+    data = await cache.aget(key)
+    if data is None:
+        data = await render()
+        await cache.aset(key, data, CACHE_TTL)
+    return data
+
+
+def filter_posts(request, queryset):
+    #PostFilter as DjangoFilterBackend applies it; validating tag names and searching run queries, so this runs in a thread
+    filterset = PostFilter(request.GET, queryset=queryset, request=request)
+    if not filterset.is_valid():
+        raise ValidationError(filterset.errors)
+    return filterset.qs
+
+
+async def list_posts(request):
+    async def render():
+        queryset = Post.objects.filter(status='PUBLISHED').for_feed(request.user)
+        if any(name in request.GET for name in PostFilter.base_filters):
+            queryset = await sync_to_async(filter_posts)(request, queryset)
+        paginator = KeysetPagination()
+        page = await paginator.apaginate_queryset(queryset, request)
+        return paginator.get_paginated_data(PostSerializer(page, many=True, context={'request': request}).data)
+
+    return json_response(await cached(request, ['posts', 'tags'], render))
+
+
+async def retrieve_post(request, post_id):
+    validators = await apost_validators(post_id, request.user)
+    if validators is None:
+        raise NotFound(POST_NOT_FOUND)
+    response = not_modified(request, validators)
+    if response is None:
+        async def render():
+            post = await Post.objects.for_feed(request.user).filter(id=post_id).afirst()
+            if post is None:
+                raise NotFound(POST_NOT_FOUND)
+            return PostSerializer(post, context={'request': request}).data
+
+        response = json_response(await cached(request, [f'post:{post_id}', 'tags'], render))
+    return add_validators(response, validators)
+
+
+async def list_comments(request, post_id):
+    validators = await athread_validators(post_id, request.user)
+    if validators is None:
+        raise NotFound(POST_NOT_FOUND)
+    response = not_modified(request, validators)
+    if response is None:
+        #top level comments are paginated, their replies come from a single query
+        replies = group_replies([comment async for comment in replies_of(post_id, request.user)])
+        paginator = KeysetPagination()
+        page = await paginator.apaginate_queryset(
+            Comment.objects.filter(post_id=post_id, parent_comment=None).for_thread(request.user), request
+        )
+        data = CommentSerializer(page, many=True, context={'request': request, 'replies': replies}).data
+        response = json_response(paginator.get_paginated_data(data))
+    return add_validators(response, validators)
+
+
+posts_list_create = async_read(list_posts, PostsListCreate.as_view())
+post_detail = async_read(retrieve_post, PostRetrieveUpdateDelete.as_view())
+comments_list_create = async_read(list_comments, CommentListCreate.as_view())
@@ -9,9 +9,51 @@ from django.shortcuts import get_object_or_404
 from .models import Post,Comment
 from rest_framework.throttling import UserRateThrottle
 from rest_framework.permissions import IsAuthenticated
-from .email import send_mail
+from .email import queue_mail
+from django.db import transaction
+from .pagination import KeysetPagination
+from .counters import bump
+from .toggles import toggle_m2m
+from .writer import write_queue
+from .conditional import ConditionalGetMixin, thread_validators
+from collections import defaultdict
 
-class CommentListCreate(ListCreateAPIView):
+
+def load_replies(post_id, viewer):
+    """
+    fetch every reply of a post in one query and group them by parent comment,
+    newest first, so the serializer can build the whole tree in memory
+    """
+    return group_replies(replies_of(post_id, viewer))
+
+
+def replies_of(post_id, viewer):
+    return Comment.objects.filter(post_id=post_id, parent_comment__isnull=False).for_thread(viewer).order_by('-created_at', '-id')
+
+
+def load_reply_tree(comment_ids, viewer):
+    """
+    the replies of the given comments at any depth, grouped like load_replies:
+    one query per level of the tree whatever the number of comments
+    """
+    replies = defaultdict(list)
+    parents = list(comment_ids)
+    while parents:
+        level = list(Comment.objects.filter(parent_comment_id__in=parents).for_thread(viewer).order_by('-created_at', '-id'))
+        for comment in level:
+            replies[comment.parent_comment_id].append(comment)
+        parents = [comment.id for comment in level]
+    return replies
+
+
+def group_replies(comments):
+    replies = defaultdict(list)
+    for comment in comments:
+        replies[comment.parent_comment_id].append(comment)
+    return replies
+
+
+class CommentListCreate(ConditionalGetMixin, ListCreateAPIView):
     """
     List and create comments
     
@@ -27,14 +69,19 @@ class CommentListCreate(ListCreateAPIView):
     
     Query Parameters (POST):
     - parent_comment_id (optional): ID of parent comment for replies
+
+    Query Parameters (GET):
+    - cursor (optional): opaque cursor taken from the "next"/"previous" links
     
     Response:
-    - GET 200: [CommentSerializer objects]
+    - GET 200: {"next": url, "previous": url, "results": [CommentSerializer objects]}, with ETag and Last-Modified headers
+    - GET 304: the thread did not change since the If-None-Match / If-Modified-Since validators
     - POST 201: CommentSerializer object
     - POST 400: {"field_name": ["error message"]}
     """
     permission_classes = [PostPermission]
     serializer_class = CommentSerializer
+    pagination_class = KeysetPagination
     def get_throttles(self):
         if self.request.method=='POST':
             return [UserRateThrottle()]
@@ -60,14 +107,29 @@ class CommentListCreate(ListCreateAPIView):
 
 
 
-        serializer.save(owner = self.request.user, parent_comment = parent_comment,post=post)
-        #check if the owner accepts notifications
-        if self.request.user.profile.accept_notifications:
-            send_mail(self.request.user.email, 'New comment', f'You have a new comment on your post {post.title}')
+        with transaction.atomic():
+            serializer.save(owner = self.request.user, parent_comment = parent_comment,post=post)
+            bump(Post, post.id, comments_count=1)
+            #check if the post owner accepts notifications (delivered later by the outbox worker)
+            if post.owner.profile.accept_notifications:
+                queue_mail(post.owner.email, 'New comment', f'You have a new comment on your post {post.title}')
+
+    def get_validators(self):
+        return thread_validators(self.kwargs.get('post_id'), self.request.user)
 
     def get_queryset(self):
         post = self.get_object()
-        return Comment.objects.filter(post=post,parent_comment=None).order_by('-created_at')
+        return Comment.objects.filter(post=post,parent_comment=None).for_thread(self.request.user).order_by('-created_at')
+
+    def list(self, request, *args, **kwargs):
+        #top level comments are paginated, their replies come from a single query
+        self.replies = load_replies(self.kwargs.get('post_id'), request.user)
+        return super().list(request, *args, **kwargs)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['replies'] = getattr(self, 'replies', None)
+        return context
 
 
 class CommentRetrieveUpdateDelete(RetrieveUpdateDestroyAPIView):
@@ -113,14 +175,37 @@ class UserComments(ListAPIView):
     
     Request Body: None
     
+    Query Parameters:
+    - cursor (optional): opaque cursor taken from the "next"/"previous" links
+
     Response:
-    - 200: [CommentSerializer objects]
+    - 200: {"next": url, "previous": url, "results": [CommentSerializer objects]}
     """
     permission_classes = [IsAuthenticated]
     serializer_class = CommentSerializer
+    pagination_class = KeysetPagination
     def get_queryset(self):
         user = self.request.user
-        return Comment.objects.filter(owner=user).order_by('-created_at')
+        return Comment.objects.filter(owner=user).for_thread(user).order_by('-created_at')
+
+    def paginate_queryset(self, queryset):
+        #the comments of the page are on many posts, their replies are loaded level by level
+        page = super().paginate_queryset(queryset)
+        self.replies = load_reply_tree([comment.id for comment in page], self.request.user)
+        return page
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['replies'] = getattr(self, 'replies', None)
+        return context
+
+
+def toggle_comment_like(comment, user_id):
+    #(is_liked, likes_count)
+    with transaction.atomic():
+        is_liked = toggle_m2m(Comment.likes, comment, user_id)
+        likes_count = bump(Comment, comment.id, likes_count=1 if is_liked else -1)['likes_count']
+    return is_liked, likes_count
 
 
 class LikeComment(APIView):
@@ -140,6 +225,7 @@ class LikeComment(APIView):
         "likes_count": 5
     }
     - 404: {"detail": "Comment not found."}
+    - 503: {"detail": "Too many writes at the moment, try again."} (write queue, nothing was written)
     """
     permission_classes = [IsAuthenticated]
     
@@ -147,19 +233,9 @@ class LikeComment(APIView):
         comment = get_object_or_404(Comment, id=comment_id, post_id=post_id)
         user = request.user
         
-        # Check if user has already liked this comment
-        if comment.likes.filter(id=user.id).exists():
-            # Unlike the comment
-            comment.likes.remove(user)
-            is_liked = False
-            message = 'Comment unliked successfully'
-        else:
-            # Like the comment
-            comment.likes.add(user)
-            is_liked = True
-            message = 'Comment liked successfully'
-        
-        likes_count = comment.likes.count()
+        #a single insert, or a delete when the unique (comment, user) pair already exists
+        is_liked, likes_count = write_queue.run(toggle_comment_like, comment, user.id)
+        message = 'Comment liked successfully' if is_liked else 'Comment unliked successfully'
         
         return Response({
             'message': message,
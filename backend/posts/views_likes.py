@@ -5,8 +5,27 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from users.serializers import ProfileSerializer
 from users.models import User,Profile
+from .pagination import LikeKeysetPagination
 from rest_framework import status
-from .email import send_mail
+from .email import queue_mail
+from django.db import transaction
+from .counters import bump
+from .toggles import toggle
+from .writer import write_queue
+
+def toggle_post_like(post, user_id):
+    """
+    (is_liked, likes_count): the counter moves in the same transaction as the like, both ways
+    """
+    with transaction.atomic():
+        #insert, or delete when the unique (user, post) index says it is already there
+        is_liked = toggle(Like, post=post, user_id=user_id)
+        likes_count = bump(Post, post.id, likes_count=1 if is_liked else -1)['likes_count']
+        #check if the owner accepts notifications (delivered later by the outbox worker)
+        if is_liked and post.owner.profile.accept_notifications:
+            queue_mail(post.owner.email, 'New like', f'You have a new like on your post {post.title}')
+    return is_liked, likes_count
+
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -21,21 +40,17 @@ def like_post(request,post_id):
     Request Body: None
     
     Response:
-    - 200: {"detail": "you have unliked this post"}
-    - 201: {"detail": "you have liked this post"}
+    - 200: {"detail": "you have unliked this post", "is_liked": false, "likes_count": 4}
+    - 201: {"detail": "you have liked this post", "is_liked": true, "likes_count": 5}
+    - 404: {"detail": "Not found."}
+    - 503: {"detail": "Too many writes at the moment, try again."} (write queue, nothing was written)
     """
-    like = Like.objects.filter(post_id=post_id,user_id = request.user.id).first()
-    if not like:   #we create a like
-        like = Like.objects.create(post_id=post_id,user_id = request.user.id)
-        like.save()
-        #check if the owner accepts notifications
-        post = get_object_or_404(Post, id=post_id)
-        if post.owner.profile.accept_notifications:
-            send_mail(post.owner.email, 'New like', f'You have a new like on your post {post.title}')
-        return Response('you have liked this post',201)
-    else:  #unike
-        like.delete()
-        return Response('you have unliked this post',200)
+    post = get_object_or_404(Post.objects.select_related('owner__profile'), id=post_id)
+    #committed by the process' writer thread when the write queue is enabled (see writer.py)
+    is_liked, likes_count = write_queue.run(toggle_post_like, post, request.user.id)
+    if is_liked:
+        return Response({'detail': 'you have liked this post', 'is_liked': True, 'likes_count': likes_count},201)
+    return Response({'detail': 'you have unliked this post', 'is_liked': False, 'likes_count': likes_count},200)
     
 
 @api_view(['GET'])
@@ -43,38 +58,48 @@ def get_all_likes(request,post_id):
     """
     Get all likes for a post
     
-    Goal: Retrieve all users who liked a specific post with their profile information.
-    Path: GET /posts/<int:post_id>/likes/
+    Goal: Retrieve the users who liked a specific post with their profile information, newest likes first.
+    Path: GET /posts/<int:post_id>/all_likes/
     Authentication: Not required
     
     Request Body: None
+
+    Query Parameters:
+    - cursor (optional): opaque cursor taken from the "next"/"previous" links
     
     Response:
     - 200: {
+        "next": url or null,
+        "previous": url or null,
         "likers": [
             {
                 "id": 1,
-                "user": 1,
+                "user": {...},
                 "pfp": "http://example.com/pfp.jpg",
-                "bio": "User bio",
-                "location": "City, Country",
-                "website": "https://example.com",
-                "birth_date": "1990-01-01",
-                "gender": "M"
+                "pfp_variants": {...},
+                "first_name": "John",
+                "last_name": "Doe",
+                "age": 25,
+                "phone": "...",
+                "accept_notifications": true
             }
         ],
         "total": 5
     }
+    - 404: {"detail": "Not found."}
     """
-    likers_ids = Like.objects.filter(post=post_id).values_list('user',flat=True)
-    likers = Profile.objects.filter(user_id__in = likers_ids)
-    likers_ser = ProfileSerializer(likers,many=True)
+    #the total is the stored counter, not a COUNT(*) over the likes
+    likes_count = get_object_or_404(Post.objects.values_list('likes_count',flat=True), id=post_id)
+    likes = Like.objects.filter(post_id=post_id).select_related('user__profile')
+    paginator = LikeKeysetPagination()
+    page = paginator.paginate_queryset(likes, request)
+    likers = [like.user.profile for like in page if hasattr(like.user, 'profile')]
+    likers_ser = ProfileSerializer(likers,many=True,context={'request': request})
     return Response({
+        'next': paginator.get_next_link(),
+        'previous': paginator.get_previous_link(),
         'likers':likers_ser.data,
-        'total' : likers.count()
+        'total' : likes_count
     },
     200
     )
-
-
-  
\ No newline at end of file
@@ -2,21 +2,34 @@ from django.shortcuts import render
 from rest_framework.generics import GenericAPIView,ListCreateAPIView,RetrieveUpdateDestroyAPIView
 from rest_framework.decorators import permission_classes,api_view
 from rest_framework.views import APIView
-from .serializers import PostSerializer
+from .serializers import PostSerializer, PostStateRequestSerializer, PostStateSerializer, TrendingRequestSerializer, ForYouRequestSerializer
 from .models import Post
 from rest_framework.permissions import IsAuthenticated,AllowAny
 from django.shortcuts import get_object_or_404
 from rest_framework.response import Response
 from django.http import FileResponse
+from django.core.files.storage import default_storage
 from .permissions import PostPermission
 from rest_framework import status
 from django_filters.rest_framework import DjangoFilterBackend
 from .filters import PostFilter
+from .pagination import KeysetPagination
+from .response_cache import AnonymousResponseCacheMixin
+from .conditional import ConditionalGetMixin, post_validators
+from .images import delete_variants, pick_variant, VARIANT_SIZES
+from .tasks import schedule_image_variants
+from .toggles import toggle_m2m
+from .trending import trending_scores
+from .personalization import for_you
+from .related import related_posts
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 from django.db import transaction
+from django.db.models import Q
 from .models import Tag
 
 
-class PostsListCreate(ListCreateAPIView):
+class PostsListCreate(AnonymousResponseCacheMixin, ListCreateAPIView):
     """
     List and create posts
     
@@ -33,8 +46,11 @@ class PostsListCreate(ListCreateAPIView):
         "summary": "Optional summary"
     }
     
+    Query Parameters (GET):
+    - cursor (optional): opaque cursor taken from the "next"/"previous" links
+
     Response:
-    - GET 200: [PostSerializer objects]
+    - GET 200: {"next": url, "previous": url, "results": [PostSerializer objects]}
     - POST 201: PostSerializer object
     - POST 400: {"field_name": ["error message"]}
     """
@@ -42,6 +58,13 @@ class PostsListCreate(ListCreateAPIView):
     queryset = Post.objects.filter(status='PUBLISHED').order_by('-created_at')
     filter_backends = [DjangoFilterBackend]
     filterset_class = PostFilter
+    pagination_class = KeysetPagination
+
+    def cache_scopes(self):
+        return ['posts', 'tags']
+
+    def get_queryset(self):
+        return super().get_queryset().for_feed(self.request.user)
 
     def perform_create(self, serializer):
         post =serializer.save(owner=self.request.user)
@@ -58,7 +81,7 @@ class PostsListCreate(ListCreateAPIView):
         return context
     
 
-class PostRetrieveUpdateDelete(RetrieveUpdateDestroyAPIView):
+class PostRetrieveUpdateDelete(ConditionalGetMixin, AnonymousResponseCacheMixin, RetrieveUpdateDestroyAPIView):
     """
     Get, update, or delete a specific post
     
@@ -75,7 +98,8 @@ class PostRetrieveUpdateDelete(RetrieveUpdateDestroyAPIView):
     }
     
     Response:
-    - GET 200: PostSerializer object
+    - GET 200: PostSerializer object, with ETag and Last-Modified headers
+    - GET 304: not modified since the If-None-Match / If-Modified-Since validators
     - PUT/PATCH 200: PostSerializer object
     - DELETE 204: No content
     - 400: {"field_name": ["error message"]}
@@ -86,6 +110,12 @@ class PostRetrieveUpdateDelete(RetrieveUpdateDestroyAPIView):
     serializer_class = PostSerializer
     queryset = Post.objects.all().order_by('-created_at')
     permission_classes = [PostPermission]
+
+    def cache_scopes(self):
+        return [f"post:{self.kwargs.get('post_id')}", 'tags']
+
+    def get_validators(self):
+        return post_validators(self.kwargs.get('post_id'), self.request.user)
     
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -110,6 +140,10 @@ class PostImage(APIView):
     
     Request Body (POST):
     - multipart/form-data with 'image' field containing the image file
+
+    Query Parameters (GET):
+    - variant (optional): thumb, card or full, a resized copy without metadata
+      (webp when the client accepts it, jpeg otherwise) instead of the original
     
     Response:
     - GET 200: Image file (binary)
@@ -125,6 +159,11 @@ class PostImage(APIView):
         self.check_permissions(request)
         post = get_object_or_404(Post,id=post_id)
         if post.image:
+            variant = request.GET.get('variant')
+            picked = pick_variant(post.image_variants, variant, request.META.get('HTTP_ACCEPT', '')) if variant in VARIANT_SIZES else None
+            if picked:
+                path, content_type = picked
+                return FileResponse(default_storage.open(path), as_attachment=False, content_type=content_type)
             return FileResponse(post.image,as_attachment=False)
         return Response(status=status.HTTP_204_NO_CONTENT)
     
@@ -133,10 +172,14 @@ class PostImage(APIView):
         self.check_object_permissions(request,post)
         if post.image:
             post.image.delete()
+            delete_variants(post.image_variants)
+            post.image_variants = {}
             post.save()
         image = request.FILES.get('image')
         post.image = image
         post.save()
+        #thumb / card / full copies for the feed and the post page
+        schedule_image_variants(post, 'image', 'image_variants')
         return Response('the image has been uploaded successfully',status=201)
 
 
@@ -145,6 +188,8 @@ class PostImage(APIView):
         self.check_object_permissions(request,post)
         if post.image:
             post.image.delete()
+            delete_variants(post.image_variants)
+            post.image_variants = {}
             post.save()
         return Response('the image has been deleted successfully',status=201)
 
@@ -199,7 +244,7 @@ def save_post(request):
     Query Parameters: post_id (required)
     
     Response:
-    - 200: {"detail": "The post has been saved successfully"} or {"detail": "The post has been removed from saved successfully"}
+    - 200: {"detail": "The post has been saved successfully", "is_saved": true} or {"detail": "The post has been removed from saved successfully", "is_saved": false}
     - 400: {"detail": "no post_id was provided"} or {"detail": "Cannot save a draft post"}
     - 404: {"detail": "Not found."}
     """
@@ -213,13 +258,11 @@ def save_post(request):
     if post.status != 'PUBLISHED':
         return Response({'detail': 'Cannot save a draft post'}, status=status.HTTP_400_BAD_REQUEST)
     print("here2")
-    # More efficient check using exists()
-    if request.user.saved_posts.filter(id=post_id).exists():
-        request.user.saved_posts.remove(post)
-        return Response({'detail': 'The post has been removed from saved successfully'})
+    #a single insert, or a delete when the unique (post, user) pair already exists
+    if toggle_m2m(Post.savers, post, request.user.id):
+        return Response({'detail': 'The post has been saved successfully', 'is_saved': True})
     else:
-        request.user.saved_posts.add(post)
-        return Response({'detail': 'The post has been saved successfully'})
+        return Response({'detail': 'The post has been removed from saved successfully', 'is_saved': False})
 
 
 @api_view(['GET'])
@@ -238,11 +281,130 @@ def get_saved_posts(request):
     - 200: [PostSerializer objects]
     """
     # Only get published posts that are saved by the user
-    posts = request.user.saved_posts.filter(status='PUBLISHED')
-    return Response(PostSerializer(posts, many=True).data)
+    posts = request.user.saved_posts.filter(status='PUBLISHED').for_feed(request.user)
+    return Response(PostSerializer(posts, many=True, context={'request': request}).data)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_trending_posts(request):
+    """
+    Trending posts
+
+    Goal: Get the published posts with the most recent engagement (views, likes, comments weighted
+          and decayed with time, see trending.py), best first
+    Path: GET /posts/trending/?limit=20
+    Authentication: Not required
+
+    Request Body: None
+
+    Response:
+    - 200: {"results": [PostSerializer objects]}   (at most `limit`, 1 to 100, default 20)
+    - 400: {"limit": ["error message"]}
+    """
+    params = TrendingRequestSerializer(data=request.GET)
+    params.is_valid(raise_exception=True)
+    post_ids = trending_scores.top(params.validated_data['limit'])
+    by_id = Post.objects.for_feed(request.user).in_bulk(post_ids)
+    posts = [by_id[post_id] for post_id in post_ids if post_id in by_id]
+    return Response({'results': PostSerializer(posts, many=True, context={'request': request}).data})
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_related_posts(request, post_id):
+    """
+    Related posts
+
+    Goal: Get the published posts most similar to a post (words of the title, tags and content),
+          precomputed by the related posts jobs (see related.py), most similar first
+    Path: GET /posts/<int:post_id>/related/
+    Authentication: Not required
+
+    Request Body: None
+
+    Response:
+    - 200: {"results": [PostSerializer objects]}   (at most RELATED_POSTS["NEIGHBOURS"])
+    - 404: {"detail": "No Post matches the given query."}
+    """
+    posts = related_posts.related(post_id, request.user)
+    if not posts:
+        #nothing related yet, or no such post
+        get_object_or_404(Post, id=post_id)
+    return Response({'results': PostSerializer(posts, many=True, context={'request': request}).data})
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_for_you_posts(request):
+    """
+    Personalized feed
+
+    Goal: Get published posts from other users ranked by the reader's affinity with their tags
+          (built from the reader's likes, saves and comments, see personalization.py) and by
+          recency; readers who have not engaged with anything yet get the trending posts
+    Path: GET /posts/for_you/?page=1
+    Authentication: Required
+
+    Request Body: None
+
+    Response:
+    - 200: {"next": "url or null", "previous": "url or null", "results": [PostSerializer objects]}
+    - 400: {"page": ["error message"]}   (pages 1 to FOR_YOU["MAX_PAGES"])
+    """
+    params = ForYouRequestSerializer(data=request.GET)
+    params.is_valid(raise_exception=True)
+    page = params.validated_data['page']
+    post_ids, has_next = for_you.page(request.user, page, api_settings.PAGE_SIZE)
+    by_id = Post.objects.for_feed(request.user).in_bulk(post_ids)
+    posts = [by_id[post_id] for post_id in post_ids if post_id in by_id]
+    url = request.build_absolute_uri()
+    return Response({
+        'next': replace_query_param(url, 'page', page + 1) if has_next else None,
+        'previous': replace_query_param(url, 'page', page - 1) if page > 1 else None,
+        'results': PostSerializer(posts, many=True, context={'request': request}).data,
+    })
 
 
 
 
 
 
+
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def get_posts_state(request):
+    """
+    Viewer state of many posts
+
+    Goal: Get the viewer flags and the counters of a batch of posts (e.g. the cards of a feed page
+          served from the shared cache) in a single query
+    Path: POST /posts/state/
+    Authentication: Not required (is_liked / is_saved are false for anonymous users)
+
+    Request Body:
+    {
+        "post_ids": [1, 2, 3]   (at most 500)
+    }
+
+    Response:
+    - 200: {"results": [{"id": 1, "is_liked": true, "is_saved": false, "likes_count": 5, "comments_count": 2, "views_count": 40}, ...]}
+           in the order of post_ids, unknown posts and other users' drafts are left out
+    - 400: {"post_ids": ["error message"]}
+    """
+    ids_ser = PostStateRequestSerializer(data=request.data)
+    ids_ser.is_valid(raise_exception=True)
+    post_ids = ids_ser.validated_data['post_ids']
+
+    visible = Q(status='PUBLISHED')
+    if request.user.is_authenticated:
+        visible |= Q(owner=request.user)
+    rows = (
+        Post.objects.filter(visible, id__in=post_ids)
+        .with_viewer_state(request.user)
+        .values('id', 'viewer_liked', 'viewer_saved', 'likes_count', 'comments_count', 'views_count')
+    )
+    by_id = {row['id']: row for row in rows}
+    states = [by_id[post_id] for post_id in dict.fromkeys(post_ids) if post_id in by_id]
+    return Response({'results': PostStateSerializer(states, many=True).data})
@@ -6,10 +6,12 @@ from .serializers import TagSerializer
 from rest_framework.decorators import permission_classes,api_view
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
-from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from .tags import resolve_tags
+from .response_cache import AnonymousResponseCacheMixin
 
 
-class TagsListCreate(ListCreateAPIView):
+class TagsListCreate(AnonymousResponseCacheMixin, ListCreateAPIView):
     """
     List and create tags
     
@@ -32,6 +34,9 @@ class TagsListCreate(ListCreateAPIView):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
 
+    def cache_scopes(self):
+        return ['tags']
+
    
 
 class TagsViewUpdateDelete(RetrieveUpdateDestroyAPIView):
@@ -78,21 +83,12 @@ def tagsBulkCreate(request):
     
     Response:
     - 200: {"detail": "5 have been created succssfully"}
+    - 400: {"tag_names": [...]} when tag_names is not a list of names of at most 50 characters
     - 403: {"detail": "You do not have permission to perform this action."}
     """
-    tag_names = set(request.data.get('tag_names',[]))
-    #we query for tag names already existing in our db
-   
-    query = Q()
-    for name in tag_names:
-        query |= Q(name__iexact=name)   #case insensitive in
-    exist = set(Tag.objects.filter(query).values_list('name',flat=True))
-    tags_to_be_created = tag_names - exist
-    l = 0
-    for name in tags_to_be_created:
-        l+=1
-        tag = Tag.objects.create(name=name)
-        tag.save()
-    return Response(f'{l} have been created succssfully')
-    
-    
+    #one lookup of the existing names, one bulk insert of the missing ones
+    try:
+        tags, created = resolve_tags(request.data.get('tag_names',[]))
+    except ValidationError as e:
+        raise ValidationError({'tag_names': e.detail})
+    return Response(f'{created} have been created succssfully')
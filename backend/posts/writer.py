@@ -0,0 +1,136 @@
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from django.conf import settings
+from django.db import connection, transaction
+from rest_framework.exceptions import APIException
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,    #False: writes run inline on the calling thread
+    'BATCH_SIZE': 100,   #writes committed together by the writer thread
+    'TIMEOUT': 30.0,     #seconds a caller waits for its write to start before giving up
+}
+
+
+class WriteTimeout(APIException):
+    #the write was withdrawn before the writer thread got to it: nothing was written
+    status_code = 503
+    default_detail = 'Too many writes at the moment, try again.'
+    default_code = 'write_timeout'
+
+
+class WriteQueue:
+    """
+    One writer thread per process for the high-frequency small writes (likes, views)
+
+    SQLite lets a single connection write at a time: when every request thread writes on its
+    own connection they all wait on the same lock and the unlucky ones fail with
+    "database is locked". Callers hand their write to the writer thread and wait for its result,
+    so a process holds one write connection. The writer takes whatever is waiting (up to
+    `batch_size` writes) and commits it as one transaction, each write in its own savepoint
+    so a failing write only rolls itself back.
+    """
+
+    def __init__(self, enabled, batch_size, timeout):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._queue = None
+        self._lock = threading.Lock()
+        self._worker = None
+        self._pid = None
+
+    def run(self, func, *args, **kwargs):
+        """
+        run func(*args, **kwargs) on the writer thread and return its result (or raise its exception)
+        inline when the caller is inside a transaction: another connection would not see its
+        uncommitted rows and could wait forever on the write lock the caller holds
+        raises WriteTimeout when the write did not start within `timeout` (it is withdrawn, never runs)
+        """
+        if not self.enabled or connection.in_atomic_block or threading.current_thread() is self._worker:
+            return func(*args, **kwargs)
+        future = Future()
+        self._ensure_worker().put((func, args, kwargs, future))
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            if future.cancel():
+                raise WriteTimeout()
+            #already part of the batch being committed: its outcome is the commit's
+            return future.result()
+
+    def stats(self):
+        return {
+            'pending': self._queue.qsize() if self._queue is not None else 0,
+            'written': self.written,
+            'failed': self.failed,
+            'batches': self.batches,
+        }
+
+    def _ensure_worker(self):
+        #started lazily and once per process (workers forked by gunicorn do not inherit threads)
+        if self._worker is not None and self._pid == os.getpid() and self._worker.is_alive():
+            return self._queue
+        with self._lock:
+            if self._worker is None or self._pid != os.getpid() or not self._worker.is_alive():
+                self._pid = os.getpid()
+                self._queue = queue.SimpleQueue()
+                self._worker = threading.Thread(target=self._run, args=(self._queue,), name='db-writer', daemon=True)
+                self._worker.start()
+        return self._queue
+
+    def _run(self, jobs):
+        while True:
+            batch = [jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(jobs.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        results = []
+        try:
+            with transaction.atomic():
+                for func, args, kwargs, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with transaction.atomic():
+                            results.append((future, True, func(*args, **kwargs)))
+                    except Exception as e:
+                        results.append((future, False, e))
+        except Exception as e:
+            #the commit itself failed: none of the writes happened
+            logger.exception('could not commit %s queued writes', len(batch))
+            connection.close_if_unusable_or_obsolete()
+            results = [(future, False, e) for _, _, _, future in batch if future.running()]
+        self.batches += 1
+        for future, ok, value in results:
+            if ok:
+                self.written += 1
+                future.set_result(value)
+            else:
+                self.failed += 1
+                future.set_exception(value)
+
+
+def _build_queue():
+    options = {**DEFAULTS, **getattr(settings, 'WRITE_QUEUE', {})}
+    return WriteQueue(
+        enabled=options['ENABLED'],
+        batch_size=options['BATCH_SIZE'],
+        timeout=options['TIMEOUT'],
+    )
+
+
+write_queue = _build_queue()
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 14:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_remove_profile_bookmarked_posts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='pfp_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
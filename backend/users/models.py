@@ -6,6 +6,7 @@ from posts.models import Post
 class Profile(models.Model):
     user = models.OneToOneField(User,related_name='profile',on_delete=models.CASCADE)
     pfp = models.ImageField(upload_to='users/',null=True,blank=True)
+    pfp_variants = models.JSONField(default=dict,blank=True)   #resized copies of pfp, see posts/images.py
     first_name = models.CharField(max_length=50)
     last_name = models.CharField(max_length=50)
     age = models.IntegerField(null=True,blank=True)
@@ -2,10 +2,14 @@ from rest_framework.serializers import Serializer,ModelSerializer
 from django.contrib.auth.models import User
 from .models import Profile
 from rest_framework import serializers
+from posts.metrics import TimedSerializerMixin
+from posts.images import variant_urls
+from drf_spectacular.utils import extend_schema_field
+from typing import Dict
 
 
 
-class UserSerializer(ModelSerializer):
+class UserSerializer(TimedSerializerMixin,ModelSerializer):
     class Meta:
         model = User
         fields = ['id','email','username','password','first_name','last_name']
@@ -26,11 +30,16 @@ class UserSerializer(ModelSerializer):
         password = validated_data.pop('password')
         return super().update(instance, validated_data)
     
-class ProfileSerializer(ModelSerializer):
+class ProfileSerializer(TimedSerializerMixin,ModelSerializer):
     user = UserSerializer()
+    pfp_variants = serializers.SerializerMethodField()
     class Meta:
         model = Profile
-        fields = ['id','user','pfp','first_name','last_name','age','phone','accept_notifications']
+        fields = ['id','user','pfp','pfp_variants','first_name','last_name','age','phone','accept_notifications']
+
+    @extend_schema_field(Dict[str, Dict[str, str]])
+    def get_pfp_variants(self, obj):
+        return variant_urls(obj.pfp_variants, self.context.get('request'))
 
 
     def create(self, validated_data):
@@ -10,6 +10,10 @@ from posts.models import Post
 from rest_framework import status
 from posts.filters import PostFilter
 from django_filters.rest_framework import DjangoFilterBackend
+from posts.pagination import OldestFirstKeysetPagination
+from posts.response_cache import AnonymousResponseCacheMixin
+from posts.images import delete_variants
+from posts.tasks import schedule_image_variants
 
 
 class MyProfileViewUpdate(APIView):
@@ -73,7 +77,7 @@ def view_profile(request,user_id):
     return Response(prof_ser.data)
 
 
-class ListUserPosts(ListAPIView):
+class ListUserPosts(AnonymousResponseCacheMixin, ListAPIView):
     """
     List user posts
     
@@ -82,20 +86,24 @@ class ListUserPosts(ListAPIView):
     Authentication: Not required
     
     Request Body: None
+    Query Parameters: cursor (optional), opaque cursor taken from the "next"/"previous" links
     
     Response:
-    - 200: [PostSerializer objects]
+    - 200: {"next": url, "previous": url, "results": [PostSerializer objects]}
     - 404: {"detail": "Not found."}
     """
     serializer_class = PostSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_class = PostFilter
+    pagination_class = OldestFirstKeysetPagination
 
+    def cache_scopes(self):
+        return [f"user_posts:{self.kwargs.get('user_id')}", 'tags']
 
     def get_queryset(self):
         user_id = self.kwargs.get('user_id')
         user = get_object_or_404(User,id=user_id)
-        posts = Post.objects.filter(owner=user,status='PUBLISHED').order_by('created_at')
+        posts = Post.objects.filter(owner=user,status='PUBLISHED').order_by('created_at').for_feed(self.request.user)
         return posts
 
 
@@ -119,7 +127,7 @@ class ListUserDrafts(ListAPIView):
     
     def get_queryset(self):
         user = self.request.user
-        posts = Post.objects.filter(owner=user,status='DRAFT').order_by('created_at')
+        posts = Post.objects.filter(owner=user,status='DRAFT').order_by('created_at').for_feed(user)
         return posts
 
 @api_view(['GET'])
@@ -169,12 +177,15 @@ def upload_profile_picture(request):
     if profile.pfp:
 
         profile.pfp.delete()
+        delete_variants(profile.pfp_variants)
+        profile.pfp_variants = {}
     
     pfp_file = request.FILES.get('pfp')
     
     if pfp_file:
         profile.pfp = pfp_file
         profile.save()
+        schedule_image_variants(profile, 'pfp', 'pfp_variants')
 
 
     else:
@@ -203,7 +214,9 @@ def remove_profile_picture(request):
     profile = user.profile
     if profile.pfp:
         profile.pfp.delete()
+    delete_variants(profile.pfp_variants)
     profile.pfp = None
+    profile.pfp_variants = {}
     profile.save()
     return Response({'message': 'Profile picture removed successfully'},status=status.HTTP_200_OK)
 
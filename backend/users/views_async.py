@@ -0,0 +1,13 @@
+from posts.views_async import async_read, json_response
+from .views import current_user_info as sync_current_user_info
+
+
+async def user_info(request):
+    #request.user was loaded from the JWT by async_read
+    return json_response({
+        'is_auth': request.user.is_authenticated,
+        'id': request.user.id,
+    })
+
+
+current_user_info = async_read(user_info, sync_current_user_info)